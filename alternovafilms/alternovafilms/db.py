@@ -0,0 +1,118 @@
+"""
+Database profiles for alternovafilms
+
+The profile is chosen with the DATABASE_PROFILE environment variable:
+
+development (default): the SQLite file next to manage.py with the Django defaults.
+
+production: persistent connections checked before reuse and, on SQLite, a
+busy timeout plus the SQLITE_PRAGMAS below, applied to every new connection
+by the connection_created hook. WAL lets readers run while a rating or a
+visualization is written and the busy timeout makes concurrent writers wait
+for the lock instead of failing with "database is locked".
+
+Postgres is used when DATABASE_ENGINE=postgres, with DATABASE_NAME,
+DATABASE_USER, DATABASE_PASSWORD, DATABASE_HOST and DATABASE_PORT. Django
+keeps one persistent connection per worker thread, put pgbouncer in front of
+the database to pool them between processes.
+
+Read replicas are listed, comma separated, in DATABASE_REPLICAS: hosts on
+Postgres and database files on SQLite, a copy of db.sqlite3 can stand in for
+a replica locally. They become the replica_1, replica_2... aliases that
+alternovafilms.routers sends the reads of GET requests to.
+"""
+
+import os
+from django.db.backends.signals import connection_created
+
+REPLICA_PREFIX = "replica_"
+
+PROFILES = ("development", "production")
+
+# seconds a connection is kept open between requests on the production profile
+CONN_MAX_AGE = 600
+
+# seconds a SQLite connection waits for a lock before raising "database is locked"
+SQLITE_BUSY_TIMEOUT = 20
+
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": SQLITE_BUSY_TIMEOUT * 1000,
+    "cache_size": -64000,  # KiB, negative values are sizes instead of pages
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+}
+
+
+def get_profile():
+    profile = os.environ.get("DATABASE_PROFILE", "development")
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown DATABASE_PROFILE {profile}, use one of {', '.join(PROFILES)}")
+    return profile
+
+
+def database_settings(base_dir, profile=None):
+    """
+    Build the DATABASES setting of a profile
+
+    Args:
+        base_dir (Path): Project directory, the SQLite file lives there
+        profile (str): development or production, by default DATABASE_PROFILE
+
+    Returns:
+        dict: DATABASES setting
+    """
+    profile = profile or get_profile()
+    if os.environ.get("DATABASE_ENGINE") == "postgres":
+        database = {
+            "ENGINE": "django.db.backends.postgresql",
+            "NAME": os.environ.get("DATABASE_NAME", "alternovafilms"),
+            "USER": os.environ.get("DATABASE_USER", ""),
+            "PASSWORD": os.environ.get("DATABASE_PASSWORD", ""),
+            "HOST": os.environ.get("DATABASE_HOST", ""),
+            "PORT": os.environ.get("DATABASE_PORT", ""),
+        }
+        if profile == "production":
+            database["OPTIONS"] = {"connect_timeout": 5}
+    else:
+        database = {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": os.environ.get("DATABASE_NAME", base_dir / "db.sqlite3"),
+        }
+        if profile == "production":
+            database["OPTIONS"] = {"timeout": SQLITE_BUSY_TIMEOUT}
+
+    if profile == "production":
+        database["CONN_MAX_AGE"] = CONN_MAX_AGE
+        database["CONN_HEALTH_CHECKS"] = True
+
+    databases = {"default": database}
+    location = "HOST" if database["ENGINE"] == "django.db.backends.postgresql" else "NAME"
+    replicas = [replica.strip() for replica in os.environ.get("DATABASE_REPLICAS", "").split(",") if replica.strip()]
+    for number, replica in enumerate(replicas, start=1):
+        # tests run against the primary test database, there is no replication to wait for
+        databases[f"{REPLICA_PREFIX}{number}"] = {**database, location: replica, "TEST": {"MIRROR": "default"}}
+    return databases
+
+
+def replica_aliases(databases):
+    return [alias for alias in databases if alias.startswith(REPLICA_PREFIX)]
+
+
+def apply_pragmas(cursor, pragmas):
+    for name, value in pragmas.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    """
+    connection_created hook applying SQLITE_PRAGMAS to the new SQLite connections of the production profile
+    """
+    if connection.vendor != "sqlite" or get_profile() != "production":
+        return
+    with connection.cursor() as cursor:
+        apply_pragmas(cursor, SQLITE_PRAGMAS)
+
+
+connection_created.connect(configure_sqlite, dispatch_uid="alternovafilms.db.configure_sqlite")
@@ -0,0 +1,253 @@
+"""
+Read replica routing for alternovafilms
+
+The reads of GET and HEAD requests go to one of the DATABASE_REPLICAS aliases,
+chosen once per request by the DATABASE_REPLICA_SELECTION strategy, so every
+query of a page sees the same replica. Everything else uses the primary:
+writes, the reads of POST, PUT, PATCH and DELETE requests, the reads that
+follow a write on the same request and the reads made outside of a request,
+like the management commands.
+
+Replicas lag behind the primary, so a user who just rated or visualized a film
+could read the old values back. After an unsafe request that wrote, the
+response sets a cookie that keeps the reads of that browser on the primary for
+DATABASE_STICKY_SECONDS, and an authenticated user is also marked in the cache
+for as long, so the clients that drop cookies, like the token clients and the
+other devices of the user, read from the primary too. The user is only known
+once the authentication ran, so the mark is checked on the first read of the
+request instead of when the replica is chosen.
+"""
+
+import asyncio
+import threading
+from collections import OrderedDict
+from contextvars import ContextVar
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.decorators import sync_and_async_middleware
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+STICKY_COOKIE = "films_primary"
+STICKY_USER_KEY = "alternovafilms:primary-user:{}"
+
+# apps always read from the primary, a session missing on a lagging replica logs the user out
+PRIMARY_APPS = ("sessions",)
+
+
+class RequestRoute:
+    """
+    Database the reads of the current request go to
+
+    attributes:
+        alias (str): Replica alias, None while the reads use the primary
+        replica (str): Replica chosen for the request, kept after a write pins the reads
+        wrote (bool): The request wrote to the primary
+        request (HttpRequest): Request whose user has not been checked for a recent write yet
+    """
+
+    def __init__(self, alias=None, request=None):
+        self.alias = alias
+        self.replica = alias
+        self.wrote = False
+        self.request = request if alias is not None else None
+
+    def read_alias(self):
+        """
+        alias of the next read, the first read moves to the primary when the user wrote recently
+        """
+        if self.request is not None:
+            # cleared first, loading the user reads from the database and comes back here
+            request, self.request = self.request, None
+            if is_user_sticky(request):
+                self.alias = None
+        return self.alias
+
+    def pin(self):
+        """
+        send the next reads of the request to the primary, they may need to see the write
+        """
+        self.alias = None
+        self.wrote = True
+
+
+_route = ContextVar("alternovafilms_route", default=None)
+
+
+class RoundRobinSelector:
+    """
+    Hand out the replicas in turn
+    """
+
+    def __init__(self, aliases):
+        self.aliases = list(aliases)
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def choose(self):
+        with self._lock:
+            alias = self.aliases[self._next % len(self.aliases)]
+            self._next += 1
+        return alias
+
+    def release(self, alias):
+        pass
+
+
+class LeastRecentlyUsedSelector:
+    """
+    Hand out the replica that has gone the longest without starting or finishing a request
+
+    Unlike the round-robin, a replica is used again when its request finishes,
+    so the replicas that just served a request go to the back of the line.
+    """
+
+    def __init__(self, aliases):
+        self._used = OrderedDict((alias, None) for alias in aliases)
+        self._lock = threading.Lock()
+
+    def choose(self):
+        with self._lock:
+            alias = next(iter(self._used))
+            self._used.move_to_end(alias)
+        return alias
+
+    def release(self, alias):
+        with self._lock:
+            if alias in self._used:
+                self._used.move_to_end(alias)
+
+
+SELECTORS = {
+    "round_robin": RoundRobinSelector,
+    "lru": LeastRecentlyUsedSelector,
+}
+
+_selector = None
+_selector_key = None
+_selector_lock = threading.Lock()
+
+
+def get_selector():
+    """
+    get the replica selector of the current settings, None without replicas
+    """
+    global _selector, _selector_key
+    aliases = tuple(getattr(settings, "DATABASE_REPLICAS", ()))
+    if not aliases:
+        return None
+    key = (aliases, getattr(settings, "DATABASE_REPLICA_SELECTION", "round_robin"))
+    with _selector_lock:
+        if key != _selector_key:
+            if key[1] not in SELECTORS:
+                raise ValueError(f"Unknown DATABASE_REPLICA_SELECTION {key[1]}, use one of {', '.join(SELECTORS)}")
+            _selector, _selector_key = SELECTORS[key[1]](aliases), key
+        return _selector
+
+
+class ReplicaRouter:
+    """
+    Route the reads to the replica chosen for the request and the writes to the primary
+    """
+
+    def db_for_read(self, model, **hints):
+        route = _route.get()
+        if route is None or model._meta.app_label in PRIMARY_APPS:
+            return DEFAULT_DB_ALIAS
+        return route.read_alias() or DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        route = _route.get()
+        if route is not None:
+            route.pin()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas get the schema through the replication
+        return db == DEFAULT_DB_ALIAS
+
+
+def is_sticky(request):
+    return request.COOKIES.get(STICKY_COOKIE) is not None
+
+
+def authenticated_user_id(request):
+    """
+    id of the user of the request, None before the authentication ran or for anonymous users
+    """
+    user = getattr(request, "user", None)
+    if user is None or not user.is_authenticated:
+        return None
+    return user.pk
+
+
+def is_user_sticky(request):
+    user_id = authenticated_user_id(request)
+    return user_id is not None and cache.get(STICKY_USER_KEY.format(user_id)) is not None
+
+
+def start_route(request):
+    """
+    choose the database of the request reads and make it the current route
+
+    Returns:
+        tuple: Route and the token to restore the previous route
+    """
+    selector = get_selector()
+    alias = None
+    if selector is not None and request.method in SAFE_METHODS and not is_sticky(request):
+        alias = selector.choose()
+    route = RequestRoute(alias, request)
+    return route, _route.set(route)
+
+
+def finish_route(route, token):
+    _route.reset(token)
+    selector = get_selector()
+    if selector is not None and route.replica is not None:
+        selector.release(route.replica)
+
+
+def stick_to_primary(request, response, route):
+    """
+    keep the next reads of the user on the primary for a while after a write
+    """
+    if route.wrote and request.method not in SAFE_METHODS:
+        seconds = getattr(settings, "DATABASE_STICKY_SECONDS", 10)
+        response.set_cookie(STICKY_COOKIE, "1", max_age=seconds, httponly=True, samesite="Lax")
+        user_id = authenticated_user_id(request)
+        if user_id is not None:
+            cache.set(STICKY_USER_KEY.format(user_id), 1, seconds)
+    return response
+
+
+@sync_and_async_middleware
+def replica_middleware(get_response):
+    """
+    Middleware choosing the database of the request reads, see the module docstring
+    """
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            route, token = start_route(request)
+            try:
+                response = await get_response(request)
+            finally:
+                finish_route(route, token)
+            if not route.wrote:
+                return response
+            # the user may still have to be loaded from the session
+            return await sync_to_async(stick_to_primary)(request, response, route)
+    else:
+        def middleware(request):
+            route, token = start_route(request)
+            try:
+                response = get_response(request)
+            finally:
+                finish_route(route, token)
+            return stick_to_primary(request, response, route)
+    return middleware
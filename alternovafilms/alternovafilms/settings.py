@@ -10,7 +10,9 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
+from alternovafilms.db import database_settings, replica_aliases
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -39,6 +41,7 @@ INSTALLED_APPS = [
     "django.contrib.staticfiles",
     # External apps
     "drf_yasg",
+    "rest_framework.authtoken",
 
     # My apps
     "films",
@@ -46,7 +49,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "films.metrics.MetricsMiddleware",
+    "films.instrumentation.InstrumentationMiddleware",
     "django.middleware.security.SecurityMiddleware",
+    "alternovafilms.routers.replica_middleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -83,10 +89,30 @@ WSGI_APPLICATION = "alternovafilms.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
-DATABASES = {
+# The profile is chosen with DATABASE_PROFILE (development or production), see alternovafilms/db.py
+
+DATABASES = database_settings(BASE_DIR)
+
+# Reads of GET requests go to the replicas of DATABASE_REPLICAS, see alternovafilms/routers.py
+# Selection: round_robin or lru. Reads stay on the primary DATABASE_STICKY_SECONDS after a write.
+
+DATABASE_ROUTERS = ["alternovafilms.routers.ReplicaRouter"]
+DATABASE_REPLICAS = replica_aliases(DATABASES)
+DATABASE_REPLICA_SELECTION = os.environ.get("DATABASE_REPLICA_SELECTION", "round_robin")
+DATABASE_STICKY_SECONDS = 10
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+# The home snapshot and other film caches live here, use a shared backend
+# (Redis or Memcached) when running more than one worker process.
+
+CACHES = {
     "default": {
-        "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "alternovafilms",
+        # film bodies and versions take two entries per film
+        "OPTIONS": {"MAX_ENTRIES": 20000},
     }
 }
 
@@ -139,3 +165,44 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 LOGIN_REDIRECT_URL = '/'
 LOGOUT_REDIRECT_URL = '/'
 
+
+# Films settings
+# Visualizations are written in batches, when FILMS_VISUALIZATION_FLUSH_SIZE increments
+# are pending or every FILMS_VISUALIZATION_FLUSH_INTERVAL seconds
+FILMS_VISUALIZATION_FLUSH_SIZE = 100
+FILMS_VISUALIZATION_FLUSH_INTERVAL = 5
+
+# Films watched and rated by each user are cached in process memory for at most
+# FILMS_ACTIVITY_CACHE_SIZE users and FILMS_ACTIVITY_CACHE_TIMEOUT seconds, a user
+# is loaded again as soon as another process writes its activity
+FILMS_ACTIVITY_CACHE_SIZE = 1000
+FILMS_ACTIVITY_CACHE_TIMEOUT = 60 * 5
+
+# A share of the requests is measured and gets a Server-Timing header with the number of
+# queries and the SQL, serialization and render times, FILMS_INSTRUMENTATION_LOG also
+# writes them as a JSON line on the films.instrumentation logger
+FILMS_INSTRUMENTATION_SAMPLE_RATE = 1.0 if DEBUG else 0.01
+FILMS_INSTRUMENTATION_HEADER = True
+FILMS_INSTRUMENTATION_LOG = False
+
+# Leaderboards keep the best FILMS_LEADERBOARD_SIZE films of every genre and film type
+FILMS_LEADERBOARD_SIZE = 10
+
+# Request counters and latency histograms served at /metrics/, every worker process writes
+# its metrics to FILMS_METRICS_DIR at most every FILMS_METRICS_WRITE_INTERVAL seconds so the
+# endpoint can add them up, without a directory only the serving process is shown. The endpoint
+# is served to staff users and to scrapers sending "Authorization: Bearer <FILMS_METRICS_TOKEN>"
+FILMS_METRICS_DIR = os.environ.get("FILMS_METRICS_DIR")
+FILMS_METRICS_WRITE_INTERVAL = 10
+FILMS_METRICS_TOKEN = os.environ.get("FILMS_METRICS_TOKEN")
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {
+        "console": {"class": "logging.StreamHandler"},
+    },
+    "loggers": {
+        "films.instrumentation": {"handlers": ["console"], "level": "INFO", "propagate": False},
+    },
+}
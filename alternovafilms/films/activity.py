@@ -0,0 +1,210 @@
+import threading
+import time
+from array import array
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from django.conf import settings
+import films.models as film_models
+import films.cache as film_cache
+
+
+class UserActivityCache:
+    """
+    Process wide LRU cache of the films watched and rated by each user
+
+    Every cached user keeps a sorted array of watched film ids and another one
+    of rated film ids, so "did the user watch or rate this film" is a binary
+    search in memory. A user costs one query per kind on a miss.
+
+    At most FILMS_ACTIVITY_CACHE_SIZE users are kept, the least recently used
+    one is evicted first. Every entry remembers the shared user version it was
+    loaded under, the one bump_user_version moves on every write, and is
+    loaded again once the version moved, so writes made by other processes
+    show up on the next lookup at the cost of one cache read. The films
+    signals and the bulk views update the cached arrays of their own writes
+    and keep the entry on the new version. Entries also expire after
+    FILMS_ACTIVITY_CACHE_TIMEOUT seconds in case the shared cache lost a
+    version.
+    """
+
+    models = {
+        "watched": film_models.UserFilmVisualization,
+        "rated": film_models.UserFilmRating,
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def max_size(self):
+        return getattr(settings, "FILMS_ACTIVITY_CACHE_SIZE", 1000)
+
+    @property
+    def timeout(self):
+        return getattr(settings, "FILMS_ACTIVITY_CACHE_TIMEOUT", 60 * 5)
+
+    def _load(self, user_id, version):
+        entry = {"expires": time.monotonic() + self.timeout, "version": version}
+        for kind, model in self.models.items():
+            film_ids = model.objects.filter(user_id=user_id).order_by("film_id").values_list("film_id", flat=True)
+            entry[kind] = array("q", film_ids)
+        return entry
+
+    def get(self, user_id):
+        """
+        Return the cached activity of a user, loading it on a miss
+
+        Args:
+            user_id (int): User id
+
+        Returns:
+            dict: watched and rated sorted arrays of film ids
+        """
+        key = film_cache.USER_VERSION_KEY.format(user_id)
+        version = film_cache.get_versions([key])[key]
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry["version"] == version and entry["expires"] > time.monotonic():
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        entry = self._load(user_id, version)
+        with self._lock:
+            self._entries[user_id] = entry
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+    def contains(self, user_id, kind, film_id):
+        """
+        Check if the user watched or rated the film
+
+        Args:
+            user_id (int): User id
+            kind (str): watched or rated
+            film_id (int): Film id
+
+        Returns:
+            bool: True if the film is on the user activity
+        """
+        film_ids = self.get(user_id)[kind]
+        index = bisect_left(film_ids, film_id)
+        return index < len(film_ids) and film_ids[index] == film_id
+
+    def add(self, user_id, kind, film_ids, versions=None):
+        """
+        Add films to the activity of a cached user, users that are not cached are loaded on their next lookup
+
+        Args:
+            user_id (int): User id
+            kind (str): watched or rated
+            film_ids (list): Film ids
+            versions (tuple): Previous and new user version returned by bump_user_version for this write
+        """
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            for film_id in film_ids:
+                index = bisect_left(entry[kind], film_id)
+                if index == len(entry[kind]) or entry[kind][index] != film_id:
+                    insort(entry[kind], film_id)
+            self._follow(entry, versions)
+
+    def remove(self, user_id, kind, film_ids, versions=None):
+        """
+        Remove films from the activity of a cached user, see add
+        """
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            for film_id in film_ids:
+                index = bisect_left(entry[kind], film_id)
+                if index < len(entry[kind]) and entry[kind][index] == film_id:
+                    del entry[kind][index]
+            self._follow(entry, versions)
+
+    def _follow(self, entry, versions):
+        # an entry that missed a write of another process keeps its old version and is loaded again
+        if versions is not None and entry["version"] == versions[0]:
+            entry["version"] = versions[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """
+        Return the hits, misses, evictions and number of cached users
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+            }
+
+
+user_activity = UserActivityCache()
+
+
+class FilmActivityLoader:
+    """
+    Request scoped reader of the films watched and rated by the current user
+
+    The activity of the user is taken from the user activity cache once per
+    request, so the template filters of a whole page are memory lookups and
+    cost at most one query per kind whatever the page size.
+
+    Args:
+        user_id (int): Id of the current user, None for anonymous users
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self._activity = None
+
+    @classmethod
+    def for_request(cls, request):
+        """
+        Return the loader of the request, creating it on first use
+
+        Args:
+            request (HttpRequest|Request): Django or rest_framework request
+
+        Returns:
+            FilmActivityLoader: Loader of the request user
+        """
+        request = getattr(request, "_request", request)
+        loader = getattr(request, "_film_activity", None)
+        if loader is None:
+            user = getattr(request, "user", None)
+            loader = cls(user.pk if user is not None and user.is_authenticated else None)
+            request._film_activity = loader
+        return loader
+
+    def _contains(self, kind, film_id):
+        if self.user_id is None:
+            return False
+        if self._activity is None:
+            self._activity = user_activity.get(self.user_id)
+        film_ids = self._activity[kind]
+        index = bisect_left(film_ids, film_id)
+        return index < len(film_ids) and film_ids[index] == film_id
+
+    def watched(self, film_id):
+        return self._contains("watched", film_id)
+
+    def rated(self, film_id):
+        return self._contains("rated", film_id)
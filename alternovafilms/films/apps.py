@@ -1,4 +1,5 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class FilmsConfig(AppConfig):
@@ -7,3 +8,7 @@ class FilmsConfig(AppConfig):
 
     def ready(self):
         import films.signals
+        from films.instrumentation import install_query_recorder
+
+        # every connection counts the queries of the sampled requests
+        connection_created.connect(install_query_recorder, dispatch_uid="films.instrumentation.install_query_recorder")
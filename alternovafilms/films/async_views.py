@@ -0,0 +1,210 @@
+import asyncio
+from asgiref.sync import sync_to_async
+from django.contrib.auth.views import redirect_to_login
+from django.http import Http404, HttpResponse
+from django.shortcuts import render
+from django.views import View
+from rest_framework import exceptions, renderers
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.negotiation import DefaultContentNegotiation
+from rest_framework.request import Request
+from rest_framework.views import exception_handler
+import films.models as film_models
+import films.cache as film_cache
+import films.counters as film_counters
+import films.views as film_views
+import films.instrumentation as film_instrumentation
+from films.utils import StandardResultsSetPagination, FilteredDataResultsSetPagination, FilmCursorPagination
+
+
+class AsyncFilmView(View):
+    """
+    Base class of the async read views
+
+    The views run on the event loop under ASGI, film lookups use the async ORM
+    and the work that is still sync in Django (sessions, paginators, the films
+    cache and template rendering) is grouped in as few sync_to_async calls as
+    possible. The response is negotiated and rendered with the same renderers
+    and templates as the rest_framework views, so both return the same body.
+    Requests are authenticated with a token like the rest_framework views and
+    fall back to the session.
+
+    attributes:
+        template_name (str): Template of the HTML responses
+        login_required (bool): Redirect anonymous users to the login page like LoginRequiredMixin
+        sync_view (APIView): Sync view the queryset building is borrowed from
+    """
+
+    template_name = None
+    login_required = True
+    sync_view = None
+    renderer_classes = [renderers.TemplateHTMLRenderer, renderers.JSONRenderer]
+
+    async def dispatch(self, request, *args, **kwargs):
+        self.renderer, self.media_type = self.negotiate(request)
+        try:
+            if not await sync_to_async(self.authenticate)(request) and self.login_required:
+                return redirect_to_login(request.get_full_path())
+            return await super().dispatch(request, *args, **kwargs)
+        except (Http404, exceptions.APIException) as exc:
+            if isinstance(self.renderer, renderers.TemplateHTMLRenderer):
+                if isinstance(exc, exceptions.AuthenticationFailed):
+                    return redirect_to_login(request.get_full_path())
+                raise Http404(str(exc))
+            error = exception_handler(exc, {})
+            return await self.render(request, error.data, status=error.status_code)
+
+    def authenticate(self, request):
+        """
+        set the user of a valid token on the request, without a token the session user is kept
+
+        Returns:
+            bool: Whether the request is authenticated
+        """
+        credentials = TokenAuthentication().authenticate(Request(request))
+        if credentials is not None:
+            request.user = credentials[0]
+        return request.user.is_authenticated
+
+    def negotiate(self, request):
+        """
+        pick the renderer like the rest_framework views do, from the Accept header and the format parameter
+        """
+        try:
+            return DefaultContentNegotiation().select_renderer(
+                Request(request), [renderer() for renderer in self.renderer_classes],
+            )
+        except exceptions.NotAcceptable:
+            return renderers.JSONRenderer(), renderers.JSONRenderer.media_type
+
+    def get_sync_view(self, request, **kwargs):
+        return self.sync_view(request=request, kwargs=kwargs)
+
+    async def render(self, request, data, template_name=None, status=200):
+        """
+        render the data with the negotiated renderer, templates may query the database so they run in a thread
+        """
+        def render_data():
+            with film_instrumentation.timer("render"):
+                if isinstance(self.renderer, renderers.TemplateHTMLRenderer):
+                    return render(request, template_name or self.template_name, data, status=status)
+                content = self.renderer.render(data, self.media_type, {})
+                return HttpResponse(content, content_type=self.media_type, status=status)
+
+        return await sync_to_async(render_data)()
+
+
+class AsyncHomeView(AsyncFilmView):
+    """
+    Async Home view
+
+    Same response as HomeView. The home snapshot and the random film are
+    loaded concurrently.
+    """
+    template_name = "films/index.html"
+    login_required = False
+
+    async def get(self, request, *args, **kwargs):
+        snapshot, random_movie = await asyncio.gather(
+            sync_to_async(film_cache.get_home_snapshot)(),
+            film_models.Film.objects.only("pk").arandom(),
+        )
+        random_movie = await sync_to_async(film_cache.get_films)([random_movie.pk] if random_movie is not None else [])
+
+        top_films = film_counters.visualizations.with_pending(snapshot["top_films"])
+        most_seen = film_counters.visualizations.with_pending(snapshot["most_seen"])
+        random_movie = film_counters.visualizations.with_pending(random_movie[0] if random_movie else None)
+        return await self.render(request, {"top_films":top_films, "most_seen":most_seen, "random_movie":random_movie})
+
+
+class AsyncFilmListView(AsyncFilmView):
+    """
+    Async Film Listing View
+
+    Same parameters and response as FilmListView
+    """
+    template_name = "films/films.html"
+    sync_view = film_views.FilmListView
+
+    async def get(self, request, *args, **kwargs):
+        films = self.get_sync_view(request).get_queryset()
+        if FilmCursorPagination.is_requested(request):
+            paginator = FilmCursorPagination()
+        else:
+            paginator = StandardResultsSetPagination()
+
+        def paginate():
+            page = paginator.paginate_queryset(films, Request(request))
+            data = film_counters.visualizations.with_pending(film_cache.get_films([film["pk"] for film in page]))
+            return paginator.get_paginated_response(data, template_name=self.template_name, status=200).data
+
+        return await self.render(request, await sync_to_async(paginate)())
+
+
+class AsyncFilmDetailView(AsyncFilmView):
+    """
+    Async Film Detail View
+
+    Same response as FilmDetailView
+    """
+    template_name = "films/film_detail.html"
+
+    async def get(self, request, *args, **kwargs):
+        film_id = await film_models.Film.objects.filter(slug=kwargs.get("slug")).values_list("pk", flat=True).afirst()
+        return await self.render_film(request, film_id)
+
+    async def render_film(self, request, film_id):
+        films = await sync_to_async(film_cache.get_films)([film_id] if film_id is not None else [])
+        if not films:
+            raise Http404("Film not found")
+        return await self.render(request, {"film":film_counters.visualizations.with_pending(films[0])})
+
+
+class AsyncRandomFilmView(AsyncFilmDetailView):
+    """
+    Async Random Film View
+
+    Same parameters and response as RandomFilmView
+    """
+
+    async def get(self, request, *args, **kwargs):
+        film = await film_models.Film.objects.only("pk").arandom(
+            genre=request.GET.get("genre", None), film_type=request.GET.get("film_type", None),
+        )
+        return await self.render_film(request, film.pk if film is not None else None)
+
+
+class AsyncSearchFilmView(AsyncFilmView):
+    """
+    Async Search Film View
+
+    Same parameters and response as SearchFilmView
+    """
+    template_name = "films/search.html"
+    sync_view = film_views.SearchFilmView
+
+    async def get(self, request, *args, **kwargs):
+        title = request.GET.get("title", None)
+        genres = request.GET.getlist("genres", None)
+        film_type = request.GET.get("film_type", None)
+
+        genres_list = film_models.Genre.objects.all().values('name')
+        film_types_list = film_models.FilmType.objects.all().values('name')
+        filtering_data = {'genres_list': genres_list, 'film_types_list': film_types_list}
+
+        if not title and not genres and not film_type:
+            return await self.render(request, {"message":"Please provide a title, genre or film type", "filtering_data":filtering_data})
+
+        def search():
+            films = self.get_sync_view(request).get_queryset()
+            paginator = FilteredDataResultsSetPagination()
+            page = paginator.paginate_queryset(films, Request(request))
+            if not page:
+                return None
+            data = film_counters.visualizations.with_pending(film_cache.get_films([film["pk"] for film in page]))
+            return paginator.get_paginated_response({"results":data, "filtering_data":filtering_data}, template_name=self.template_name, status=200).data
+
+        data = await sync_to_async(search)()
+        if data is None:
+            data = {"message":"No films found", "filtering_data":filtering_data}
+        return await self.render(request, data)
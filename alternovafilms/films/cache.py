@@ -0,0 +1,268 @@
+import time
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+import films.models as film_models
+import films.serializers as film_serializers
+import films.instrumentation as film_instrumentation
+
+CATALOG_VERSION_KEY = "films:catalog-version"
+STATS_VERSION_KEY = "films:stats-version"
+FILM_VERSION_KEY = "films:film-version:{}"
+USER_VERSION_KEY = "films:user-version:{}"
+FILM_SLUG_KEY = "films:film-slug:{}"
+FILM_BODY_KEY = "films:film-body:{}:{}:{}"
+FILM_BODY_TIMEOUT = 60 * 60
+
+HOME_SNAPSHOT_KEY = "films:home-snapshot"
+HOME_SNAPSHOT_TIMEOUT = 60 * 5
+
+# section name -> (ordering field, number of films)
+HOME_SECTIONS = {
+    "top_films": ("rating", 5),
+    "most_seen": ("visualizations", 3),
+}
+
+
+def _new_version(previous=None):
+    """
+    versions are nanosecond timestamps so a key lost by the cache never comes back with an old value
+    """
+    return max(time.time_ns(), (previous or 0) + 1)
+
+
+def get_versions(keys):
+    """
+    get several versions with one cache call, missing versions start now
+
+    Args:
+        keys (list): Version keys
+
+    Returns:
+        dict: key -> version
+    """
+    versions = cache.get_many(keys)
+    raced = []
+    for key in keys:
+        if key not in versions:
+            version = _new_version()
+            if cache.add(key, version, None):
+                versions[key] = version
+            else:
+                raced.append(key)
+    if raced:
+        versions.update(cache.get_many(raced))
+    return versions
+
+
+def bump_versions(keys):
+    """
+    move several versions forward, the keys built with the old ones are not used anymore
+
+    Returns:
+        dict: key -> (previous version or None, new version)
+    """
+    versions = cache.get_many(keys)
+    bumped = {key: (versions.get(key), _new_version(versions.get(key))) for key in keys}
+    cache.set_many({key: version for key, (_, version) in bumped.items()}, None)
+    return bumped
+
+
+def get_catalog_version():
+    """
+    get the catalog version, it changes every time films, genres or film types are
+    added, edited or deleted so it can be part of the cache keys built from the catalog
+    """
+    return get_versions([CATALOG_VERSION_KEY])[CATALOG_VERSION_KEY]
+
+
+def bump_catalog_version():
+    """
+    move the catalog to a new version, the keys built with the old one are not used anymore
+    """
+    bump_versions([CATALOG_VERSION_KEY])
+
+
+def bump_film_stats(film_ids):
+    """
+    bump the versions of films whose rating or visualizations changed and the stats version of the lists
+    """
+    bump_versions([STATS_VERSION_KEY] + [FILM_VERSION_KEY.format(pk) for pk in film_ids])
+
+
+def bump_user_version(user_id):
+    """
+    bump the version of the films watched and rated by a user
+
+    Returns:
+        tuple: Previous and new version, see UserActivityCache.add
+    """
+    key = USER_VERSION_KEY.format(user_id)
+    return bump_versions([key])[key]
+
+
+def get_film_id(slug):
+    """
+    get the id of a film from its slug, slugs don't change so the id can be cached
+
+    Returns:
+        int: Film id or None when there is no film with the slug
+    """
+    key = FILM_SLUG_KEY.format(slug)
+    film_id = cache.get(key)
+    if film_id is None:
+        film_id = film_models.Film.objects.filter(slug=slug).values_list("pk", flat=True).first()
+        if film_id is not None:
+            cache.set(key, film_id, HOME_SNAPSHOT_TIMEOUT)
+    return film_id
+
+
+def get_name_ids(model):
+    """
+    get the ids of the genres or film types by lowercase name, cached until the catalog changes
+
+    Args:
+        model (Model): Genre or FilmType
+
+    Returns:
+        dict: lowercase name -> list of ids
+    """
+    key = f"films:name-ids:{model._meta.model_name}:{get_catalog_version()}"
+    names = cache.get(key)
+    if names is None:
+        names = {}
+        for pk, name in model.objects.order_by("pk").values_list("pk", "name"):
+            names.setdefault(name.lower(), []).append(pk)
+        cache.set(key, names, HOME_SNAPSHOT_TIMEOUT)
+    return names
+
+
+def get_films(film_ids):
+    """
+    get serialized films from the films cache, only the misses are queried and serialized
+
+    Bodies are keyed by the catalog version and the film version, so a film
+    edited, rated or visualized gets a new key and the old body is not read
+    again. The versions and the bodies are read with one get_many each.
+
+    Args:
+        film_ids (list): Film ids in the order of the page
+
+    Returns:
+        list: Serialized films in the same order, each one a copy the caller can change
+    """
+    if not film_ids:
+        return []
+
+    version_keys = {pk: FILM_VERSION_KEY.format(pk) for pk in film_ids}
+    versions = get_versions([CATALOG_VERSION_KEY] + list(version_keys.values()))
+    catalog = versions[CATALOG_VERSION_KEY]
+    keys = {pk: FILM_BODY_KEY.format(catalog, pk, versions[key]) for pk, key in version_keys.items()}
+
+    bodies = cache.get_many(list(keys.values()))
+    missing = [pk for pk, key in keys.items() if key not in bodies]
+    if missing:
+        # read from the primary, a lagging replica would store an old body under the new version
+        films = film_models.Film.objects.using(DEFAULT_DB_ALIAS).filter(pk__in=missing)
+        fresh = {keys[film["pk"]]: film for film in _serialize(films)}
+        cache.set_many(fresh, FILM_BODY_TIMEOUT)
+        bodies.update(fresh)
+
+    return [dict(bodies[keys[pk]]) for pk in film_ids if keys[pk] in bodies]
+
+
+def _serialize(films):
+    """
+    serialize a films queryset into plain dicts so they can be stored on any cache backend
+    """
+    with film_instrumentation.timer("serialize"):
+        return film_serializers.FilmReadSerializer(films.read_model(), many=True).data
+
+
+def _sort_key(field):
+    return lambda film: (-film[field], film["title"])
+
+
+def build_home_snapshot():
+    """
+    build the home snapshot from the database and store it on the cache
+
+    Returns:
+        dict: top_films and most_seen lists already serialized
+    """
+    snapshot = {}
+    for section, (field, size) in HOME_SECTIONS.items():
+        films = film_models.Film.objects.using(DEFAULT_DB_ALIAS).order_by("-" + field, "title")[:size]
+        snapshot[section] = _serialize(films)
+
+    cache.set(HOME_SNAPSHOT_KEY, snapshot, HOME_SNAPSHOT_TIMEOUT)
+    return snapshot
+
+
+def get_home_snapshot():
+    """
+    get the home snapshot from the cache, building it on a miss
+    """
+    snapshot = cache.get(HOME_SNAPSHOT_KEY)
+    if snapshot is None:
+        snapshot = build_home_snapshot()
+    return snapshot
+
+
+def invalidate_home_snapshot():
+    """
+    drop the home snapshot, the next request will rebuild it
+    """
+    cache.delete(HOME_SNAPSHOT_KEY)
+
+
+def refresh_home_snapshots(film_ids):
+    """
+    place several films on the home snapshot, they are only read when the snapshot is cached
+
+    Args:
+        film_ids (list): Ids of the films whose rating or visualizations changed
+    """
+    if cache.get(HOME_SNAPSHOT_KEY) is None:
+        return
+    for film in film_models.Film.objects.filter(pk__in=film_ids):
+        refresh_home_snapshot(film)
+
+
+def refresh_home_snapshot(film):
+    """
+    place a film whose rating or visualizations changed on the home snapshot
+
+    The film is only serialized when it belongs to a section. When a listed film
+    drops to the last position we can't know which film should replace it without
+    querying, so the snapshot is invalidated instead.
+
+    Args:
+        film (Film): film with the updated rating and visualizations
+    """
+    snapshot = cache.get(HOME_SNAPSHOT_KEY)
+    if snapshot is None:
+        return
+
+    serialized = None
+    for section, (field, size) in HOME_SECTIONS.items():
+        films = snapshot[section]
+        listed = [entry for entry in films if entry["pk"] != film.pk]
+        was_listed = len(listed) != len(films)
+        key = _sort_key(field)
+        candidate = {"pk": film.pk, "title": film.title, field: getattr(film, field)}
+
+        if not was_listed and len(films) >= size and key(candidate) >= key(films[-1]):
+            continue
+
+        if serialized is None:
+            serialized = _serialize(film_models.Film.objects.filter(pk=film.pk))[0]
+
+        listed.append(serialized)
+        listed.sort(key=key)
+        if was_listed and len(films) >= size and listed[-1]["pk"] == film.pk:
+            invalidate_home_snapshot()
+            return
+
+        snapshot[section] = listed[:size]
+
+    cache.set(HOME_SNAPSHOT_KEY, snapshot, HOME_SNAPSHOT_TIMEOUT)
@@ -0,0 +1,69 @@
+import hashlib
+from functools import wraps
+from django.utils.cache import get_conditional_response, patch_vary_headers
+import films.cache as film_cache
+
+
+def conditional_get(version_keys):
+    """
+    Answer conditional GET requests of a view from the catalog versions
+
+    The ETag is built from the request path, the rendered format, the user and
+    the versions returned by version_keys, which are read with a single cache
+    call. When the client already has that representation the view returns
+    304 Not Modified before any catalog query or serialization runs.
+
+    No Last-Modified is sent, its one second granularity would answer 304 to
+    an If-Modified-Since sent in the same second as a change, so only
+    If-None-Match makes the request conditional.
+
+    Args:
+        version_keys (callable): Receives the view, the request and the url kwargs and returns the version keys
+
+    Returns:
+        function: Decorator for the get method of an APIView
+    """
+
+    def decorator(get):
+        @wraps(get)
+        def wrapper(self, request, *args, **kwargs):
+            keys = version_keys(self, request, **kwargs)
+            if keys is None:
+                return get(self, request, *args, **kwargs)
+
+            keys.append(film_cache.USER_VERSION_KEY.format(request.user.pk))
+            versions = film_cache.get_versions(keys)
+            representation = (
+                request.get_full_path(), request.accepted_media_type, request.user.pk,
+                [versions[key] for key in keys],
+            )
+            etag = '"%s"' % hashlib.sha1(repr(representation).encode()).hexdigest()
+
+            response = get_conditional_response(request, etag=etag)
+            if response is None:
+                response = get(self, request, *args, **kwargs)
+            if response.status_code in (200, 304):
+                response["ETag"] = etag
+            patch_vary_headers(response, ("Accept", "Cookie", "Authorization"))
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def catalog_versions(view, request, **kwargs):
+    """
+    versions of the film lists, they change with the catalog and with any rating or visualization
+    """
+    return [film_cache.CATALOG_VERSION_KEY, film_cache.STATS_VERSION_KEY]
+
+
+def film_versions(view, request, slug=None, **kwargs):
+    """
+    versions of a film detail, unknown slugs skip the conditional handling and get their 404
+    """
+    film_id = film_cache.get_film_id(slug)
+    if film_id is None:
+        return None
+    return [film_cache.CATALOG_VERSION_KEY, film_cache.FILM_VERSION_KEY.format(film_id)]
@@ -0,0 +1,141 @@
+import atexit
+import logging
+import os
+import threading
+from collections import defaultdict
+from django.conf import settings
+from django.db import close_old_connections
+import films.models as film_models
+import films.cache as film_cache
+import films.leaderboards as film_leaderboards
+
+logger = logging.getLogger(__name__)
+
+
+class VisualizationBuffer:
+    """
+    Write-behind buffer for the films visualizations counter
+
+    Increments are collected per film in process memory and written with one
+    batched UPDATE when FILMS_VISUALIZATION_FLUSH_SIZE increments are pending,
+    every FILMS_VISUALIZATION_FLUSH_INTERVAL seconds and when the process exits.
+    A flush size of 1 or less writes every increment straight away.
+
+    Responses merge the pending increments with the stored counter through
+    pending() and with_pending(), so the visualizations shown stay fresh.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = defaultdict(int)
+        self._size = 0
+        self._pid = os.getpid()
+        self._timer = None
+        atexit.register(self.flush)
+
+    @property
+    def flush_size(self):
+        return getattr(settings, "FILMS_VISUALIZATION_FLUSH_SIZE", 100)
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, "FILMS_VISUALIZATION_FLUSH_INTERVAL", 5)
+
+    def _check_fork(self):
+        """
+        forget the parent's pending increments and timer in a forked worker
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._pending = defaultdict(int)
+            self._size = 0
+            self._timer = None
+
+    def increment(self, film_id, delta=1):
+        """
+        Add delta visualizations to a film
+
+        Args:
+            film_id (int): Film id
+            delta (int): Number of visualizations to add, negative to remove
+        """
+        with self._lock:
+            self._check_fork()
+            self._pending[film_id] += delta
+            self._size += 1
+            flush = self._size >= self.flush_size
+            if not flush:
+                self._start_timer()
+
+        film_cache.bump_film_stats([film_id])
+        if flush:
+            self.flush()
+
+    def pending(self, film_id):
+        """
+        Return the visualizations of a film that are not written yet
+        """
+        return self._pending.get(film_id, 0)
+
+    def with_pending(self, data):
+        """
+        Add the pending visualizations to serialized films
+
+        Args:
+            data (dict|list): Serialized film or list of serialized films
+
+        Returns:
+            dict|list: The same data with the visualizations updated
+        """
+        films = data if isinstance(data, list) else [data]
+        for film in films:
+            if film and film.get("pk") is not None:
+                film["visualizations"] = film["visualizations"] + self.pending(film["pk"])
+        return data
+
+    def flush(self):
+        """
+        Write the pending visualizations with a single UPDATE
+
+        On failure the increments are put back so the next flush retries them.
+        """
+        with self._lock:
+            self._check_fork()
+            pending = {pk: delta for pk, delta in self._pending.items() if delta}
+            self._pending = defaultdict(int)
+            self._size = 0
+
+        if not pending:
+            return
+
+        try:
+            film_models.Film.objects.add_visualizations(pending)
+        except Exception:
+            logger.exception("Could not flush %s film visualizations", len(pending))
+            with self._lock:
+                for pk, delta in pending.items():
+                    self._pending[pk] += delta
+                    self._size += 1
+            return
+
+        film_cache.bump_film_stats(pending.keys())
+        film_cache.refresh_home_snapshots(pending.keys())
+        film_leaderboards.refresh(pending.keys(), ("visualizations",))
+
+    def _start_timer(self):
+        if self._timer is not None or self.flush_interval <= 0:
+            return
+        self._timer = threading.Timer(self.flush_interval, self._flush_on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _flush_on_timer(self):
+        with self._lock:
+            self._timer = None
+        try:
+            self.flush()
+        finally:
+            close_old_connections()
+
+
+visualizations = VisualizationBuffer()
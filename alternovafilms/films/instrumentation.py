@@ -0,0 +1,219 @@
+"""
+Per request instrumentation
+
+InstrumentationMiddleware measures a sample of the requests, chosen with
+FILMS_INSTRUMENTATION_SAMPLE_RATE (0 to 1):
+
+sql: number of queries and time spent in the database, counted by an
+execute_wrapper every connection gets when it's created
+serialize: time spent turning films into dicts, measured with timer("serialize")
+render: time spent rendering the response, the template or the JSON body
+total: time spent in the middleware and the view
+
+Measured requests get a Server-Timing header when FILMS_INSTRUMENTATION_HEADER
+is set, and a JSON log line on the films.instrumentation logger when
+FILMS_INSTRUMENTATION_LOG is set. Requests out of the sample only pay for
+the random draw and a context variable lookup per query.
+"""
+
+import asyncio
+import json
+import logging
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_metrics = ContextVar("films_instrumentation", default=None)
+
+
+class RequestMetrics:
+    """
+    Measures of one request
+
+    attributes:
+        queries (int): Number of SQL queries
+        timings (dict): Milliseconds per phase: sql, serialize and render
+        statements (list): SQL of the queries, only kept when record_sql is set
+        record_sql (bool): Keep the SQL of the queries, used by the query budget tests
+    """
+
+    def __init__(self, record_sql=False):
+        self.queries = 0
+        self.timings = {"sql": 0.0, "serialize": 0.0, "render": 0.0}
+        self.statements = []
+        self.record_sql = record_sql
+        self.started = time.perf_counter()
+        self.total = None
+
+    def add(self, phase, milliseconds):
+        self.timings[phase] = self.timings.get(phase, 0.0) + milliseconds
+
+    def finish(self):
+        self.total = (time.perf_counter() - self.started) * 1000
+
+    def server_timing(self):
+        """
+        value of the Server-Timing header
+        """
+        metrics = [f'sql;dur={self.timings["sql"]:.2f};desc="{self.queries} queries"']
+        metrics += [f"{phase};dur={value:.2f}" for phase, value in self.timings.items() if phase != "sql"]
+        metrics.append(f"total;dur={self.total:.2f}")
+        return ", ".join(metrics)
+
+    def as_dict(self):
+        return {"queries": self.queries, **{f"{phase}_ms": round(value, 2) for phase, value in self.timings.items()},
+                "total_ms": round(self.total, 2)}
+
+
+def current():
+    """
+    metrics of the request being measured, None when the request is out of the sample
+    """
+    return _metrics.get()
+
+
+@contextmanager
+def timer(phase):
+    """
+    add the time spent in the block to a phase of the current request
+    """
+    metrics = _metrics.get()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add(phase, (time.perf_counter() - start) * 1000)
+
+
+def record_query(execute, sql, params, many, context):
+    """
+    execute_wrapper counting the queries of the measured requests
+    """
+    metrics = _metrics.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.queries += 1
+        metrics.add("sql", (time.perf_counter() - start) * 1000)
+        if metrics.record_sql:
+            metrics.statements.append(sql)
+
+
+def install_query_recorder(sender, connection, **kwargs):
+    """
+    connection_created hook adding record_query to the connection, the wrappers survive reconnections
+
+    Connected by FilmsConfig.ready
+    """
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class InstrumentationMiddleware:
+    """
+    Measure a sample of the requests, see the module docstring
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            # mark the instance as a coroutine function like MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        metrics, token = self.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            if token is not None:
+                _metrics.reset(token)
+        return self.finish(request, response, metrics)
+
+    async def __acall__(self, request):
+        metrics, token = self.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            if token is not None:
+                _metrics.reset(token)
+        return self.finish(request, response, metrics)
+
+    def start(self):
+        rate = getattr(settings, "FILMS_INSTRUMENTATION_SAMPLE_RATE", 0)
+        if rate <= 0 or (rate < 1 and random.random() >= rate):
+            return None, None
+        metrics = RequestMetrics(record_sql=getattr(settings, "FILMS_INSTRUMENTATION_RECORD_SQL", False))
+        return metrics, _metrics.set(metrics)
+
+    def process_template_response(self, request, response):
+        """
+        time the rendering of template and rest_framework responses, the handler renders them after this hook
+        """
+        metrics = _metrics.get()
+        if metrics is not None:
+            started = time.perf_counter()
+            response.add_post_render_callback(lambda rendered: metrics.add("render", (time.perf_counter() - started) * 1000))
+        return response
+
+    def finish(self, request, response, metrics):
+        if metrics is None:
+            return response
+        metrics.finish()
+        response.instrumentation = metrics
+        if getattr(settings, "FILMS_INSTRUMENTATION_HEADER", True):
+            response["Server-Timing"] = metrics.server_timing()
+        if getattr(settings, "FILMS_INSTRUMENTATION_LOG", False):
+            match = getattr(request, "resolver_match", None)
+            logger.info(json.dumps({
+                "method": request.method,
+                "path": request.path,
+                "view": match.view_name if match else None,
+                "status": response.status_code,
+                **metrics.as_dict(),
+            }))
+        return response
+
+
+class QueryBudgetMixin:
+    """
+    Test case mixin asserting the number of queries of an endpoint
+
+    The request is measured by InstrumentationMiddleware, so the budget counts
+    every query of the request, sessions and authentication included. On
+    failure the message lists the SQL of the queries.
+    """
+
+    def assertQueryBudget(self, budget, path, method="get", **kwargs):
+        """
+        request path with the test client and fail when it runs more than budget queries
+
+        Returns:
+            HttpResponse: Response of the request
+        """
+        from django.test import override_settings
+
+        with override_settings(FILMS_INSTRUMENTATION_SAMPLE_RATE=1, FILMS_INSTRUMENTATION_RECORD_SQL=True):
+            response = getattr(self.client, method)(path, **kwargs)
+        metrics = getattr(response, "instrumentation", None)
+        if metrics is None:
+            self.fail("The request was not measured, is InstrumentationMiddleware in MIDDLEWARE?")
+        if metrics.queries > budget:
+            statements = "\n".join(f"{number}. {sql}" for number, sql in enumerate(metrics.statements, start=1))
+            self.fail(f"{method.upper()} {path} ran {metrics.queries} queries, the budget is {budget}:\n{statements}")
+        return response
@@ -0,0 +1,266 @@
+"""
+Leaderboards of the best films by rating and by visualizations per genre and film type
+
+Every board is stored as LeaderboardEntry rows holding its best
+FILMS_LEADERBOARD_SIZE films, so reading a board walks a few rows of the rank
+index instead of sorting every film of the genre.
+
+Boards are updated incrementally with the films whose rating or
+visualizations changed: a film better than the last row of a full board takes
+its place and a listed film gets its new score. When a listed film drops to
+the last row of a full board a film off the board may now be better, we
+can't know which one without querying, so that board is rebuilt from the
+films table. A board that isn't full should hold every film of its genre or
+type, but films written without the signals may be missing from it, so a
+film that isn't listed on it rebuilds it instead of being appended. Boards
+of a genre or type a film left and boards that lost a deleted film are
+rebuilt as well.
+
+Writes that skip the signals (the catalog import and the synthetic catalogs)
+rebuild every board with rebuild(). Fixtures are saved raw and skip them too,
+run the rebuild_leaderboards command once they are loaded.
+
+Boards are read from the cache under the leaderboards version, which moves
+forward once a change to any board is committed.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Q
+import films.models as film_models
+import films.cache as film_cache
+
+Entry = film_models.LeaderboardEntry
+
+VERSION_KEY = "films:leaderboards-version"
+BOARD_KEY = "films:leaderboard:{}:{}:{}:{}"
+BOARD_TIMEOUT = 60 * 5
+
+METRICS = tuple(metric for metric, _ in Entry.METRICS)
+
+
+def get_size():
+    return getattr(settings, "FILMS_LEADERBOARD_SIZE", 10)
+
+
+def _changed():
+    # the version moves after the commit, so a reader never caches the old board under the new version
+    transaction.on_commit(lambda: film_cache.bump_versions([VERSION_KEY]), using=DEFAULT_DB_ALIAS)
+
+
+def _rank(film_id, score):
+    # boards are sorted by score and then by film id, the same order rebuild_board queries
+    return (-score, film_id)
+
+
+def film_boards(film_ids):
+    """
+    get the boards every film belongs to and its scores, read from the primary
+
+    Args:
+        film_ids (list): Film ids
+
+    Returns:
+        dict: film id -> (set of (scope, scope id), dict metric -> score), deleted films are missing
+    """
+    films = {}
+    rows = film_models.Film.objects.using(DEFAULT_DB_ALIAS).filter(pk__in=film_ids)
+    for pk, film_type_id, *scores in rows.values_list("pk", "film_type_id", *METRICS):
+        boards = {(Entry.FILM_TYPE, film_type_id)} if film_type_id is not None else set()
+        films[pk] = (boards, {metric: float(score) for metric, score in zip(METRICS, scores)})
+
+    through = film_models.Film.genre.through.objects.using(DEFAULT_DB_ALIAS).filter(film_id__in=films.keys())
+    for film_id, genre_id in through.values_list("film_id", "genre_id"):
+        films[film_id][0].add((Entry.GENRE, genre_id))
+    return films
+
+
+def refresh(film_ids, metrics=METRICS):
+    """
+    place films whose scores, genres or film type changed on their boards
+
+    The boards of the films are read with one query and the changes are
+    written with one DELETE, one INSERT and one UPDATE, plus one rebuild per
+    board a film dropped out of and per board that isn't full and doesn't
+    list the film.
+
+    Args:
+        film_ids (list): Film ids
+        metrics (tuple): Metrics that changed, rating, visualizations or both
+    """
+    film_ids = set(film_ids)
+    if not film_ids:
+        return
+
+    size = get_size()
+    films = film_boards(film_ids)
+
+    # the boards of the films and the entries of the films on any board, they may have left a genre or type
+    query = Q(film_id__in=film_ids)
+    for scope in (Entry.GENRE, Entry.FILM_TYPE):
+        scope_ids = {scope_id for boards, _ in films.values() for board_scope, scope_id in boards if board_scope == scope}
+        if scope_ids:
+            query |= Q(scope=scope, scope_id__in=scope_ids)
+
+    stored = {}
+    entries = Entry.objects.using(DEFAULT_DB_ALIAS).filter(query, metric__in=metrics)
+    for pk, scope, scope_id, metric, film_id, score in entries.values_list("pk", "scope", "scope_id", "metric", "film_id", "score"):
+        stored.setdefault((scope, scope_id, metric), {})[film_id] = (pk, score)
+
+    boards = {key: dict(board) for key, board in stored.items()}
+    rebuilt = set()
+    for film_id in film_ids:
+        film_scopes, scores = films.get(film_id, (set(), {}))
+        for key, board in boards.items():
+            if film_id in board and key[:2] not in film_scopes:
+                rebuilt.add(key)
+
+        for metric in metrics:
+            for scope, scope_id in film_scopes:
+                key = (scope, scope_id, metric)
+                board = boards.setdefault(key, {})
+                rank = _rank(film_id, scores[metric])
+                ranks = {listed: _rank(listed, score) for listed, (_, score) in board.items() if listed != film_id}
+                last = max(ranks, key=ranks.get) if ranks else None
+
+                if film_id in board:
+                    if len(board) >= size and last is not None and rank > ranks[last]:
+                        rebuilt.add(key)
+                    board[film_id] = (board[film_id][0], scores[metric])
+                elif len(board) < size:
+                    # other films of the scope may be missing too, the rebuild places them all
+                    rebuilt.add(key)
+                elif rank < ranks[last]:
+                    del board[last]
+                    board[film_id] = (None, scores[metric])
+
+    deleted, created, updated = [], [], []
+    for key, board in boards.items():
+        if key in rebuilt:
+            continue
+        previous = stored.get(key, {})
+        deleted += [pk for film_id, (pk, _) in previous.items() if film_id not in board]
+        for film_id, (pk, score) in board.items():
+            if pk is None:
+                created.append(Entry(scope=key[0], scope_id=key[1], metric=key[2], film_id=film_id, score=score))
+            elif score != previous[film_id][1]:
+                updated.append(Entry(pk=pk, score=score))
+
+    if not (deleted or created or updated or rebuilt):
+        return
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        if deleted:
+            Entry.objects.filter(pk__in=deleted).delete()
+        # a concurrent refresh may have placed the same film, the board then holds one more row until the next change
+        Entry.objects.bulk_create(created, ignore_conflicts=True)
+        Entry.objects.bulk_update(updated, ["score"])
+        rebuild_boards(rebuilt)
+        _changed()
+
+
+def boards_listing(film_ids):
+    """
+    get the boards the films are listed on
+
+    Returns:
+        set: (scope, scope id, metric) of every board
+    """
+    entries = Entry.objects.using(DEFAULT_DB_ALIAS).filter(film_id__in=film_ids)
+    return set(entries.values_list("scope", "scope_id", "metric"))
+
+
+def remove_film(film_id, boards):
+    """
+    remove a deleted film from the boards and rebuild them
+
+    The entries of the film are deleted with it, but its ratings are deleted
+    first and their signals may have placed it on other boards in between.
+
+    Args:
+        film_id (int): Deleted film id
+        boards (set): Boards listing the film before it was deleted, see boards_listing
+    """
+    boards = set(boards) | boards_listing([film_id])
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        Entry.objects.filter(film_id=film_id).delete()
+        rebuild_boards(boards)
+        _changed()
+
+
+def rebuild_board(scope, scope_id, metric):
+    """
+    replace the entries of a board with the best films of its genre or film type
+
+    Returns:
+        int: Number of films on the board
+    """
+    films = film_models.Film.objects.using(DEFAULT_DB_ALIAS)
+    films = films.with_genres([scope_id]) if scope == Entry.GENRE else films.filter(film_type_id=scope_id)
+    best = films.order_by("-" + metric, "pk").values_list("pk", metric)[:get_size()]
+
+    Entry.objects.filter(scope=scope, scope_id=scope_id, metric=metric).delete()
+    return len(Entry.objects.bulk_create(
+        Entry(scope=scope, scope_id=scope_id, metric=metric, film_id=film_id, score=score) for film_id, score in best
+    ))
+
+
+def rebuild_boards(keys):
+    """
+    rebuild several boards, keys are (scope, scope id, metric)
+    """
+    if not keys:
+        return
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        for key in keys:
+            rebuild_board(*key)
+        _changed()
+
+
+def rebuild():
+    """
+    rebuild every board from the films table
+
+    Returns:
+        int: Number of boards
+    """
+    keys = [
+        (scope, scope_id, metric)
+        for scope, model in ((Entry.GENRE, film_models.Genre), (Entry.FILM_TYPE, film_models.FilmType))
+        for scope_id in model.objects.using(DEFAULT_DB_ALIAS).values_list("pk", flat=True)
+        for metric in METRICS
+    ]
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        Entry.objects.all().delete()
+        rebuild_boards(keys)
+    return len(keys)
+
+
+def drop_scope(scope, scope_id):
+    """
+    remove the boards of a deleted genre or film type
+    """
+    Entry.objects.filter(scope=scope, scope_id=scope_id).delete()
+    _changed()
+
+
+def get_board(scope, scope_ids, metric):
+    """
+    get the film ids of a board in rank order, cached until a board changes
+
+    Args:
+        scope (str): genre or film_type
+        scope_ids (list): Ids of the genres or film types with the requested name, their boards are merged
+        metric (str): rating or visualizations
+
+    Returns:
+        list: Film ids, at most FILMS_LEADERBOARD_SIZE
+    """
+    version = film_cache.get_versions([VERSION_KEY])[VERSION_KEY]
+    key = BOARD_KEY.format(scope, ",".join(str(scope_id) for scope_id in scope_ids), metric, version)
+    film_ids = cache.get(key)
+    if film_ids is None:
+        entries = Entry.objects.filter(scope=scope, scope_id__in=scope_ids, metric=metric).order_by("-score", "film_id")
+        film_ids = list(dict.fromkeys(entries.values_list("film_id", flat=True)[:get_size() * len(scope_ids)]))[:get_size()]
+        cache.set(key, film_ids, BOARD_TIMEOUT)
+    return film_ids
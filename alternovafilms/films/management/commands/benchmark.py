@@ -0,0 +1,246 @@
+import json
+import math
+import os
+import time
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.request import Request
+import films.models as film_models
+import films.serializers as film_serializers
+import films.synthetic as film_synthetic
+import films.urls as film_urls
+import films.views as film_views
+import films.activity as film_activity
+import films.counters as film_counters
+from films.utils import StandardResultsSetPagination, FilmCursorPagination
+
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(timings, value):
+    """
+    nearest rank percentile of sorted timings
+    """
+    return timings[max(math.ceil(len(timings) * value / 100) - 1, 0)]
+
+
+class Command(BaseCommand):
+    """
+    Benchmark every films route and the serializers and paginators on a synthetic catalog
+
+    The catalog comes from films.synthetic, so a seed and a size always give
+    the same data. It's generated inside a transaction that is rolled back at
+    the end unless --keep is given, a kept catalog is reused by the next runs.
+    Routes are requested in process with the test client, reads of the
+    replicas are disabled because they can't see the uncommitted catalog.
+
+    Every case records the p50, p95 and p99 latency in milliseconds and the
+    median number of SQL queries. With --baseline the results are compared with
+    a previous run: a case regresses when its p95 grows more than --tolerance
+    (and more than --min-delta ms) or when it runs more queries. --save-baseline
+    stores the results of the run instead.
+
+    Example: python manage.py benchmark --films 100000 --users 2000 --baseline benchmark.json
+    """
+
+    help = "Benchmark the films endpoints, serializers and paginators against a stored baseline"
+    username = "benchmark"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--films", type=int, default=10000)
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--ratings-per-user", type=int, default=20)
+        parser.add_argument("--visualizations-per-user", type=int, default=40)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--iterations", type=int, default=100)
+        parser.add_argument("--only", nargs="+", help="Run only these cases")
+        parser.add_argument("--accept", default="application/json")
+        parser.add_argument("--keep", action="store_true", help="Commit the synthetic catalog")
+        parser.add_argument("--baseline", help="JSON file with the results of a previous run")
+        parser.add_argument("--save-baseline", action="store_true", help="Write the results to --baseline")
+        parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed p95 growth, 0.2 is 20%%")
+        parser.add_argument("--min-delta", type=float, default=0.5, help="p95 growth in ms ignored as noise")
+
+    def handle(self, *args, **options):
+        if options["save_baseline"] and not options["baseline"]:
+            raise CommandError("--save-baseline needs --baseline")
+
+        settings = {"ALLOWED_HOSTS": ["testserver"], "DATABASE_REPLICAS": [], "FILMS_VISUALIZATION_FLUSH_INTERVAL": 0}
+        with override_settings(**settings), transaction.atomic():
+            catalog = film_synthetic.SyntheticCatalog(seed=options["seed"])
+            self.stdout.write(f"Generating {options['films']} films")
+            catalog.grow(options["films"], stdout=self.stdout)
+            self.stdout.write(f"Generating the activity of {options['users']} users")
+            catalog.add_activity(options["users"], options["ratings_per_user"], options["visualizations_per_user"], stdout=self.stdout)
+
+            # staff so the metrics case is served
+            self.user, _ = get_user_model().objects.update_or_create(username=self.username, defaults={"is_staff": True})
+            self.client = Client(HTTP_ACCEPT=options["accept"])
+            self.client.force_login(self.user)
+            self.factory = RequestFactory()
+            self.film_ids = list(film_models.Film.objects.order_by("pk").values_list("pk", flat=True))
+            self.page_ids = self.film_ids[:9]
+
+            cases = self.cases()
+            uncovered = {pattern.name for pattern in film_urls.urlpatterns} - set(cases)
+            if uncovered:
+                self.stderr.write(f"Routes without a benchmark: {', '.join(sorted(uncovered))}")
+            if options["only"]:
+                cases = {name: case for name, case in cases.items() if name in options["only"]}
+
+            results = {}
+            self.stdout.write(f"{'case':<28} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'queries':>8}")
+            for name, case in cases.items():
+                results[name] = self.measure(case, options["iterations"])
+                result = results[name]
+                self.stdout.write(
+                    f"{name:<28} {result['p50']:>8.2f} {result['p95']:>8.2f} {result['p99']:>8.2f} {result['queries']:>8}"
+                )
+
+            film_counters.visualizations.flush()
+            if not options["keep"]:
+                transaction.set_rollback(True)
+
+        cache.clear()
+        film_activity.user_activity.clear()
+        run = {
+            "catalog": {key: options[key] for key in ("films", "users", "ratings_per_user", "visualizations_per_user", "seed")},
+            "results": results,
+        }
+        if options["save_baseline"]:
+            with open(options["baseline"], "w") as stream:
+                json.dump(run, stream, indent=2, sort_keys=True)
+            self.stdout.write(self.style.SUCCESS(f"Baseline saved to {options['baseline']}"))
+        elif options["baseline"]:
+            self.compare(run, options["baseline"], options["tolerance"], options["min_delta"])
+
+    def cases(self):
+        """
+        benchmark cases by name, route cases are named after the url they request
+
+        Returns:
+            dict: name -> callable running one iteration, the write cases use a new film every time
+        """
+        slug = film_models.Film.objects.filter(pk=self.film_ids[0]).values_list("slug", flat=True).get()
+        genre = "Action"
+        # the write cases take films from the end of the catalog, the synthetic users rate the first ones
+        touched = set(film_models.UserFilmRating.objects.filter(user=self.user).values_list("film_id", flat=True))
+        touched.update(film_models.UserFilmVisualization.objects.filter(user=self.user).values_list("film_id", flat=True))
+        unused = (pk for pk in reversed(self.film_ids) if pk not in touched)
+
+        def next_film():
+            film_id = next(unused, None)
+            if film_id is None:
+                raise CommandError("Not enough films for the write cases, use more --films or fewer --iterations")
+            return film_id
+
+        def get(name, query="", **kwargs):
+            path = reverse(name, kwargs=kwargs) + query
+            return lambda: self.client.get(path)
+
+        def post(name, payload):
+            path = reverse(name)
+            return lambda: self.client.post(path, payload(), content_type="application/json")
+
+        cases = {}
+        for prefix in ("", "async_"):
+            cases.update({
+                prefix + "home": get(prefix + "home"),
+                prefix + "films": get(prefix + "films"),
+                prefix + "films_by_rating": get(prefix + "films", "?ordering=-rating&page=5"),
+                prefix + "films_cursor": get(prefix + "films", "?ordering=-rating&pagination=cursor"),
+                prefix + "film_detail": get(prefix + "film_detail", slug=slug),
+                prefix + "random_film": get(prefix + "random_film"),
+                prefix + "random_film_by_genre": get(prefix + "random_film", f"?genre={genre}"),
+                prefix + "search_film": get(prefix + "search_film", "?title=the+night"),
+                prefix + "search_film_by_genre": get(prefix + "search_film", f"?genres={genre}&film_type=movie"),
+            })
+
+        cases.update({
+            "leaderboard": get("leaderboard", f"?genre={genre}"),
+            "leaderboard_by_film_type": get("leaderboard", "?film_type=movie&metric=visualizations"),
+            "metrics": get("metrics"),
+            "film_visualize": post("film_visualize", lambda: {"film": next_film(), "user": self.user.pk}),
+            "film_rate": post("film_rate", lambda: {"film": next_film(), "user": self.user.pk, "rating": 7}),
+            "film_visualize_bulk": post("film_visualize_bulk", lambda: [{"film": next_film()} for _ in range(20)]),
+            "film_rate_bulk": post("film_rate_bulk", lambda: [{"film": next_film(), "rating": 7} for _ in range(20)]),
+            "serializer_read_page": lambda: film_serializers.FilmReadSerializer(
+                film_models.Film.objects.filter(pk__in=self.page_ids).read_model(), many=True,
+            ).data,
+            "serializer_model_page": lambda: film_serializers.FilmGetSerializer(
+                film_models.Film.objects.filter(pk__in=self.page_ids), many=True,
+            ).data,
+            "paginator_first_page": lambda: self.paginate(StandardResultsSetPagination(), "?ordering=-rating"),
+            "paginator_last_page": lambda: self.paginate(
+                StandardResultsSetPagination(), f"?ordering=-rating&page={math.ceil(len(self.film_ids) / 9)}",
+            ),
+            "paginator_cursor": lambda: self.paginate(FilmCursorPagination(), "?ordering=-rating&pagination=cursor"),
+        })
+        return cases
+
+    def paginate(self, paginator, query):
+        request = self.factory.get("/films/" + query)
+        films = film_views.FilmListView(request=request, kwargs={}).get_queryset()
+        return paginator.paginate_queryset(films, Request(request))
+
+    def measure(self, case, iterations):
+        """
+        run a case iterations times after clearing the caches, the first run is cold
+
+        Returns:
+            dict: p50, p95 and p99 latency in milliseconds and the median number of queries
+        """
+        cache.clear()
+        film_activity.user_activity.clear()
+        timings, queries = [], []
+        for _ in range(iterations):
+            with CaptureQueriesContext(connection) as context:
+                start = time.perf_counter()
+                response = case()
+                timings.append((time.perf_counter() - start) * 1000)
+            if getattr(response, "status_code", 200) >= 400:
+                raise CommandError(f"{response.status_code} response: {response.content[:200]!r}")
+            queries.append(len(context.captured_queries))
+
+        timings.sort()
+        queries.sort()
+        result = {f"p{value}": round(percentile(timings, value), 3) for value in PERCENTILES}
+        result["queries"] = queries[len(queries) // 2]
+        return result
+
+    def compare(self, run, path, tolerance, min_delta):
+        """
+        compare the run with the baseline and fail when a case regressed
+        """
+        if not os.path.exists(path):
+            raise CommandError(f"No baseline at {path}, create it with --save-baseline")
+        with open(path) as stream:
+            baseline = json.load(stream)
+        if baseline["catalog"] != run["catalog"]:
+            self.stderr.write(f"The baseline catalog {baseline['catalog']} differs from this run, results may not compare")
+
+        regressions = []
+        self.stdout.write(f"\n{'case':<28} {'base p95':>9} {'p95':>9} {'change':>8} {'queries':>9}")
+        for name, result in run["results"].items():
+            previous = baseline["results"].get(name)
+            if previous is None:
+                continue
+            change = (result["p95"] - previous["p95"]) / previous["p95"] if previous["p95"] else 0
+            slower = change > tolerance and result["p95"] - previous["p95"] > min_delta
+            more_queries = result["queries"] > previous["queries"]
+            flag = "  REGRESSION" if slower or more_queries else ""
+            if flag:
+                regressions.append(name)
+            self.stdout.write(
+                f"{name:<28} {previous['p95']:>9.2f} {result['p95']:>9.2f} {change:>+8.0%} "
+                f"{previous['queries']:>4}->{result['queries']:<4}{flag}"
+            )
+
+        if regressions:
+            raise CommandError(f"{len(regressions)} cases regressed: {', '.join(regressions)}")
+        self.stdout.write(self.style.SUCCESS("No regressions against the baseline"))
@@ -0,0 +1,131 @@
+import asyncio
+import io
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand, CommandError
+from django.core.wsgi import get_wsgi_application
+import films.models as film_models
+
+
+class Command(BaseCommand):
+    """
+    Compare the throughput of the read endpoints under WSGI and ASGI
+
+    Requests are sent straight to the WSGI and ASGI handlers of the project, so
+    the numbers measure Django and the views without any server or network in
+    front of them. WSGI requests run on a pool of threads, as a threaded WSGI
+    server would, and ASGI requests run as concurrent tasks on one event loop.
+    Every path is measured on WSGI, on ASGI and on ASGI with the async/ version
+    of the endpoint.
+
+    A benchmark user and session are created for the run and removed at the end.
+
+    Example: python manage.py benchmark_asgi --concurrency 64 --requests 2000
+    """
+
+    help = "Benchmark the read endpoints on WSGI, ASGI and the async ASGI views"
+    username = "benchmark-asgi"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--paths", nargs="+", default=["/films/", "/films/random/", "/films/search/?title=the"])
+        parser.add_argument("--concurrency", type=int, default=64)
+        parser.add_argument("--requests", type=int, default=2000)
+        parser.add_argument("--accept", default="application/json")
+
+    def handle(self, *args, **options):
+        if not film_models.Film.objects.exists():
+            raise CommandError("There are no films, import a catalog first")
+
+        User = get_user_model()
+        user, created = User.objects.get_or_create(username=self.username)
+        session = SessionStore()
+        session[SESSION_KEY] = str(user.pk)
+        session[BACKEND_SESSION_KEY] = "django.contrib.auth.backends.ModelBackend"
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.create()
+        self.cookie = f"{settings.SESSION_COOKIE_NAME}={session.session_key}"
+        self.accept = options["accept"]
+
+        try:
+            wsgi = get_wsgi_application()
+            asgi = get_asgi_application()
+            concurrency, total = options["concurrency"], options["requests"]
+
+            self.stdout.write(f"{'path':<32} {'mode':<11} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'errors':>7}")
+            for path in options["paths"]:
+                runs = [
+                    ("wsgi", lambda: self.run_wsgi(wsgi, path, concurrency, total)),
+                    ("asgi", lambda: asyncio.run(self.run_asgi(asgi, path, concurrency, total))),
+                    ("asgi async", lambda: asyncio.run(self.run_asgi(asgi, "/async" + path, concurrency, total))),
+                ]
+                for mode, run in runs:
+                    started = time.perf_counter()
+                    timings, errors = run()
+                    elapsed = time.perf_counter() - started
+                    timings.sort()
+                    self.stdout.write(
+                        f"{path:<32} {mode:<11} {total / elapsed:>9.1f} {statistics.median(timings):>8.2f} "
+                        f"{timings[int(len(timings) * 0.95) - 1]:>8.2f} {errors:>7}"
+                    )
+        finally:
+            session.delete()
+            if created:
+                user.delete()
+
+    def split(self, path):
+        path, _, query = path.partition("?")
+        return path, query
+
+    def run_wsgi(self, application, path, concurrency, total):
+        path, query = self.split(path)
+
+        def request():
+            environ = {
+                "REQUEST_METHOD": "GET", "PATH_INFO": path, "QUERY_STRING": query, "SCRIPT_NAME": "",
+                "SERVER_NAME": "localhost", "SERVER_PORT": "80", "SERVER_PROTOCOL": "HTTP/1.1",
+                "HTTP_HOST": "localhost", "HTTP_COOKIE": self.cookie, "HTTP_ACCEPT": self.accept,
+                "wsgi.input": io.BytesIO(), "wsgi.errors": io.StringIO(), "wsgi.url_scheme": "http",
+                "wsgi.multithread": True, "wsgi.multiprocess": False, "wsgi.run_once": False, "wsgi.version": (1, 0),
+            }
+            statuses = []
+            start = time.perf_counter()
+            body = application(environ, lambda status, headers, exc_info=None: statuses.append(status))
+            b"".join(body)
+            body.close()
+            return (time.perf_counter() - start) * 1000, not statuses[0].startswith("200")
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(lambda _: request(), range(total)))
+        return [timing for timing, _ in results], sum(error for _, error in results)
+
+    async def run_asgi(self, application, path, concurrency, total):
+        path, query = self.split(path)
+        semaphore = asyncio.Semaphore(concurrency)
+        headers = [(b"host", b"localhost"), (b"cookie", self.cookie.encode()), (b"accept", self.accept.encode())]
+
+        async def request():
+            scope = {
+                "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+                "path": path, "raw_path": path.encode(), "query_string": query.encode(), "root_path": "",
+                "headers": headers, "client": ("127.0.0.1", 0), "server": ("localhost", 80),
+            }
+            messages = []
+
+            async def receive():
+                return {"type": "http.request", "body": b"", "more_body": False}
+
+            async def send(message):
+                messages.append(message)
+
+            async with semaphore:
+                start = time.perf_counter()
+                await application(scope, receive, send)
+                return (time.perf_counter() - start) * 1000, messages[0]["status"] != 200
+
+        results = await asyncio.gather(*[request() for _ in range(total)])
+        return [timing for timing, _ in results], sum(error for _, error in results)
@@ -0,0 +1,76 @@
+import statistics
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+import films.models as film_models
+import films.synthetic as film_synthetic
+
+
+class Command(BaseCommand):
+    """
+    Benchmark the random film selection against growing catalogs
+
+    The catalog is grown with the films of films.synthetic inside a transaction
+    that is rolled back at the end, so the database is left untouched. The
+    probe columns time the fallback random() takes when every drawn id misses,
+    like with a rare genre.
+
+    Example: python manage.py benchmark_random --sizes 10000 100000 1000000 5000000
+    """
+
+    help = "Benchmark Film.objects.random() latency for several catalog sizes"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", nargs="+", type=int, default=[10000, 100000, 1000000, 5000000])
+        parser.add_argument("--iterations", type=int, default=200)
+        parser.add_argument("--genre", default="Action", help="Genre of the filtered lookups")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--compare", action="store_true", help="Also time order_by('?') for comparison")
+
+    def handle(self, *args, **options):
+        catalog = film_synthetic.SyntheticCatalog(seed=options["seed"])
+        genre = options["genre"]
+        with transaction.atomic():
+            self.stdout.write(
+                f"{'films':>10} {'p50 ms':>8} {'p95 ms':>8} {'genre p50':>10} {'genre p95':>10} "
+                f"{'probe p50':>10} {'probe p95':>10} {'order_by(?)':>12}"
+            )
+            for size in sorted(options["sizes"]):
+                total = catalog.grow(size)
+                plain = self.measure(lambda: film_models.Film.objects.random(), options["iterations"])
+                filtered = self.measure(lambda: film_models.Film.objects.random(genre=genre), options["iterations"])
+                probe = self.measure(lambda: self.probe(genre), options["iterations"])
+                shuffled = ""
+                if options["compare"]:
+                    shuffled = "%.3f" % self.measure(lambda: film_models.Film.objects.order_by("?").first(), 5)[0]
+
+                self.stdout.write(
+                    f"{total:>10} {plain[0]:>8.3f} {plain[1]:>8.3f} {filtered[0]:>10.3f} {filtered[1]:>10.3f} "
+                    f"{probe[0]:>10.3f} {probe[1]:>10.3f} {shuffled:>12}"
+                )
+
+            transaction.set_rollback(True)
+
+    def probe(self, genre):
+        """
+        random film of the genre read with the fallback probe, as if every drawn id missed
+        """
+        pivots = film_models.FilmQuerySet.RANDOM_PIVOTS
+        film_models.FilmQuerySet.RANDOM_PIVOTS = 0
+        try:
+            return film_models.Film.objects.random(genre=genre)
+        finally:
+            film_models.FilmQuerySet.RANDOM_PIVOTS = pivots
+
+    def measure(self, query, iterations):
+        """
+        run query iterations times and return the p50 and p95 latency in milliseconds
+        """
+        timings = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            query()
+            timings.append((time.perf_counter() - start) * 1000)
+
+        timings.sort()
+        return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
@@ -0,0 +1,265 @@
+import csv
+import json
+import os
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+import films.models as film_models
+import films.cache as film_cache
+import films.search as film_search
+import films.leaderboards as film_leaderboards
+
+FILM = "films.film"
+RATING = "films.userfilmrating"
+VISUALIZATION = "films.userfilmvisualization"
+
+# models in the order their chunks are written, ratings and visualizations reference films
+MODELS = (FILM, RATING, VISUALIZATION)
+
+
+def iter_json_array(stream, read_size=1 << 16):
+    """
+    yield the objects of a JSON array one by one without loading the whole file
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    separators = "["
+    eof = False
+
+    while True:
+        while position < len(buffer) and (buffer[position].isspace() or buffer[position] in separators):
+            if buffer[position] == "[":
+                separators = ","
+            position += 1
+
+        if position < len(buffer):
+            if separators == "[":
+                raise CommandError("Expected a JSON array")
+            if buffer[position] == "]":
+                return
+            try:
+                record, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise CommandError("Invalid JSON at the end of the file")
+            else:
+                yield record
+                continue
+        elif eof:
+            raise CommandError("Unexpected end of the JSON array")
+
+        data = stream.read(read_size)
+        eof = not data
+        buffer = buffer[position:] + data
+        position = 0
+
+
+def iter_ndjson(stream):
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+
+def iter_csv(stream):
+    """
+    yield the CSV rows, genres are film ids separated by |
+    """
+    for row in csv.DictReader(stream):
+        row = {key: value for key, value in row.items() if value not in ("", None)}
+        if "genre" in row:
+            row["genre"] = [int(genre) for genre in row["genre"].split("|") if genre]
+        yield row
+
+
+READERS = {
+    "json": iter_json_array,
+    "ndjson": iter_ndjson,
+    "csv": iter_csv,
+}
+
+
+def normalize(record, default_model):
+    """
+    turn a fixture object ({"model", "pk", "fields"}) or a flat record into (model, pk, fields)
+    """
+    if "fields" in record:
+        return record.get("model", default_model).lower(), record.get("pk"), record["fields"]
+    fields = dict(record)
+    pk = fields.pop("pk", fields.pop("id", None))
+    return fields.pop("model", default_model).lower(), pk, fields
+
+
+class Command(BaseCommand):
+    """
+    Import films, ratings and visualizations from a JSON, NDJSON or CSV file
+
+    The file is streamed and written in chunks with bulk_create, so memory stays
+    constant whatever the size of the catalog. The per row signals are skipped:
+    slugs, genre masks and the search index are built for every chunk, and the
+    rating and visualization aggregates and the leaderboards are recomputed
+    set-wise at the end.
+
+    Every chunk is committed with its own transaction and the number of records
+    written is stored on a checkpoint file, --resume skips them after a failure.
+    Records with a pk that already exist are ignored, so a chunk written again
+    after a crash between the commit and the checkpoint doesn't duplicate rows.
+
+    Accepts the fixtures format (films/fixtures/films.json, ratings.json) and
+    flat records, where the model comes from --model:
+    films: id, title, film_type, genre (list, "|" separated in CSV), visualizations
+    ratings: id, user, film, rating
+    visualizations: id, user, film
+
+    Example: python manage.py import_catalog catalog.ndjson --chunk-size 5000
+    """
+
+    help = "Stream a films catalog into the database with bulk inserts"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument("--format", choices=READERS.keys(), help="Defaults to the file extension")
+        parser.add_argument("--model", choices=MODELS, default=FILM, help="Model of the records without one")
+        parser.add_argument("--chunk-size", type=int, default=2000)
+        parser.add_argument("--checkpoint", help="Defaults to <path>.checkpoint")
+        parser.add_argument("--resume", action="store_true", help="Skip the records written by a previous run")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        fmt = options["format"] or os.path.splitext(path)[1].lstrip(".").lower()
+        if fmt not in READERS:
+            raise CommandError(f"Unknown format {fmt}, use --format")
+
+        self.checkpoint_path = options["checkpoint"] or f"{path}.checkpoint"
+        checkpoint = self.read_checkpoint() if options["resume"] else None
+        if checkpoint is None:
+            checkpoint = {"records": 0, "visualization_pk": self.last_pk(film_models.UserFilmVisualization)}
+        skip = checkpoint["records"]
+
+        self.search = film_search.get_backend()
+        self.genre_ids = set(film_models.Genre.objects.values_list("pk", flat=True))
+        chunk_size = options["chunk_size"]
+        buffers = {model: [] for model in MODELS}
+        buffered = 0
+        written = 0
+        number = skip
+        started = time.monotonic()
+
+        with open(path, newline="" if fmt == "csv" else None, encoding="utf-8") as stream:
+            for number, record in enumerate(READERS[fmt](stream), start=1):
+                if number <= skip:
+                    continue
+                model, pk, fields = normalize(record, options["model"])
+                if model not in buffers:
+                    raise CommandError(f"Record {number}: can't import {model}")
+                buffers[model].append((pk, fields))
+                buffered += 1
+
+                if buffered >= chunk_size:
+                    written += self.write(buffers)
+                    checkpoint["records"] = number
+                    self.save_checkpoint(checkpoint)
+                    buffered = 0
+                    self.report(written, started)
+
+            if buffered:
+                written += self.write(buffers)
+                checkpoint["records"] = number
+                self.save_checkpoint(checkpoint)
+
+        self.stdout.write("Recomputing the film aggregates and leaderboards")
+        with transaction.atomic():
+            film_models.Film.objects.recompute_ratings()
+            film_models.Film.objects.count_visualizations(
+                film_models.UserFilmVisualization.objects.filter(pk__gt=checkpoint["visualization_pk"])
+            )
+            film_leaderboards.rebuild()
+        film_cache.bump_catalog_version()
+        film_cache.bump_film_stats([])
+        film_cache.invalidate_home_snapshot()
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+        self.report(written, started)
+        self.stdout.write(self.style.SUCCESS(f"Imported {written} records"))
+
+    def write(self, buffers):
+        """
+        write the buffered records in one transaction and empty the buffers
+
+        Returns:
+            int: Number of records written
+        """
+        written = 0
+        with transaction.atomic():
+            for model in MODELS:
+                rows = buffers[model]
+                if rows:
+                    getattr(self, "write_" + model.split(".")[1])(rows)
+                    written += len(rows)
+                    buffers[model] = []
+        return written
+
+    def write_film(self, rows):
+        Through = film_models.Film.genre.through
+        films = []
+        genres = []
+        for pk, fields in rows:
+            genre_ids = [int(genre) for genre in fields.get("genre", []) if int(genre) in self.genre_ids]
+            mask = 0
+            for genre_id in genre_ids:
+                mask |= film_models.genre_mask([genre_id]) or 0
+            films.append(film_models.Film(
+                pk=pk,
+                title=fields["title"],
+                film_type_id=fields.get("film_type"),
+                visualizations=int(fields.get("visualizations", 0)),
+                genre_mask=mask,
+                slug=fields.get("slug"),
+            ))
+            genres.append(genre_ids)
+        film_models.assign_slugs(films)
+
+        with_pk = all(film.pk is not None for film in films)
+        films = film_models.Film.objects.bulk_create(films, ignore_conflicts=with_pk)
+
+        Through.objects.bulk_create(
+            [Through(film_id=film.pk, genre_id=genre_id) for film, genre_ids in zip(films, genres) for genre_id in genre_ids],
+            ignore_conflicts=True,
+        )
+        self.search.index([film for film in films if film.pk is not None])
+
+    def write_userfilmrating(self, rows):
+        film_models.UserFilmRating.objects.bulk_create(
+            [
+                film_models.UserFilmRating(pk=pk, user_id=fields["user"], film_id=fields["film"], rating=float(fields["rating"]))
+                for pk, fields in rows
+            ],
+            ignore_conflicts=True,
+        )
+
+    def write_userfilmvisualization(self, rows):
+        film_models.UserFilmVisualization.objects.bulk_create(
+            [film_models.UserFilmVisualization(pk=pk, user_id=fields["user"], film_id=fields["film"]) for pk, fields in rows],
+            ignore_conflicts=True,
+        )
+
+    def last_pk(self, model):
+        return model.objects.order_by("-pk").values_list("pk", flat=True).first() or 0
+
+    def read_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return None
+        with open(self.checkpoint_path) as checkpoint:
+            return json.load(checkpoint)
+
+    def save_checkpoint(self, checkpoint):
+        temporary = self.checkpoint_path + ".tmp"
+        with open(temporary, "w") as stream:
+            json.dump(checkpoint, stream)
+        os.replace(temporary, self.checkpoint_path)
+
+    def report(self, written, started):
+        elapsed = time.monotonic() - started
+        rate = written / elapsed if elapsed else 0
+        self.stdout.write(f"{written} records in {elapsed:.1f}s ({rate:.0f} rows/sec)")
@@ -0,0 +1,461 @@
+import asyncio
+import io
+import itertools
+import json
+import logging
+import multiprocessing
+import random
+import threading
+import time
+from collections import defaultdict
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand, CommandError
+from django.core.signals import request_finished, request_started
+from django.core.wsgi import get_wsgi_application
+from django.db import connection, connections
+from django.db.models import Count, Sum
+from django.test import override_settings
+from django.urls import reverse
+import films.models as film_models
+import films.counters as film_counters
+import films.synthetic as film_synthetic
+
+KINDS = ("read", "rate", "visualize")
+
+# unmasked CSRF secret sent as cookie and header, the views use session authentication
+CSRF_TOKEN = "loadtestloadtestloadtestloadtest"
+
+WRITE_STATEMENTS = ("INSERT", "UPDATE", "DELETE")
+
+USERNAME = "loadtest-{}"
+
+
+class Workload:
+    """
+    Requests sent by the load test workers
+
+    Films are drawn with a Zipf distribution over the hot films, the film of
+    rank k is chosen with a probability proportional to 1 / k ** zipf. Writes
+    are sent by a random user of the load test, a user rating or visualizing a
+    film twice gets a 400 that is counted as rejected.
+
+    attributes:
+        films (list): (id, slug) of the hot films, hottest first
+        users (list): (user id, cookie header) of the load test users
+        write_ratio (float): Share of the requests that are writes
+        rate_ratio (float): Share of the writes that are ratings
+    """
+
+    def __init__(self, films, users, zipf, write_ratio, rate_ratio):
+        self.films = films
+        self.users = users
+        self.cum_weights = list(itertools.accumulate(1 / rank ** zipf for rank in range(1, len(films) + 1)))
+        self.write_ratio = write_ratio
+        self.rate_ratio = rate_ratio
+        self.read_path = reverse("film_detail", kwargs={"slug": "slug"}).replace("slug", "{}")
+        self.rate_path = reverse("film_rate")
+        self.visualize_path = reverse("film_visualize")
+
+    def next_request(self, rng):
+        """
+        Returns:
+            tuple: kind, method, path, body and cookie header of the next request
+        """
+        film_id, slug = rng.choices(self.films, cum_weights=self.cum_weights)[0]
+        user_id, cookie = rng.choice(self.users)
+        if rng.random() >= self.write_ratio:
+            return "read", "GET", self.read_path.format(slug), b"", cookie
+        if rng.random() < self.rate_ratio:
+            body = {"film": film_id, "user": user_id, "rating": rng.randint(0, 10)}
+            return "rate", "POST", self.rate_path, json.dumps(body).encode(), cookie
+        body = {"film": film_id, "user": user_id}
+        return "visualize", "POST", self.visualize_path, json.dumps(body).encode(), cookie
+
+
+class LockRecorder(logging.Handler):
+    """
+    Count the "database is locked" errors and the writes that waited for a lock
+
+    Errors are read from the records logged by django.request and the films
+    loggers. As an execute_wrapper of the connections serving requests, it
+    counts the writes slower than threshold milliseconds as lock waits: they
+    are waiting for another writer to commit on SQLite, or for a row lock on
+    Postgres.
+    """
+
+    def __init__(self, threshold):
+        super().__init__(level=logging.ERROR)
+        self.threshold = threshold
+        self.counts = {"locked": 0, "lock_waits": 0, "lock_wait_ms": 0.0}
+        self._lock_counts = threading.Lock()
+
+    def add(self, key, value=1):
+        with self._lock_counts:
+            self.counts[key] += value
+
+    def emit(self, record):
+        if record.exc_info and "locked" in str(record.exc_info[1]):
+            self.add("locked")
+
+    def __call__(self, execute, sql, params, many, context):
+        if not sql.lstrip().upper().startswith(WRITE_STATEMENTS):
+            return execute(sql, params, many, context)
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            if elapsed >= self.threshold:
+                self.add("lock_waits")
+                self.add("lock_wait_ms", elapsed)
+
+
+def wsgi_environ(method, path, body, cookie):
+    return {
+        "REQUEST_METHOD": method, "PATH_INFO": path, "QUERY_STRING": "", "SCRIPT_NAME": "",
+        "SERVER_NAME": "localhost", "SERVER_PORT": "80", "SERVER_PROTOCOL": "HTTP/1.1",
+        "HTTP_HOST": "localhost", "HTTP_COOKIE": cookie, "HTTP_ACCEPT": "application/json",
+        "HTTP_X_CSRFTOKEN": CSRF_TOKEN, "CONTENT_TYPE": "application/json", "CONTENT_LENGTH": str(len(body)),
+        "wsgi.input": io.BytesIO(body), "wsgi.errors": io.StringIO(), "wsgi.url_scheme": "http",
+        "wsgi.multithread": True, "wsgi.multiprocess": True, "wsgi.run_once": False, "wsgi.version": (1, 0),
+    }
+
+
+def run_wsgi(application, workload, threads, requests, seed):
+    """
+    send requests from threads threads to the WSGI application
+
+    Returns:
+        list: (kind, status, milliseconds) of every request
+    """
+
+    def work(number, count):
+        rng = random.Random(f"{seed}:{number}")
+        results = []
+        for _ in range(count):
+            kind, method, path, body, cookie = workload.next_request(rng)
+            statuses = []
+            start = time.perf_counter()
+            response = application(wsgi_environ(method, path, body, cookie), lambda status, headers, exc_info=None: statuses.append(status))
+            b"".join(response)
+            response.close()
+            results.append((kind, int(statuses[0].split()[0]), (time.perf_counter() - start) * 1000))
+        connection.close()
+        return results
+
+    counts = split(requests, threads)
+    results = [None] * threads
+    workers = [
+        threading.Thread(target=lambda number=number: results.__setitem__(number, work(number, counts[number])))
+        for number in range(threads)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return [result for thread_results in results for result in thread_results]
+
+
+def run_asgi(application, workload, concurrency, requests, seed):
+    """
+    send requests from concurrency tasks to the ASGI application
+
+    Sync views run on the thread of the ASGI handler, so the writes of one
+    process are serialized like on a single ASGI worker.
+
+    Returns:
+        list: (kind, status, milliseconds) of every request
+    """
+    rng = random.Random(seed)
+
+    async def request():
+        kind, method, path, body, cookie = workload.next_request(rng)
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": method, "scheme": "http",
+            "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "",
+            "headers": [
+                (b"host", b"localhost"), (b"cookie", cookie.encode()), (b"accept", b"application/json"),
+                (b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()),
+                (b"x-csrftoken", CSRF_TOKEN.encode()),
+            ],
+            "client": ("127.0.0.1", 0), "server": ("localhost", 80),
+        }
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        start = time.perf_counter()
+        await application(scope, receive, send)
+        return kind, messages[0]["status"], (time.perf_counter() - start) * 1000
+
+    async def work(count):
+        results = []
+        for _ in range(count):
+            results.append(await request())
+        return results
+
+    async def main():
+        counts = split(requests, concurrency)
+        return await asyncio.gather(*[work(count) for count in counts])
+
+    results = asyncio.run(main())
+    return [result for task_results in results for result in task_results]
+
+
+def split(total, parts):
+    return [total // parts + (1 if number < total % parts else 0) for number in range(parts)]
+
+
+def run_worker(mode, workload, concurrency, requests, seed, threshold, queue=None):
+    """
+    run the requests of a worker process and flush its buffered visualizations
+
+    Returns:
+        dict: results and lock counts, also put on queue when given
+    """
+    connections.close_all()
+    # building the application configures the logging, the recorder is added after it
+    application = get_wsgi_application() if mode == "wsgi" else get_asgi_application()
+    runner = run_wsgi if mode == "wsgi" else run_asgi
+    recorder = LockRecorder(threshold)
+    loggers = [logging.getLogger("django.request"), logging.getLogger("films")]
+    levels = [logger.level for logger in loggers]
+    for logger in loggers:
+        # rejected writes log a warning each, keep the errors only
+        logger.setLevel(logging.ERROR)
+        logger.addHandler(recorder)
+
+    # requests run on threads of the handlers, the wrapper is added to the connection of each request
+    def install(sender, **kwargs):
+        if recorder not in connection.execute_wrappers:
+            connection.execute_wrappers.append(recorder)
+
+    def uninstall(sender, **kwargs):
+        if recorder in connection.execute_wrappers:
+            connection.execute_wrappers.remove(recorder)
+
+    request_started.connect(install, dispatch_uid="films.loadtest.install")
+    request_finished.connect(uninstall, dispatch_uid="films.loadtest.uninstall")
+    try:
+        results = runner(application, workload, concurrency, requests, seed)
+        film_counters.visualizations.flush()
+    finally:
+        request_started.disconnect(dispatch_uid="films.loadtest.install")
+        request_finished.disconnect(dispatch_uid="films.loadtest.uninstall")
+        for logger, level in zip(loggers, levels):
+            logger.removeHandler(recorder)
+            logger.setLevel(level)
+        connections.close_all()
+
+    output = {"results": results, "counts": recorder.counts}
+    if queue is not None:
+        queue.put(output)
+    return output
+
+
+class Command(BaseCommand):
+    """
+    Load test the rate and visualize endpoints with bursts on popular films
+
+    Requests go straight to the WSGI or ASGI handler of the project from
+    --processes forked processes with --concurrency threads (WSGI) or tasks
+    (ASGI) each. --write-ratio of the requests are ratings and visualizations
+    and the rest read the film detail. Films are drawn from the --hot-films
+    first films of a shuffled catalog with a Zipf distribution of exponent
+    --zipf, so most writes hit the same few films.
+
+    The report has the throughput, the status of every kind of request, the
+    "database is locked" errors and the writes that waited longer than
+    --lock-threshold ms. Then the counters of the hot films are checked
+    against the stored rows: visualizations must have grown by the number of
+    visualizations created and rating, rating_sum and rating_count must match
+    the ratings of the film. A mismatch is a lost update and fails the command.
+
+    The requests write to the configured database, run it against a scratch
+    database (DATABASE_NAME=/tmp/loadtest.sqlite3). The catalog is grown with
+    films.synthetic up to --films and the load test users and sessions are
+    created for the run. The ratings and visualizations of a previous run are
+    deleted first, so runs with the same --seed send the same requests.
+
+    Example: python manage.py loadtest --processes 4 --concurrency 8 --requests 20000 --write-ratio 0.8
+    """
+
+    help = "Load test the rate and visualize endpoints and check the film counters"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--mode", choices=["wsgi", "asgi"], default="wsgi")
+        parser.add_argument("--processes", type=int, default=1)
+        parser.add_argument("--concurrency", type=int, default=8, help="Threads (wsgi) or tasks (asgi) per process")
+        parser.add_argument("--requests", type=int, default=2000)
+        parser.add_argument("--write-ratio", type=float, default=0.5)
+        parser.add_argument("--rate-ratio", type=float, default=0.5, help="Share of the writes that are ratings")
+        parser.add_argument("--zipf", type=float, default=1.1)
+        parser.add_argument("--hot-films", type=int, default=100)
+        parser.add_argument("--films", type=int, default=1000, help="Grow the catalog to this many films")
+        parser.add_argument("--users", type=int, default=500)
+        parser.add_argument("--lock-threshold", type=float, default=20.0)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        catalog = film_synthetic.SyntheticCatalog(seed=options["seed"])
+        catalog.grow(options["films"])
+        film_ids = list(film_models.Film.objects.order_by("pk").values_list("pk", "slug"))
+        random.Random(options["seed"]).shuffle(film_ids)
+        hot_films = film_ids[:options["hot_films"]]
+        hot_ids = [pk for pk, _ in hot_films]
+        if not hot_films:
+            raise CommandError("There are no films")
+
+        user_ids = catalog.ensure_users(options["users"], username=USERNAME)
+        self.reset(user_ids)
+        users = self.create_sessions(user_ids)
+        before = self.counters(hot_ids)
+        workload = Workload(hot_films, users, options["zipf"], options["write_ratio"], options["rate_ratio"])
+
+        processes, concurrency = options["processes"], options["concurrency"]
+        counts = split(options["requests"], processes)
+        worker = (options["mode"], workload, concurrency)
+        started = time.perf_counter()
+        try:
+            # the requests are sent to localhost, whatever the DEBUG setting
+            with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, "localhost"]):
+                if processes == 1:
+                    outputs = [run_worker(*worker, counts[0], options["seed"], options["lock_threshold"])]
+                else:
+                    outputs = self.run_processes(worker, counts, options)
+            elapsed = time.perf_counter() - started
+        finally:
+            Session.objects.filter(session_key__in=self.session_keys).delete()
+
+        self.report(outputs, elapsed, options)
+        mismatches = self.check_counters(hot_ids, before)
+        if mismatches:
+            raise CommandError(f"{mismatches} film counters don't match their rows")
+
+    def reset(self, user_ids):
+        """
+        delete the activity of a previous run, the signals take it out of the film counters
+        """
+        for model in (film_models.UserFilmRating, film_models.UserFilmVisualization):
+            model.objects.filter(user_id__in=list(user_ids)).delete()
+        film_counters.visualizations.flush()
+
+    def create_sessions(self, user_ids):
+        """
+        log in every load test user
+
+        Returns:
+            list: (user id, cookie header) of every user
+        """
+        users = []
+        self.session_keys = []
+        for user in get_user_model().objects.filter(pk__in=list(user_ids)):
+            session = SessionStore()
+            session[SESSION_KEY] = str(user.pk)
+            session[BACKEND_SESSION_KEY] = "django.contrib.auth.backends.ModelBackend"
+            session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+            session.create()
+            self.session_keys.append(session.session_key)
+            cookie = f"{settings.SESSION_COOKIE_NAME}={session.session_key}; {settings.CSRF_COOKIE_NAME}={CSRF_TOKEN}"
+            users.append((user.pk, cookie))
+        return users
+
+    def run_processes(self, worker, counts, options):
+        context = multiprocessing.get_context("fork")
+        queue = context.Queue()
+        connections.close_all()
+        processes = [
+            context.Process(target=run_worker, args=(*worker, count, f"{options['seed']}:{number}", options["lock_threshold"], queue))
+            for number, count in enumerate(counts)
+        ]
+        for process in processes:
+            process.start()
+        # read before joining, a child blocks on exit until its output is consumed
+        outputs = [queue.get() for _ in processes]
+        for process in processes:
+            process.join()
+        return outputs
+
+    def counters(self, film_ids):
+        """
+        visualizations counter and visualization rows of the films
+
+        Returns:
+            dict: film id -> (visualizations, visualization rows)
+        """
+        rows = dict(
+            film_models.UserFilmVisualization.objects.filter(film_id__in=film_ids)
+            .values("film").annotate(count=Count("pk")).values_list("film", "count")
+        )
+        counters = film_models.Film.objects.filter(pk__in=film_ids).values_list("pk", "visualizations")
+        return {pk: (visualizations, rows.get(pk, 0)) for pk, visualizations in counters}
+
+    def report(self, outputs, elapsed, options):
+        results = [result for output in outputs for result in output["results"]]
+        locks = defaultdict(float)
+        for output in outputs:
+            for key, value in output["counts"].items():
+                locks[key] += value
+
+        self.stdout.write(
+            f"{options['mode']}: {options['processes']} processes x {options['concurrency']}, "
+            f"{len(results)} requests in {elapsed:.1f}s, {len(results) / elapsed:.1f} req/s"
+        )
+        self.stdout.write(f"{'kind':<10} {'requests':>9} {'ok':>7} {'rejected':>9} {'errors':>7} {'p50 ms':>8} {'p95 ms':>8}")
+        for kind in KINDS:
+            statuses = [status for result_kind, status, _ in results if result_kind == kind]
+            if not statuses:
+                continue
+            timings = sorted(ms for result_kind, _, ms in results if result_kind == kind)
+            ok = sum(1 for status in statuses if status < 400)
+            errors = sum(1 for status in statuses if status >= 500)
+            self.stdout.write(
+                f"{kind:<10} {len(statuses):>9} {ok:>7} {len(statuses) - ok - errors:>9} {errors:>7} "
+                f"{timings[len(timings) // 2]:>8.2f} {timings[max(int(len(timings) * 0.95) - 1, 0)]:>8.2f}"
+            )
+        self.stdout.write(
+            f"database is locked errors: {int(locks['locked'])}, "
+            f"writes waiting over {options['lock_threshold']:g} ms: {int(locks['lock_waits'])} ({locks['lock_wait_ms'] / 1000:.2f}s)"
+        )
+
+    def check_counters(self, film_ids, before):
+        """
+        compare the counters of the films with the rows written, report the mismatches
+
+        Returns:
+            int: Number of films with a wrong counter
+        """
+        after = self.counters(film_ids)
+        ratings = {
+            row["film"]: row for row in film_models.UserFilmRating.objects.filter(film_id__in=film_ids)
+            .values("film").annotate(total=Sum("rating"), count=Count("pk"))
+        }
+        mismatches = 0
+        for film in film_models.Film.objects.filter(pk__in=film_ids).only("pk", "rating", "rating_sum", "rating_count"):
+            visualizations, rows = after[film.pk]
+            expected = before[film.pk][0] + rows - before[film.pk][1]
+            rating = ratings.get(film.pk, {"total": 0, "count": 0})
+            average = rating["total"] / rating["count"] if rating["count"] else 0
+            problems = []
+            if visualizations != expected:
+                problems.append(f"visualizations {visualizations} != {expected}")
+            if film.rating_count != rating["count"] or abs(film.rating_sum - rating["total"]) > 1e-6:
+                problems.append(f"ratings {film.rating_sum}/{film.rating_count} != {rating['total']}/{rating['count']}")
+            # the database rounds the average to one decimal
+            if abs(film.rating - average) > 0.05 + 1e-6:
+                problems.append(f"rating {film.rating} != {average:.2f}")
+            if problems:
+                mismatches += 1
+                self.stderr.write(f"Film {film.pk}: {', '.join(problems)}")
+
+        if not mismatches:
+            self.stdout.write(self.style.SUCCESS(f"Counters of {len(film_ids)} hot films match their rows"))
+        return mismatches
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+import films.cache as film_cache
+import films.leaderboards as film_leaderboards
+
+
+class Command(BaseCommand):
+    """
+    Rebuild the genre and film type leaderboards from the films table
+
+    Example: python manage.py rebuild_leaderboards
+    """
+
+    help = "Rebuild the genre and film type leaderboards"
+
+    def handle(self, *args, **options):
+        boards = film_leaderboards.rebuild()
+        film_cache.bump_film_stats([])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {boards} leaderboards"))
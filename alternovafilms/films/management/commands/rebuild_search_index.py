@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+import films.search as film_search
+
+
+class Command(BaseCommand):
+    """
+    Rebuild the film title search index from the films table
+
+    Example: python manage.py rebuild_search_index
+    """
+
+    help = "Rebuild the film title search index"
+
+    def handle(self, *args, **options):
+        backend = film_search.get_backend()
+        backend.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt the search index with {type(backend).__name__}"))
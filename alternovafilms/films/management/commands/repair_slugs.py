@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.utils.text import slugify
+import films.models as film_models
+
+
+class Command(BaseCommand):
+    """
+    Give a slug to the films without one and replace the slugs that are not valid
+
+    Valid slugs are kept as they are so the film urls don't change.
+
+    Example: python manage.py repair_slugs --dry-run
+    """
+
+    help = "Backfill missing film slugs and repair invalid ones"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=2000)
+        parser.add_argument("--dry-run", action="store_true", help="Only report the films to repair")
+
+    def handle(self, *args, **options):
+        films = film_models.Film.objects.order_by("pk").only("pk", "title", "slug")
+        repaired = 0
+        chunk = []
+        for film in films.filter(Q(slug__isnull=True) | Q(slug="")).iterator(chunk_size=options["chunk_size"]):
+            chunk.append(film)
+            if len(chunk) >= options["chunk_size"]:
+                repaired += self.repair(chunk, options["dry_run"])
+                chunk = []
+
+        # valid slugs can't be told apart with a query on every database, check them in python
+        for film in films.exclude(Q(slug__isnull=True) | Q(slug="")).iterator(chunk_size=options["chunk_size"]):
+            if slugify(film.slug) != film.slug:
+                chunk.append(film)
+            if len(chunk) >= options["chunk_size"]:
+                repaired += self.repair(chunk, options["dry_run"])
+                chunk = []
+        repaired += self.repair(chunk, options["dry_run"])
+
+        action = "Would repair" if options["dry_run"] else "Repaired"
+        self.stdout.write(self.style.SUCCESS(f"{action} {repaired} film slugs"))
+
+    def repair(self, films, dry_run):
+        if dry_run or not films:
+            return len(films)
+        for film in films:
+            film.slug = None
+        film_models.assign_slugs(films)
+        with transaction.atomic():
+            film_models.Film.objects.bulk_update(films, ["slug"])
+        return len(films)
@@ -0,0 +1,368 @@
+"""
+In-process metrics with a file backed aggregation across worker processes
+
+Counters and fixed bucket histograms are kept in process memory, recording a
+value takes a lock and a dict update. Every process writes a snapshot of its
+metrics to FILMS_METRICS_DIR/<pid>.json, at most every
+FILMS_METRICS_WRITE_INTERVAL seconds when a request finishes and when the
+process exits. The scrape endpoint adds the live metrics of the process that
+serves it to the snapshots of the other processes, so the values of the
+other workers are at most FILMS_METRICS_WRITE_INTERVAL seconds old.
+
+Snapshots of processes that are gone are folded into archive.json by the
+next scrape, so counters don't go back when gunicorn replaces a worker.
+Without FILMS_METRICS_DIR only the metrics of the scraped process are shown.
+"""
+
+import asyncio
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:
+    # Windows locks the snapshots directory with msvcrt
+    fcntl = None
+    import ctypes
+    import msvcrt
+
+ARCHIVE = "archive"
+
+# seconds, from fast cache hits to slow searches on large catalogs
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metric:
+    """
+    Base class of the metrics, values are stored per tuple of label values
+
+    attributes:
+        name (str): Metric name
+        help (str): Description shown on the scrape endpoint
+        labels (tuple): Label names
+    """
+
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self.values = {}
+
+    def state(self):
+        with self._lock:
+            return {"kind": self.kind, "help": self.help, "labels": self.labels, "values": [
+                [list(labels), self.copy_value(value)] for labels, value in self.values.items()
+            ]}
+
+    def copy_value(self, value):
+        return value
+
+
+class Counter(Metric):
+    """
+    Value that only goes up
+    """
+
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values over fixed buckets
+
+    Every label tuple stores the count of each bucket (the last one is +Inf), the sum and the count.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def copy_value(self, value):
+        return [list(value[0]), value[1], value[2]]
+
+    def state(self):
+        return {**super().state(), "buckets": self.buckets}
+
+
+def merge(states, other):
+    """
+    add the metric states of other into states
+    """
+    for name, state in other.items():
+        target = states.setdefault(name, {**state, "values": []})
+        values = {tuple(labels): value for labels, value in target["values"]}
+        for labels, value in state["values"]:
+            labels = tuple(labels)
+            previous = values.get(labels)
+            if previous is None:
+                values[labels] = value
+            elif state["kind"] == "histogram":
+                values[labels] = [[a + b for a, b in zip(previous[0], value[0])], previous[1] + value[1], previous[2] + value[2]]
+            else:
+                values[labels] = previous + value
+        target["values"] = [[list(labels), value] for labels, value in values.items()]
+    return states
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def format_number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    """
+    Metrics of the process and their snapshots on FILMS_METRICS_DIR
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self._written = 0.0
+        self._write_lock = threading.Lock()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self.clear)
+        atexit.register(self.write)
+
+    @property
+    def directory(self):
+        return getattr(settings, "FILMS_METRICS_DIR", None)
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def clear(self):
+        """
+        forget the recorded values, a forked worker starts from zero instead of its parent values
+        """
+        for metric in self.metrics.values():
+            metric.clear()
+        self._written = 0.0
+
+    def states(self):
+        return {name: metric.state() for name, metric in self.metrics.items()}
+
+    def path(self, name):
+        return os.path.join(self.directory, f"{name}.json")
+
+    def write(self):
+        """
+        write the snapshot of the process
+        """
+        if not self.directory:
+            return
+        with self._write_lock:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self.path(os.getpid())
+            temporary = f"{path}.tmp"
+            with open(temporary, "w") as stream:
+                json.dump(self.states(), stream)
+            os.replace(temporary, path)
+            self._written = time.monotonic()
+
+    def write_due(self):
+        """
+        whether the last snapshot is older than FILMS_METRICS_WRITE_INTERVAL
+        """
+        return time.monotonic() - self._written >= getattr(settings, "FILMS_METRICS_WRITE_INTERVAL", 10)
+
+    def maybe_write(self):
+        """
+        write the snapshot when the last one is older than FILMS_METRICS_WRITE_INTERVAL
+        """
+        if self.write_due():
+            self.write()
+
+    def collect(self):
+        """
+        metric states of every process, the current one with its live values
+
+        Returns:
+            dict: name -> state with the values of all the processes added up
+        """
+        states = self.states()
+        if not self.directory or not os.path.isdir(self.directory):
+            return states
+
+        with locked(os.path.join(self.directory, "lock")):
+            archive = self.read(self.path(ARCHIVE))
+            archived = False
+            for path in glob.glob(os.path.join(self.directory, "*.json")):
+                name = os.path.basename(path)[:-len(".json")]
+                if not name.isdigit() or int(name) == os.getpid():
+                    continue
+                snapshot = self.read(path)
+                if alive(int(name)):
+                    merge(states, snapshot)
+                else:
+                    merge(archive, snapshot)
+                    os.remove(path)
+                    archived = True
+            if archived:
+                temporary = self.path(ARCHIVE) + ".tmp"
+                with open(temporary, "w") as stream:
+                    json.dump(archive, stream)
+                os.replace(temporary, self.path(ARCHIVE))
+        return merge(states, archive)
+
+    def read(self, path):
+        try:
+            with open(path) as stream:
+                return json.load(stream)
+        except (OSError, ValueError):
+            return {}
+
+    def render(self):
+        """
+        metrics of every process in the Prometheus text format
+        """
+        lines = []
+        for name, state in sorted(self.collect().items()):
+            lines.append(f"# HELP {name} {state['help']}")
+            lines.append(f"# TYPE {name} {state['kind']}")
+            for labels, value in sorted(state["values"]):
+                if state["kind"] == "histogram":
+                    cumulative = 0
+                    bounds = [format_number(float(bound)) for bound in state["buckets"]] + ["+Inf"]
+                    for bound, count in zip(bounds, value[0]):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{format_labels(state['labels'], labels, [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_sum{format_labels(state['labels'], labels)} {format_number(value[1])}")
+                    lines.append(f"{name}_count{format_labels(state['labels'], labels)} {value[2]}")
+                else:
+                    lines.append(f"{name}{format_labels(state['labels'], labels)} {format_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+@contextmanager
+def locked(path):
+    """
+    hold an exclusive lock on the file at path, shared with the other processes
+    """
+    with open(path, "w") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+            return
+        # LK_LOCK retries for 10 seconds before it gives up with an OSError
+        msvcrt.locking(lock.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            lock.seek(0)
+            msvcrt.locking(lock.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def alive(pid):
+    if fcntl is None:
+        return _windows_alive(pid)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _windows_alive(pid):
+    # os.kill(pid, 0) would send CTRL_C_EVENT on Windows, ask for the exit code instead
+    kernel32 = ctypes.windll.kernel32
+    handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+    if not handle:
+        return False
+    try:
+        code = ctypes.c_ulong()
+        return bool(kernel32.GetExitCodeProcess(handle, ctypes.byref(code))) and code.value == 259  # STILL_ACTIVE
+    finally:
+        kernel32.CloseHandle(handle)
+
+
+registry = Registry()
+
+requests_total = registry.counter("films_requests_total", "HTTP requests by view, method and status", ("view", "method", "status"))
+request_duration = registry.histogram("films_request_duration_seconds", "Time spent serving the requests by view", ("view",))
+activity = registry.counter("films_activity_total", "Ratings and visualizations stored by kind, rated or watched", ("kind",))
+
+
+class MetricsMiddleware:
+    """
+    Count the requests and time them per view, the view is the url name or unmatched
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            # mark the instance as a coroutine function like MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        start = time.perf_counter()
+        response = self.get_response(request)
+        self.record(request, response, start)
+        registry.maybe_write()
+        return response
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        self.record(request, response, start)
+        if registry.write_due():
+            # the snapshot is a file write, it must not block the event loop
+            await sync_to_async(registry.write, thread_sensitive=False)()
+        return response
+
+    def record(self, request, response, start):
+        match = getattr(request, "resolver_match", None)
+        view = match.view_name if match is not None else "unmatched"
+        request_duration.observe(time.perf_counter() - start, view)
+        requests_total.inc(view, request.method, str(response.status_code))
@@ -0,0 +1,46 @@
+# Generated by Django 4.1.9 on 2026-10-18 15:14
+
+from django.db import migrations, models
+from django.db.models import Count, F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce, Round
+
+
+def backfill_rating_aggregates(apps, schema_editor):
+    """
+    fill the rating aggregates from the existing ratings and recompute the rating
+
+    The rating is the average of the stored ratings and 0 for films without
+    ratings, like Film.objects.recompute_ratings(). A legacy rating without
+    ratings behind it is not kept, 0006 follows the same rule.
+    """
+    Film = apps.get_model('films', 'Film')
+    UserFilmRating = apps.get_model('films', 'UserFilmRating')
+
+    ratings = UserFilmRating.objects.filter(film=OuterRef('pk')).order_by().values('film')
+    Film.objects.update(
+        rating_sum=Coalesce(Subquery(ratings.annotate(total=Sum('rating')).values('total')), 0.0),
+        rating_count=Coalesce(Subquery(ratings.annotate(count=Count('pk')).values('count')), 0),
+    )
+    Film.objects.filter(rating_count=0).update(rating=0.0)
+    Film.objects.filter(rating_count__gt=0).update(rating=Round(F('rating_sum') / F('rating_count'), 1))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('films', '0002_alter_film_options_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='film',
+            name='rating_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='film',
+            name='rating_sum',
+            field=models.FloatField(default=0),
+        ),
+        migrations.RunPython(backfill_rating_aggregates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.1.9 on 2026-10-18 16:02
+
+from django.db import migrations
+from unidecode import unidecode
+
+
+def create_search_index(apps, schema_editor):
+    """
+    create the FTS5 title index on SQLite and fill it with the normalized titles
+    """
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+
+    Film = apps.get_model('films', 'Film')
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS films_film_fts USING fts5(title, tokenize = 'unicode61 remove_diacritics 2')"
+    )
+    rows = [(pk, unidecode(title or '').lower()) for pk, title in Film.objects.values_list('pk', 'title').iterator()]
+    with schema_editor.connection.cursor() as cursor:
+        cursor.executemany("INSERT INTO films_film_fts (rowid, title) VALUES (%s, %s)", rows)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute("DROP TABLE IF EXISTS films_film_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('films', '0003_film_rating_aggregates'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
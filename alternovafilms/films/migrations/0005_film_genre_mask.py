@@ -0,0 +1,37 @@
+# Generated by Django 4.1.9 on 2026-10-18 15:28
+
+from collections import defaultdict
+from django.db import migrations, models
+
+
+def backfill_genre_masks(apps, schema_editor):
+    """
+    set the genre mask of every film from its genres, genres without a bit are left out
+    """
+    Film = apps.get_model('films', 'Film')
+    masks = defaultdict(int)
+    for film_id, genre_id in Film.genre.through.objects.values_list('film_id', 'genre_id').iterator():
+        if 0 <= genre_id < 63:
+            masks[film_id] |= 1 << genre_id
+
+    Film.objects.bulk_update([Film(pk=pk, genre_mask=mask) for pk, mask in masks.items()], ['genre_mask'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('films', '0004_film_title_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='film',
+            name='genre_mask',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='film',
+            index=models.Index(fields=['film_type', 'genre_mask'], name='films_film_type_genres_idx'),
+        ),
+        migrations.RunPython(backfill_genre_masks, migrations.RunPython.noop),
+    ]
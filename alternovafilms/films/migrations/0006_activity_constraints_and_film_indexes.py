@@ -0,0 +1,78 @@
+# Generated by Django 4.1.9 on 2026-10-18 15:33
+
+from django.db import migrations, models
+from django.db.models import Count, F, Min, Sum
+from django.db.models.functions import Greatest, Round
+
+
+def remove_duplicate_activity(apps, schema_editor):
+    """
+    keep the first rating and visualization of every (user, film) pair and
+    remove the deleted rows from the aggregates of their films
+
+    The aggregates are adjusted instead of recomputed from the rows, the
+    seeded visualization counters have no rows behind them. Like 0003 the
+    rating is the average of the ratings and 0 without ratings.
+    """
+    Film = apps.get_model('films', 'Film')
+    UserFilmRating = apps.get_model('films', 'UserFilmRating')
+    UserFilmVisualization = apps.get_model('films', 'UserFilmVisualization')
+
+    # film id -> [rating sum, rating count, visualizations] of the deleted rows
+    removed = {}
+    for model in (UserFilmRating, UserFilmVisualization):
+        duplicates = (
+            model.objects.order_by().values('user', 'film')
+            .annotate(count=Count('pk'), first=Min('pk')).filter(count__gt=1)
+        )
+        for duplicate in duplicates.iterator():
+            rows = model.objects.filter(user=duplicate['user'], film=duplicate['film']).exclude(pk=duplicate['first'])
+            deltas = removed.setdefault(duplicate['film'], [0.0, 0, 0])
+            if model is UserFilmRating:
+                deltas[0] += rows.aggregate(total=Sum('rating'))['total'] or 0.0
+                deltas[1] += duplicate['count'] - 1
+            else:
+                deltas[2] += duplicate['count'] - 1
+            rows.delete()
+
+    for film_id, (rating_sum, rating_count, visualizations) in removed.items():
+        Film.objects.filter(pk=film_id).update(
+            rating_sum=F('rating_sum') - rating_sum,
+            rating_count=F('rating_count') - rating_count,
+            visualizations=Greatest(F('visualizations') - visualizations, 0),
+        )
+
+    rated = Film.objects.filter(pk__in=[film_id for film_id, deltas in removed.items() if deltas[1]])
+    rated.filter(rating_count__lte=0).update(rating=0.0, rating_sum=0.0, rating_count=0)
+    rated.filter(rating_count__gt=0).update(rating=Round(F('rating_sum') / F('rating_count'), 1))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('films', '0005_film_genre_mask'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_activity, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='film',
+            index=models.Index(fields=['rating'], name='films_film_rating_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='film',
+            index=models.Index(fields=['visualizations'], name='films_film_visualizations_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='film',
+            index=models.Index(fields=['film_type', 'rating'], name='films_film_type_rating_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='userfilmrating',
+            constraint=models.UniqueConstraint(fields=('user', 'film'), name='films_unique_user_film_rating'),
+        ),
+        migrations.AddConstraint(
+            model_name='userfilmvisualization',
+            constraint=models.UniqueConstraint(fields=('user', 'film'), name='films_unique_user_film_visualization'),
+        ),
+    ]
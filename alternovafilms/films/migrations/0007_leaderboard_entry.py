@@ -0,0 +1,57 @@
+# Generated by Django 4.1.9 on 2026-10-18 16:13
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+LEADERBOARD_SIZE = 10
+
+
+def build_leaderboards(apps, schema_editor):
+    """
+    fill the leaderboards of the existing genres and film types, rebuild_leaderboards does the same later
+    """
+    Film = apps.get_model('films', 'Film')
+    Genre = apps.get_model('films', 'Genre')
+    FilmType = apps.get_model('films', 'FilmType')
+    LeaderboardEntry = apps.get_model('films', 'LeaderboardEntry')
+
+    entries = []
+    for scope, model, lookup in (('genre', Genre, 'genre'), ('film_type', FilmType, 'film_type')):
+        for scope_id in model.objects.values_list('pk', flat=True):
+            for metric in ('rating', 'visualizations'):
+                best = Film.objects.filter(**{lookup: scope_id}).order_by('-' + metric, 'pk').values_list('pk', metric)
+                entries += [
+                    LeaderboardEntry(scope=scope, scope_id=scope_id, metric=metric, film_id=film_id, score=score)
+                    for film_id, score in best[:LEADERBOARD_SIZE]
+                ]
+    LeaderboardEntry.objects.bulk_create(entries, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('films', '0006_activity_constraints_and_film_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LeaderboardEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(choices=[('genre', 'Genre'), ('film_type', 'Film type')], max_length=16)),
+                ('scope_id', models.IntegerField()),
+                ('metric', models.CharField(choices=[('rating', 'Rating'), ('visualizations', 'Visualizations')], max_length=16)),
+                ('score', models.FloatField()),
+                ('film', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='films.film')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='leaderboardentry',
+            index=models.Index(fields=['scope', 'scope_id', 'metric', '-score', 'film'], name='films_leaderboard_rank_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='leaderboardentry',
+            constraint=models.UniqueConstraint(fields=('scope', 'scope_id', 'metric', 'film'), name='films_unique_leaderboard_film'),
+        ),
+        migrations.RunPython(build_leaderboards, migrations.RunPython.noop),
+    ]
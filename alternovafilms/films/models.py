@@ -1,6 +1,13 @@
-from django.db import models
+import random
+import secrets
+import string
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, Count, Exists, F, FloatField, IntegerField, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, NullIf, Round
 from django.urls import reverse
 from django.core.validators import MinValueValidator, MaxValueValidator
+from django.template.defaultfilters import slugify
+from unidecode import unidecode
 
 class Genre(models.Model):
     """
@@ -39,6 +46,311 @@ class FilmType(models.Model):
         return self.name.capitalize()
 
 
+# genres are stored as bits of Film.genre_mask, the bit of a genre is its id
+GENRE_MASK_BITS = 63
+
+
+def genre_mask(genre_ids):
+    """
+    Return the genre mask of a list of genre ids or None if an id has no bit
+
+    Args:
+        genre_ids (list): Genre ids
+
+    Returns:
+        int: Mask with the bit of every genre set
+    """
+    mask = 0
+    for genre_id in genre_ids:
+        if not 0 <= genre_id < GENRE_MASK_BITS:
+            return None
+        mask |= 1 << genre_id
+    return mask
+
+
+SLUG_SUFFIX_LENGTH = 6
+SLUG_SUFFIX_CHARS = string.ascii_lowercase + string.digits
+# slugs drawn for a film before its write gives up on the collisions
+SLUG_ATTEMPTS = 5
+
+
+def film_slug(title, max_length=100):
+    """
+    Return a new slug for a film title with a random suffix
+
+    The suffix makes the slug unique without querying the films or knowing the
+    film id, so it can be assigned before the INSERT. With 36^6 suffixes per
+    title a collision is unlikely, the unique constraint of the column rejects
+    it and Film.save and assign_slugs draw another suffix.
+
+    Args:
+        title (str): Film title
+        max_length (int): Max length of the slug
+
+    Returns:
+        str: Slug like the-godfather-x7k2qa
+    """
+    suffix = "".join(secrets.choice(SLUG_SUFFIX_CHARS) for _ in range(SLUG_SUFFIX_LENGTH))
+    base = slugify(unidecode(title or ""))[:max_length - SLUG_SUFFIX_LENGTH - 1].strip("-") or "film"
+    return f"{base}-{suffix}"
+
+
+def assign_slugs(films):
+    """
+    Give a new slug to the films without one before they are written with bulk_create or bulk_update
+
+    Bulk writes don't go through Film.save, so the drawn slugs are checked
+    against the stored films and the other films of the batch, and the taken
+    ones are drawn again, at most SLUG_ATTEMPTS times.
+
+    Args:
+        films (list): Films, the ones with a slug keep it
+    """
+    pending = [film for film in films if not film.slug]
+    # slugs of the batch, the given ones and the drawn ones already accepted
+    seen = {film.slug for film in films if film.slug}
+    for _ in range(SLUG_ATTEMPTS):
+        if not pending:
+            return
+        for film in pending:
+            film.slug = film_slug(film.title)
+        taken = set(Film.objects.filter(slug__in=[film.slug for film in pending]).values_list("slug", flat=True))
+        retry = []
+        for film in pending:
+            if film.slug in taken or film.slug in seen:
+                retry.append(film)
+            else:
+                seen.add(film.slug)
+        pending = retry
+    if pending:
+        raise IntegrityError(f"Could not draw a free slug for {len(pending)} films")
+
+
+class FilmQuerySet(models.QuerySet):
+    """
+    Custom queryset for the Film model
+    """
+
+    # columns read by FilmReadSerializer
+    READ_MODEL_FIELDS = ("pk", "title", "film_type__name", "visualizations", "rating", "slug")
+    # columns the list paginators sort and build cursors on
+    PAGE_KEY_FIELDS = ("pk", "title", "rating", "visualizations")
+    # ids drawn by random() before it falls back to a probe of the primary key index
+    RANDOM_PIVOTS = 32
+
+    def with_related(self):
+        """
+        Load the film type with a join and the genres with one extra query for the whole queryset
+        """
+        return self.select_related("film_type").prefetch_related("genre")
+
+    def read_model(self):
+        """
+        Return the films as dicts with the columns used by FilmReadSerializer
+        """
+        return self.values(*self.READ_MODEL_FIELDS)
+
+    def page_keys(self):
+        """
+        Return the films as dicts with the ids and sort columns only, the bodies come from the films cache
+        """
+        return self.values(*self.PAGE_KEY_FIELDS)
+
+    def random(self, genre=None, film_type=None):
+        """
+        Return a uniformly random film without sorting the whole table
+
+        RANDOM_PIVOTS ids are drawn between the lowest and highest ids and the
+        films with those ids are read with one primary key lookup. The first
+        drawn id that is a film matching the filters wins, every matching film
+        has the same chance whatever the gaps left by deleted films around it.
+        When every id lands in a gap or on a film outside the filters, the first
+        matching film from one more random id up is read with the primary key
+        index, wrapping around to the lowest id. That probe favours the films
+        after long gaps, but it only runs when all the drawn ids missed and its
+        cost doesn't grow with the catalog.
+
+        Args:
+            genre (str): Optional genre name the film must have
+            film_type (str): Optional film type name the film must have
+
+        Returns:
+            Film: Random film or None if no film matches
+        """
+        ids = self.order_by().values_list("pk", flat=True)
+        low = ids.order_by("pk").first()
+        if low is None:
+            return None
+        high = ids.order_by("-pk").first()
+
+        queryset = self._random_candidates(genre, film_type)
+        pivots = [random.randint(low, high) for _ in range(self.RANDOM_PIVOTS)]
+        film = self._first_drawn(pivots, queryset.filter(pk__in=pivots))
+        if film is None:
+            films = queryset.order_by("pk")
+            film = films.filter(pk__gte=random.randint(low, high)).first() or films.first()
+        return film
+
+    async def arandom(self, genre=None, film_type=None):
+        """
+        Async version of random() with the async ORM
+        """
+        ids = self.order_by().values_list("pk", flat=True)
+        low = await ids.order_by("pk").afirst()
+        if low is None:
+            return None
+        high = await ids.order_by("-pk").afirst()
+
+        queryset = self._random_candidates(genre, film_type)
+        pivots = [random.randint(low, high) for _ in range(self.RANDOM_PIVOTS)]
+        film = self._first_drawn(pivots, [film async for film in queryset.filter(pk__in=pivots)])
+        if film is None:
+            films = queryset.order_by("pk")
+            film = await films.filter(pk__gte=random.randint(low, high)).afirst() or await films.afirst()
+        return film
+
+    @staticmethod
+    def _first_drawn(pivots, films):
+        films = {film.pk: film for film in films}
+        return next((films[pk] for pk in pivots if pk in films), None)
+
+    def _random_candidates(self, genre, film_type):
+        # correlated filters are checked on the films found by primary key instead of
+        # collecting every film of the genre or type
+        queryset = self
+        if genre:
+            genres = Film.genre.through.objects.filter(film_id=OuterRef("pk"), genre__name__iexact=genre)
+            queryset = queryset.filter(Exists(genres))
+        if film_type:
+            film_types = FilmType.objects.filter(pk=OuterRef("film_type_id"), name__iexact=film_type)
+            queryset = queryset.filter(Exists(film_types))
+        return queryset
+
+    def add_ratings(self, ratings):
+        """
+        Add ratings to the films running aggregates with a single UPDATE
+
+        The sum and count are incremented by the database so concurrent writers
+        don't overwrite each other, and the displayed rating is recomputed from
+        the new aggregates in the same statement.
+
+        Args:
+            ratings (dict): film id -> (rating sum, rating count) to add, negative values remove ratings
+
+        Returns:
+            int: Number of updated films
+        """
+        if not ratings:
+            return 0
+
+        sums = Case(
+            *[When(pk=pk, then=Value(float(total))) for pk, (total, _) in ratings.items()],
+            default=Value(0.0), output_field=FloatField(),
+        )
+        counts = Case(
+            *[When(pk=pk, then=Value(int(count))) for pk, (_, count) in ratings.items()],
+            default=Value(0), output_field=IntegerField(),
+        )
+        rating_sum = F("rating_sum") + sums
+        rating_count = F("rating_count") + counts
+        return self.filter(pk__in=ratings.keys()).update(
+            rating_sum=rating_sum,
+            rating_count=rating_count,
+            rating=Coalesce(Round(rating_sum / NullIf(rating_count, 0), 1), Value(0.0)),
+        )
+
+    def recompute_ratings(self):
+        """
+        Recompute the rating aggregates of the films from the stored ratings with a single UPDATE
+
+        Returns:
+            int: Number of updated films
+        """
+        ratings = UserFilmRating.objects.filter(film=OuterRef("pk")).order_by().values("film")
+        rating_sum = Coalesce(Subquery(ratings.annotate(total=Sum("rating")).values("total")), Value(0.0))
+        rating_count = Coalesce(Subquery(ratings.annotate(count=Count("pk")).values("count")), Value(0))
+        return self.update(
+            rating_sum=rating_sum,
+            rating_count=rating_count,
+            rating=Coalesce(Round(rating_sum / NullIf(rating_count, 0), 1), Value(0.0)),
+        )
+
+    def count_visualizations(self, visualizations):
+        """
+        Add the given visualization rows to the films visualizations counter with a single UPDATE
+
+        Args:
+            visualizations (QuerySet): UserFilmVisualization rows to count
+
+        Returns:
+            int: Number of updated films
+        """
+        rows = visualizations.filter(film=OuterRef("pk")).order_by().values("film")
+        return self.filter(Exists(rows)).update(
+            visualizations=F("visualizations") + Subquery(rows.annotate(count=Count("pk")).values("count")),
+        )
+
+    def with_genres(self, genre_ids):
+        """
+        Return the films that have all the given genres
+
+        The genre mask answers it without joining the genres table, when a genre
+        has no bit the films are filtered with one join per genre instead.
+
+        Args:
+            genre_ids (list): Genre ids the films must have
+
+        Returns:
+            QuerySet: Films with all the genres
+        """
+        mask = genre_mask(genre_ids)
+        if mask is None:
+            queryset = self
+            for genre_id in genre_ids:
+                queryset = queryset.filter(genre=genre_id)
+            return queryset
+        return self.alias(genre_match=F("genre_mask").bitand(mask)).filter(genre_match=mask)
+
+    def refresh_genre_masks(self):
+        """
+        Recompute the genre mask of the films from their genres
+
+        Returns:
+            int: Number of updated films
+        """
+        films = {pk: 0 for pk in self.values_list("pk", flat=True)}
+        through = Film.genre.through.objects.filter(film_id__in=films.keys())
+        for film_id, genre_id in through.values_list("film_id", "genre_id"):
+            mask = genre_mask([genre_id])
+            films[film_id] |= mask or 0
+
+        return Film.objects.bulk_update(
+            [Film(pk=pk, genre_mask=mask) for pk, mask in films.items()], ["genre_mask"], batch_size=500,
+        )
+
+    def add_visualizations(self, visualizations):
+        """
+        Add visualizations to several films with a single UPDATE
+
+        Only the visualizations column is written and the increment is done by
+        the database, so concurrent writers don't lose updates.
+
+        Args:
+            visualizations (dict): film id -> number of visualizations to add
+
+        Returns:
+            int: Number of updated films
+        """
+        if not visualizations:
+            return 0
+
+        deltas = Case(
+            *[When(pk=pk, then=Value(int(delta))) for pk, delta in visualizations.items()],
+            default=Value(0), output_field=IntegerField(),
+        )
+        return self.filter(pk__in=visualizations.keys()).update(visualizations=F("visualizations") + deltas)
+
+
 # Create your models here.
 class Film(models.Model):
     """
@@ -54,8 +366,11 @@ class Film(models.Model):
         genre (Genre): Film genre
         film_type (FilmType): Film type
         visualizations (int): Film visualizations
-        rating (float): Film rating
+        rating (float): Film rating, average of rating_sum and rating_count
+        rating_sum (float): Sum of all the ratings given to the film
+        rating_count (int): Number of ratings given to the film
         slug (str): Film slug
+        genre_mask (int): Bit mask of the film genres, see GENRE_MASK_BITS
     """
 
     title = models.CharField(max_length=100)
@@ -63,13 +378,39 @@ class Film(models.Model):
     film_type = models.ForeignKey(FilmType, on_delete=models.SET_NULL, null=True)
     visualizations = models.IntegerField(default=0)
     rating = models.FloatField(default=0)
+    rating_sum = models.FloatField(default=0)
+    rating_count = models.IntegerField(default=0)
     slug = models.SlugField(max_length=100, unique=True, null=True, blank=True)
+    genre_mask = models.BigIntegerField(default=0)
+
+    objects = FilmQuerySet.as_manager()
 
     def __str__(self):
         return self.title
+
+    def save(self, *args, **kwargs):
+        """
+        save the film, when the slug drawn by create_slug is taken the write is retried with a new one
+        """
+        if self.slug:
+            return super().save(*args, **kwargs)
+        for attempt in range(SLUG_ATTEMPTS):
+            try:
+                with transaction.atomic(using=kwargs.get("using")):
+                    return super().save(*args, **kwargs)
+            except IntegrityError:
+                slug, self.slug = self.slug, None
+                if attempt == SLUG_ATTEMPTS - 1 or not Film.objects.filter(slug=slug).exists():
+                    raise
     
     class Meta:
         ordering = ('title',)
+        indexes = [
+            models.Index(fields=["film_type", "genre_mask"], name="films_film_type_genres_idx"),
+            models.Index(fields=["rating"], name="films_film_rating_idx"),
+            models.Index(fields=["visualizations"], name="films_film_visualizations_idx"),
+            models.Index(fields=["film_type", "rating"], name="films_film_type_rating_idx"),
+        ]
     
 
 class UserFilmRating(models.Model):
@@ -94,12 +435,17 @@ class UserFilmRating(models.Model):
         if self.rating < 0 or self.rating > 10:
             raise ValueError("Rating must be between 0 and 10")
         
-        rating = UserFilmRating.objects.filter(user=self.user, film=self.film)
-        if rating:
+        from films.activity import user_activity
+        if user_activity.contains(self.user_id, "rated", self.film_id):
             raise ValueError("User has already rated this film")
 
         return super().clean()
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "film"], name="films_unique_user_film_rating"),
+        ]
+
 
 class UserFilmVisualization(models.Model):
     """
@@ -120,8 +466,53 @@ class UserFilmVisualization(models.Model):
     film = models.ForeignKey(Film, on_delete=models.CASCADE)
 
     def clean(self) -> None:
-        visualization = UserFilmVisualization.objects.filter(user=self.user, film=self.film)
-        if visualization:
+        from films.activity import user_activity
+        if user_activity.contains(self.user_id, "watched", self.film_id):
             raise ValueError("User has already visualized this film")
 
         return super().clean()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "film"], name="films_unique_user_film_visualization"),
+        ]
+
+
+class LeaderboardEntry(models.Model):
+    """
+    Leaderboard entry model stores a film on the leaderboard of a genre or film type
+
+    Every board keeps its best FILMS_LEADERBOARD_SIZE films by rating or by
+    visualizations, see films.leaderboards for how the boards are kept up to date
+
+    Args:
+        models (Model): Model from django.db
+
+    Attributes:
+
+        id (int): LeaderboardEntry id
+        scope (str): genre or film_type
+        scope_id (int): Id of the genre or film type
+        metric (str): rating or visualizations
+        film (Film): Film on the board
+        score (float): Rating or visualizations of the film when the board was updated
+    """
+
+    GENRE = "genre"
+    FILM_TYPE = "film_type"
+    SCOPES = [(GENRE, "Genre"), (FILM_TYPE, "Film type")]
+    METRICS = [("rating", "Rating"), ("visualizations", "Visualizations")]
+
+    scope = models.CharField(max_length=16, choices=SCOPES)
+    scope_id = models.IntegerField()
+    metric = models.CharField(max_length=16, choices=METRICS)
+    film = models.ForeignKey(Film, on_delete=models.CASCADE)
+    score = models.FloatField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["scope", "scope_id", "metric", "film"], name="films_unique_leaderboard_film"),
+        ]
+        indexes = [
+            models.Index(fields=["scope", "scope_id", "metric", "-score", "film"], name="films_leaderboard_rank_idx"),
+        ]
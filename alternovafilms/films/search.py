@@ -0,0 +1,127 @@
+import re
+from abc import ABC, abstractmethod
+from django.conf import settings
+from django.db import connection
+from django.db.models import Value, FloatField
+from django.utils.module_loading import import_string
+from unidecode import unidecode
+import films.models as film_models
+
+
+def normalize(text):
+    """
+    normalize a title the same way slugs are built, without accents and lowercase
+    """
+    return unidecode(text or "").lower()
+
+
+def query_tokens(text):
+    """
+    split a search text into normalized words
+    """
+    return re.findall(r"\w+", normalize(text))
+
+
+class SearchBackend(ABC):
+    """
+    Base class for the film title search backends
+
+    A backend keeps its index in sync through index() and remove(), which the
+    films signals call on create, update and delete, and filters querysets
+    with filter(), which annotates search_rank (lower is more relevant).
+    """
+
+    @abstractmethod
+    def filter(self, queryset, title):
+        """
+        filter the films whose title matches the search and annotate search_rank
+        """
+
+    def index(self, films):
+        pass
+
+    def remove(self, film_ids):
+        pass
+
+    def rebuild(self):
+        pass
+
+
+class BasicSearchBackend(SearchBackend):
+    """
+    Search backend without an index, every word must be contained in the title
+    """
+
+    def filter(self, queryset, title):
+        tokens = query_tokens(title)
+        if not tokens:
+            return queryset.none()
+        for token in tokens:
+            queryset = queryset.filter(title__icontains=token)
+        return queryset.annotate(search_rank=Value(0.0, output_field=FloatField()))
+
+
+class SQLiteFTS5Backend(SearchBackend):
+    """
+    Search backend using a SQLite FTS5 table with the normalized titles
+
+    Every word of the search matches the start of a word in the title and
+    results are ranked with bm25.
+    """
+
+    table = "films_film_fts"
+
+    def match_expression(self, title):
+        return " ".join(f'"{token}"*' for token in query_tokens(title))
+
+    def filter(self, queryset, title):
+        match = self.match_expression(title)
+        if not match:
+            return queryset.none()
+
+        # the index is joined on the film id so MATCH runs once for the whole query, a
+        # correlated subquery for the rank would run it again for every matching film
+        table = self.table
+        film_table = film_models.Film._meta.db_table
+        return queryset.extra(
+            select={"search_rank": f'"{table}"."rank"'},
+            tables=[table],
+            where=[f'"{table}" MATCH %s', f'"{table}"."rowid" = "{film_table}"."id"'],
+            params=[match],
+        )
+
+    def index(self, films):
+        rows = [(film.pk, normalize(film.title)) for film in films]
+        if not rows:
+            return
+        with connection.cursor() as cursor:
+            cursor.executemany(f"DELETE FROM {self.table} WHERE rowid = %s", [(pk,) for pk, _ in rows])
+            cursor.executemany(f"INSERT INTO {self.table} (rowid, title) VALUES (%s, %s)", rows)
+
+    def remove(self, film_ids):
+        with connection.cursor() as cursor:
+            cursor.executemany(f"DELETE FROM {self.table} WHERE rowid = %s", [(pk,) for pk in film_ids])
+
+    def rebuild(self, chunk_size=2000):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.table}")
+        films = film_models.Film.objects.order_by("pk").only("pk", "title")
+        chunk = []
+        for film in films.iterator(chunk_size=chunk_size):
+            chunk.append(film)
+            if len(chunk) >= chunk_size:
+                self.index(chunk)
+                chunk = []
+        self.index(chunk)
+
+
+def get_backend():
+    """
+    Return the search backend from FILMS_SEARCH_BACKEND, by default FTS5 on SQLite and the basic backend elsewhere
+    """
+    path = getattr(settings, "FILMS_SEARCH_BACKEND", None)
+    if path:
+        return import_string(path)()
+    if connection.vendor == "sqlite":
+        return SQLiteFTS5Backend()
+    return BasicSearchBackend()
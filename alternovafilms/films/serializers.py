@@ -1,5 +1,8 @@
+from collections import defaultdict
+from django.db import IntegrityError, transaction
 from rest_framework import serializers
 import films.models as film_models
+import films.activity as film_activity
 
 class FilmGetSerializer(serializers.ModelSerializer):
     """
@@ -21,7 +24,93 @@ class FilmGetSerializer(serializers.ModelSerializer):
         fields = ["pk", "title", "genre", "film_type", "visualizations", "rating", "slug"]
 
 
-class FilmVisualizationSerializer(serializers.ModelSerializer):
+class FilmReadSerializer:
+    """
+    Lightweight film serializer for list responses
+
+    Builds the same output as FilmGetSerializer from the dicts returned by
+    Film.objects.read_model(). The genres of every film are loaded with a
+    single query, so a page costs the same number of queries whatever its size.
+
+    Args:
+        instance (dict|list): Film dict or list of film dicts from read_model()
+        many (bool): True when instance is a list of films
+
+    Returns:
+        FilmReadSerializer: Film serializer for list responses
+    """
+
+    def __init__(self, instance=None, many=False, **kwargs):
+        self.instance = instance
+        self.many = many
+
+    @property
+    def data(self):
+        films = list(self.instance) if self.many else [self.instance]
+        films = [film for film in films if film]
+
+        genres = defaultdict(list)
+        if films:
+            through = film_models.Film.genre.through.objects.filter(film_id__in=[film["pk"] for film in films])
+            for film_id, name in through.order_by("pk").values_list("film_id", "genre__name"):
+                genres[film_id].append(name.capitalize())
+
+        data = [
+            {
+                "pk": film["pk"],
+                "title": film["title"],
+                "genre": genres[film["pk"]],
+                "film_type": film["film_type__name"].capitalize() if film["film_type__name"] is not None else None,
+                "visualizations": film["visualizations"],
+                "rating": film["rating"],
+                "slug": film["slug"],
+            }
+            for film in films
+        ]
+
+        if self.many:
+            return data
+        return data[0] if data else None
+
+
+class ContextObjectField(serializers.PrimaryKeyRelatedField):
+    """
+    Primary key field that takes the object the view already read from the serializer context
+
+    The object is stored in the context under the field name, any other pk is read from the queryset.
+    """
+
+    def to_internal_value(self, data):
+        instance = self.context.get(self.field_name)
+        if instance is not None and str(instance.pk) == str(data):
+            return instance
+        return super().to_internal_value(data)
+
+
+class UniqueUserFilmMixin:
+    """
+    Create the row relying on the (user, film) unique constraint
+
+    The duplicate check in validate reads the user activity cache, a duplicate
+    that gets past it, like two concurrent requests, is rejected by the database
+    and reported as the same validation error. The film and the user are taken
+    from the context when the view already has them, so a write reads the film
+    once and then runs the INSERT, the UPDATE of the film aggregates and the
+    leaderboard refresh.
+    """
+
+    duplicate_message = None
+    serializer_related_field = ContextObjectField
+
+    def create(self, validated_data):
+        try:
+            with transaction.atomic():
+                return super().create(validated_data)
+        except IntegrityError:
+            raise serializers.ValidationError({"non_field_errors": [self.duplicate_message]})
+
+
+class FilmVisualizationSerializer(UniqueUserFilmMixin, serializers.ModelSerializer):
     """
     Film serializer for POST requests to add a film to the user's visualizations
 
@@ -36,9 +125,12 @@ class FilmVisualizationSerializer(serializers.ModelSerializer):
         user (int): User id
     """
 
+    duplicate_message = "You already visualized this film"
+
     class Meta:
         model = film_models.UserFilmVisualization
         fields = ["film", "user"]
+        validators = []
 
     def validate(self, attrs):
         film_id = attrs.get("film")
@@ -46,16 +138,15 @@ class FilmVisualizationSerializer(serializers.ModelSerializer):
 
         if film_id and user_id:
             
-            films = film_models.UserFilmVisualization.objects.filter(film=film_id, user=user_id)
-            if films.exists():
-                raise serializers.ValidationError("You already visualized this film")
+            if film_activity.user_activity.contains(user_id.pk, "watched", film_id.pk):
+                raise serializers.ValidationError(self.duplicate_message)
             else:
                 return attrs
         else:
             raise serializers.ValidationError("Film and user are required")
         
 
-class FilmRatingSerializer(serializers.ModelSerializer):
+class FilmRatingSerializer(UniqueUserFilmMixin, serializers.ModelSerializer):
     """
     Film serializer for POST requests to add a film to the user's ratings
 
@@ -71,9 +162,12 @@ class FilmRatingSerializer(serializers.ModelSerializer):
         rating (int): Rating
     """
 
+    duplicate_message = "You already rated this film"
+
     class Meta:
         model = film_models.UserFilmRating
         fields = ["film", "user", "rating"]
+        validators = []
 
     def validate(self, attrs):
         film_id = attrs.get("film")
@@ -84,9 +178,8 @@ class FilmRatingSerializer(serializers.ModelSerializer):
             if rating > 10 or rating < 0:
                 raise serializers.ValidationError("Rating must be between 0 and 10")
             else:
-                films = film_models.UserFilmRating.objects.filter(film=film_id, user=user_id)
-                if films.exists():
-                    raise serializers.ValidationError("You already rated this film")
+                if film_activity.user_activity.contains(user_id.pk, "rated", film_id.pk):
+                    raise serializers.ValidationError(self.duplicate_message)
                 else:
                     return attrs
         else:
@@ -95,3 +188,33 @@ class FilmRatingSerializer(serializers.ModelSerializer):
         
 
 
+
+
+class FilmVisualizationItemSerializer(serializers.Serializer):
+    """
+    Item serializer for the bulk visualizations endpoint
+
+    Args:
+        serializers (Serializer): Serializer from rest_framework
+
+    Required fields:
+        film (int): Film id
+    """
+
+    film = serializers.IntegerField()
+
+
+class FilmRatingItemSerializer(serializers.Serializer):
+    """
+    Item serializer for the bulk ratings endpoint
+
+    Args:
+        serializers (Serializer): Serializer from rest_framework
+
+    Required fields:
+        film (int): Film id
+        rating (float): Rating between 0 and 10
+    """
+
+    film = serializers.IntegerField()
+    rating = serializers.FloatField(min_value=0, max_value=10)
@@ -1,32 +1,70 @@
-from django.db.models.signals import post_save, pre_save
+from django.db.models.signals import post_save, pre_save, pre_delete, post_delete, m2m_changed
 from django.dispatch import receiver
-from django.template.defaultfilters import slugify
-from unidecode import unidecode
+from django.db import transaction
 import films.models as film_models
+import films.cache as film_cache
+import films.counters as film_counters
+import films.search as film_search
+import films.activity as film_activity
+import films.metrics as film_metrics
+import films.leaderboards as film_leaderboards
 
 
-@receiver(post_save, sender=film_models.Film)
-def create_slug(sender, instance, created, **kwargs):
+@receiver(pre_save, sender=film_models.Film)
+def create_slug(sender, instance, **kwargs):
     """
-    create slug signal for Film model when a new film is created
+    create slug signal for Film model, films without a slug get one before they are written
+
+    The slug is kept when the title changes so the film urls don't break
     """
-    if created:
-        instance.slug = slugify(unidecode(instance.title) + "-" + str(instance.id))
-        instance.save()
+    if not instance.slug:
+        instance.slug = film_models.film_slug(instance.title)
+
 
 @receiver(pre_save, sender=film_models.UserFilmRating)
-def update_rating(sender, instance, **kwargs):
+def remember_rating(sender, instance, raw=False, **kwargs):
+    """
+    remember the stored value of an edited rating so update_rating can apply the difference
     """
-    update rating signal for UserFilmRating model when a new rating is created
+    instance._previous_rating = None
+    if instance.pk and not raw:
+        instance._previous_rating = (
+            film_models.UserFilmRating.objects.filter(pk=instance.pk).values_list("rating", flat=True).first()
+        )
+
 
-    It will find all ratings for the film and calculate the average rating
+@receiver(post_save, sender=film_models.UserFilmRating)
+def update_rating(sender, instance, created, raw=False, **kwargs):
     """
+    update rating signal for UserFilmRating model when a rating is created or edited
 
-    ratings = film_models.UserFilmRating.objects.filter(film = instance.film).exclude(id=instance.id)
+    It will add the rating to the film rating aggregates with a single UPDATE
+    """
+    previous = getattr(instance, "_previous_rating", None)
+    if created:
+        film_models.Film.objects.add_ratings({instance.film_id: (instance.rating, 1)})
+    elif previous is not None and previous != instance.rating:
+        film_models.Film.objects.add_ratings({instance.film_id: (instance.rating - previous, 0)})
+    else:
+        return
+
+    film_cache.bump_film_stats([instance.film_id])
+    film_cache.refresh_home_snapshots([instance.film_id])
+    if not raw:
+        film_leaderboards.refresh([instance.film_id], ("rating",))
 
-    film = film_models.Film.objects.get(id=instance.film.id)
-    film.rating = round(((film.rating + instance.rating) / (len(ratings) + 1)), 1)
-    film.save()
+
+@receiver(post_delete, sender=film_models.UserFilmRating)
+def remove_rating(sender, instance, **kwargs):
+    """
+    remove a deleted rating from the film rating aggregates
+    """
+    film_models.Film.objects.add_ratings({instance.film_id: (-instance.rating, -1)})
+    film_cache.bump_film_stats([instance.film_id])
+    film = film_models.Film.objects.filter(pk=instance.film_id).first()
+    if film is not None:
+        film_cache.refresh_home_snapshot(film)
+        film_leaderboards.refresh([instance.film_id], ("rating",))
 
 
 @receiver(post_save, sender=film_models.UserFilmVisualization)
@@ -34,8 +72,169 @@ def update_visualizations(sender, instance, created, **kwargs):
     """
     update visualizations signal for UserFilmVisualization model when a new visualization is created
 
-    It will find all visualizations for the film and update the visualizations counter
+    The increment goes through the write-behind buffer once the visualization is committed
     """
     if created:
-        instance.film.visualizations += 1
-        instance.film.save()
\ No newline at end of file
+        film_id = instance.film_id
+        transaction.on_commit(lambda: film_counters.visualizations.increment(film_id))
+
+
+@receiver(post_delete, sender=film_models.UserFilmVisualization)
+def remove_visualization(sender, instance, **kwargs):
+    """
+    remove a deleted visualization from the film visualizations counter
+    """
+    film_id = instance.film_id
+    transaction.on_commit(lambda: film_counters.visualizations.increment(film_id, -1))
+
+
+@receiver(post_save, sender=film_models.Film)
+@receiver(post_delete, sender=film_models.Film)
+def invalidate_home_snapshot(sender, instance, **kwargs):
+    """
+    invalidate the home snapshot when a film is created, edited or deleted
+
+    Rating and visualizations updates don't save the film, they refresh the snapshot incrementally
+    """
+    film_cache.invalidate_home_snapshot()
+
+
+@receiver(m2m_changed, sender=film_models.Film.genre.through)
+@receiver(post_save, sender=film_models.Genre)
+@receiver(post_save, sender=film_models.FilmType)
+def invalidate_home_snapshot_names(sender, **kwargs):
+    """
+    invalidate the home snapshot when the genres or film type names shown on it change
+    """
+    film_cache.invalidate_home_snapshot()
+
+
+@receiver(post_save, sender=film_models.Film)
+@receiver(post_delete, sender=film_models.Film)
+@receiver(m2m_changed, sender=film_models.Film.genre.through)
+@receiver(post_save, sender=film_models.Genre)
+@receiver(post_delete, sender=film_models.Genre)
+@receiver(post_save, sender=film_models.FilmType)
+@receiver(post_delete, sender=film_models.FilmType)
+def bump_catalog_version(sender, action=None, **kwargs):
+    """
+    bump the catalog version when films, genres or film types change
+
+    Rating and visualizations updates don't change the catalog version
+    """
+    if action is not None and not action.startswith("post_"):
+        return
+    film_cache.bump_catalog_version()
+
+
+@receiver(post_save, sender=film_models.Film)
+def index_film_title(sender, instance, **kwargs):
+    """
+    add or update the film title on the search index
+    """
+    film_search.get_backend().index([instance])
+
+
+@receiver(post_delete, sender=film_models.Film)
+def remove_film_title(sender, instance, **kwargs):
+    """
+    remove the film title from the search index
+    """
+    film_search.get_backend().remove([instance.pk])
+
+
+@receiver(post_save, sender=film_models.Film)
+def place_film_on_leaderboards(sender, instance, raw=False, **kwargs):
+    """
+    place a new or edited film on the leaderboards of its film type, its genres are placed when they are added
+
+    Films loaded from fixtures are skipped with their genres, the rebuild_leaderboards command places them once the fixtures are loaded
+    """
+    if raw:
+        instance._loaded_raw = True
+        return
+    film_leaderboards.refresh([instance.pk])
+
+
+@receiver(pre_delete, sender=film_models.Film)
+def remember_leaderboards(sender, instance, **kwargs):
+    """
+    remember the leaderboards listing a film, its entries are deleted with it
+    """
+    instance._leaderboards = film_leaderboards.boards_listing([instance.pk])
+
+
+@receiver(post_delete, sender=film_models.Film)
+def rebuild_leaderboards(sender, instance, **kwargs):
+    """
+    rebuild the leaderboards a deleted film was listed on, another film takes its row
+    """
+    film_leaderboards.remove_film(instance.pk, getattr(instance, "_leaderboards", ()))
+
+
+@receiver(post_delete, sender=film_models.Genre)
+@receiver(post_delete, sender=film_models.FilmType)
+def drop_leaderboards(sender, instance, **kwargs):
+    """
+    remove the leaderboards of a deleted genre or film type
+    """
+    scope = film_models.LeaderboardEntry.GENRE if sender is film_models.Genre else film_models.LeaderboardEntry.FILM_TYPE
+    film_leaderboards.drop_scope(scope, instance.pk)
+
+
+@receiver(m2m_changed, sender=film_models.Film.genre.through)
+def update_genre_mask(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    recompute the genre mask and the genre leaderboards of the films whose genres changed
+
+    When the films of a genre are cleared the film ids are only known before the clear
+    """
+    if reverse and action == "pre_clear":
+        instance._cleared_film_ids = list(instance.film_set.values_list("pk", flat=True))
+        return
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+
+    if not reverse:
+        film_ids = [instance.pk]
+    elif action == "post_clear":
+        film_ids = getattr(instance, "_cleared_film_ids", [])
+    else:
+        film_ids = pk_set
+    film_models.Film.objects.filter(pk__in=film_ids).refresh_genre_masks()
+    if reverse or not getattr(instance, "_loaded_raw", False):
+        film_leaderboards.refresh(film_ids)
+
+
+@receiver(post_save, sender=film_models.UserFilmVisualization)
+@receiver(post_save, sender=film_models.UserFilmRating)
+def add_user_activity(sender, instance, created, **kwargs):
+    """
+    add a new visualization or rating to the user activity cache
+    """
+    if created:
+        kind = "watched" if sender is film_models.UserFilmVisualization else "rated"
+        versions = film_cache.bump_user_version(instance.user_id)
+        film_activity.user_activity.add(instance.user_id, kind, [instance.film_id], versions)
+
+
+@receiver(post_save, sender=film_models.UserFilmVisualization)
+@receiver(post_save, sender=film_models.UserFilmRating)
+def count_activity(sender, instance, created, **kwargs):
+    """
+    count a new visualization or rating on the metrics once it is committed
+    """
+    if created:
+        kind = "watched" if sender is film_models.UserFilmVisualization else "rated"
+        transaction.on_commit(lambda: film_metrics.activity.inc(kind))
+
+
+@receiver(post_delete, sender=film_models.UserFilmVisualization)
+@receiver(post_delete, sender=film_models.UserFilmRating)
+def remove_user_activity(sender, instance, **kwargs):
+    """
+    remove a deleted visualization or rating from the user activity cache
+    """
+    kind = "watched" if sender is film_models.UserFilmVisualization else "rated"
+    versions = film_cache.bump_user_version(instance.user_id)
+    film_activity.user_activity.remove(instance.user_id, kind, [instance.film_id], versions)
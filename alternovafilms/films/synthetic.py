@@ -0,0 +1,236 @@
+"""
+Deterministic synthetic catalogs for the benchmarks
+
+The same seed always produces the same films, users, ratings and
+visualizations, so two benchmark runs on different commits measure the same
+data. Films are drawn in blocks of BLOCK_SIZE with a random generator seeded
+by the block number, growing a catalog from 10000 to 100000 films gives the
+same films as generating 100000 at once.
+
+Genres and film types follow GENRE_WEIGHTS and FILM_TYPE_WEIGHTS, and the
+activity is skewed towards a few popular films like on a real catalog.
+"""
+
+import math
+import random
+from array import array
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.utils.text import slugify
+import films.models as film_models
+import films.search as film_search
+import films.leaderboards as film_leaderboards
+
+BLOCK_SIZE = 10000
+
+# relative frequency of the genres, based on the share of each genre on public film catalogs
+GENRE_WEIGHTS = {
+    "Drama": 30, "Comedy": 20, "Documentary": 12, "Action": 10, "Thriller": 9, "Romance": 8,
+    "Crime": 7, "Horror": 7, "Adventure": 5, "Family": 4, "Mystery": 4, "Sci-Fi": 4,
+    "Fantasy": 3, "Biography": 3, "Animation": 3, "Music": 2, "History": 2, "Reality-TV": 2,
+    "War": 2, "Short": 2, "Sport": 2, "Talk-Show": 1, "Musical": 1, "Game-Show": 1,
+    "News": 1, "Western": 1, "Adult": 1, "Film-Noir": 1,
+}
+
+FILM_TYPE_WEIGHTS = {"movie": 75, "series": 25}
+
+# number of genres of a film -> weight
+GENRE_COUNT_WEIGHTS = {1: 40, 2: 35, 3: 25}
+
+TITLE_WORDS = (
+    "the", "last", "night", "love", "dark", "city", "man", "woman", "story", "house", "blood", "war",
+    "lost", "world", "time", "king", "dead", "girl", "life", "secret", "black", "road", "star", "home",
+    "summer", "winter", "river", "fire", "dream", "game", "heart", "shadow", "return", "island", "killer",
+    "family", "american", "little", "big", "new", "red", "moon", "sea", "ghost", "light", "journey",
+)
+
+USERNAME = "synthetic-{}"
+
+
+class SyntheticCatalog:
+    """
+    Generator of deterministic synthetic catalogs
+
+    attributes:
+        seed (int): Seed of every random draw
+        chunk_size (int): Rows written per bulk insert
+        skew (float): Popularity skew of the activity, a film at position p of a catalog of n
+            films is drawn as n * u ** (1 + skew) with u uniform, 0 is no skew
+    """
+
+    def __init__(self, seed=0, chunk_size=BLOCK_SIZE, skew=1.1):
+        self.seed = seed
+        self.chunk_size = chunk_size
+        self.skew = skew
+
+    def rng(self, *scope):
+        return random.Random(":".join(str(part) for part in (self.seed,) + scope))
+
+    def ensure_catalog_types(self):
+        """
+        create the genres and film types the weights refer to, the existing ones are kept
+
+        Returns:
+            tuple: genre id -> weight and film type id -> weight
+        """
+        for model, weights in ((film_models.Genre, GENRE_WEIGHTS), (film_models.FilmType, FILM_TYPE_WEIGHTS)):
+            existing = set(model.objects.filter(name__in=weights).values_list("name", flat=True))
+            model.objects.bulk_create([model(name=name) for name in weights if name not in existing])
+
+        genres = dict(film_models.Genre.objects.filter(name__in=GENRE_WEIGHTS).values_list("pk", "name"))
+        film_types = dict(film_models.FilmType.objects.filter(name__in=FILM_TYPE_WEIGHTS).values_list("pk", "name"))
+        return (
+            {pk: GENRE_WEIGHTS[name] for pk, name in sorted(genres.items())},
+            {pk: FILM_TYPE_WEIGHTS[name] for pk, name in sorted(film_types.items())},
+        )
+
+    def iter_films(self, start, stop, genres, film_types):
+        """
+        yield the synthetic films numbered from start to stop as (title, film type id, genre ids)
+
+        Every block is drawn from its first film, so a film always gets the same values.
+        """
+        genre_ids, genre_weights = list(genres), list(genres.values())
+        type_ids, type_weights = list(film_types), list(film_types.values())
+        counts, count_weights = list(GENRE_COUNT_WEIGHTS), list(GENRE_COUNT_WEIGHTS.values())
+
+        for block in range(start // BLOCK_SIZE, math.ceil(stop / BLOCK_SIZE)):
+            rng = self.rng("films", block)
+            for number in range(block * BLOCK_SIZE, min((block + 1) * BLOCK_SIZE, stop)):
+                words = rng.choices(TITLE_WORDS, k=rng.randint(1, 4))
+                film_type = rng.choices(type_ids, type_weights)[0]
+                film_genres = set(rng.choices(genre_ids, genre_weights, k=rng.choices(counts, count_weights)[0]))
+                if number >= start:
+                    yield f"{' '.join(words).capitalize()} {number}", film_type, sorted(film_genres)
+
+    def grow(self, size, stdout=None):
+        """
+        add synthetic films until the catalog has size films
+
+        Returns:
+            int: Number of films of the catalog
+        """
+        genres, film_types = self.ensure_catalog_types()
+        total = film_models.Film.objects.count()
+        if total >= size:
+            return total
+
+        search = film_search.get_backend()
+        chunk = []
+        for film in self.iter_films(total, size, genres, film_types):
+            chunk.append(film)
+            if len(chunk) >= self.chunk_size:
+                self.write_films(chunk, search)
+                chunk = []
+                if stdout is not None:
+                    stdout.write(f"{film_models.Film.objects.count()} films")
+        self.write_films(chunk, search)
+        return size
+
+    def write_films(self, rows, search):
+        if not rows:
+            return
+        Through = film_models.Film.genre.through
+        with transaction.atomic():
+            films = film_models.Film.objects.bulk_create(
+                film_models.Film(
+                    title=title, film_type_id=film_type, genre_mask=film_models.genre_mask(genre_ids) or 0,
+                    # titles end with the film number, so the slug is unique without a random suffix
+                    slug=slugify(title),
+                )
+                for title, film_type, genre_ids in rows
+            )
+            Through.objects.bulk_create(
+                Through(film_id=film.pk, genre_id=genre_id) for film, (_, _, genre_ids) in zip(films, rows) for genre_id in genre_ids
+            )
+            search.index(films)
+
+    def ensure_users(self, count, username=USERNAME):
+        """
+        create the synthetic users up to count
+
+        Args:
+            count (int): Number of users
+            username (str): Username format, the user number is the only field
+
+        Returns:
+            array: Ids of the synthetic users in creation order
+        """
+        User = get_user_model()
+        existing = User.objects.filter(username__startswith=username.format("")).count()
+        for start in range(existing, count, self.chunk_size):
+            User.objects.bulk_create(
+                User(username=username.format(number), password="!")
+                for number in range(start, min(start + self.chunk_size, count))
+            )
+        users = User.objects.filter(username__startswith=username.format("")).order_by("pk")
+        return array("q", users.values_list("pk", flat=True)[:count])
+
+    def popular_films(self, rng, film_ids, size):
+        """
+        draw size distinct films, the first films of the catalog are much more likely
+
+        When the popular films are exhausted the rest are drawn uniformly.
+        """
+        size = min(size, len(film_ids))
+        films = set()
+        for _ in range(size * 20):
+            if len(films) >= size:
+                return films
+            films.add(film_ids[min(int(len(film_ids) * rng.random() ** (1 + self.skew)), len(film_ids) - 1)])
+        while len(films) < size:
+            films.add(film_ids[rng.randrange(len(film_ids))])
+        return films
+
+    def add_activity(self, users, ratings_per_user, visualizations_per_user, stdout=None):
+        """
+        give every synthetic user ratings and visualizations of distinct popular films and update the films aggregates and leaderboards
+
+        The activity of a user is drawn from its own generator, so the rows
+        only depend on the seed, the user number and the catalog.
+
+        Args:
+            users (int): Number of synthetic users
+            ratings_per_user (int): Ratings of each user
+            visualizations_per_user (int): Visualizations of each user
+
+        Returns:
+            tuple: Number of ratings and visualizations sent, rows already stored are skipped
+        """
+        film_ids = array("q", film_models.Film.objects.order_by("pk").values_list("pk", flat=True))
+        if not film_ids:
+            return 0, 0
+        user_ids = self.ensure_users(users)
+        first_visualization = film_models.UserFilmVisualization.objects.order_by("-pk").values_list("pk", flat=True).first() or 0
+
+        ratings, visualizations = [], []
+        written = [0, 0]
+        for number, user_id in enumerate(user_ids):
+            rng = self.rng("activity", number)
+            for kind, size, rows in (("rating", ratings_per_user, ratings), ("visualization", visualizations_per_user, visualizations)):
+                for film_id in sorted(self.popular_films(rng, film_ids, size)):
+                    if kind == "rating":
+                        rows.append(film_models.UserFilmRating(user_id=user_id, film_id=film_id, rating=rng.randint(0, 20) / 2))
+                    else:
+                        rows.append(film_models.UserFilmVisualization(user_id=user_id, film_id=film_id))
+
+            if len(ratings) + len(visualizations) >= self.chunk_size:
+                written = self.write_activity(ratings, visualizations, written)
+                ratings, visualizations = [], []
+                if stdout is not None:
+                    stdout.write(f"{written[0]} ratings, {written[1]} visualizations")
+        written = self.write_activity(ratings, visualizations, written)
+
+        with transaction.atomic():
+            film_models.Film.objects.recompute_ratings()
+            film_models.Film.objects.count_visualizations(
+                film_models.UserFilmVisualization.objects.filter(pk__gt=first_visualization)
+            )
+            film_leaderboards.rebuild()
+        return tuple(written)
+
+    def write_activity(self, ratings, visualizations, written):
+        with transaction.atomic():
+            film_models.UserFilmRating.objects.bulk_create(ratings, ignore_conflicts=True)
+            film_models.UserFilmVisualization.objects.bulk_create(visualizations, ignore_conflicts=True)
+        return [written[0] + len(ratings), written[1] + len(visualizations)]
@@ -1,6 +1,6 @@
 from django import template
 import re
-import films.models as film_models
+from films.activity import FilmActivityLoader
 
 register = template.Library()
 
@@ -15,19 +15,17 @@ def ordering_value(ordering):
     else:
         return "Sorted by: Default (Title)"
     
-def watched(film_id, user_id):
-    try:
-        film = film_models.UserFilmVisualization.objects.get(film__id=film_id, user__id=user_id)
-    except film_models.UserFilmVisualization.DoesNotExist:
-        return False
-    return True
-
-def rated(film_id, user_id):
-    try:
-        film = film_models.UserFilmRating.objects.get(film__id=film_id, user__id=user_id)
-    except film_models.UserFilmRating.DoesNotExist:
-        return False
-    return True
+def watched(film_id, request):
+    """
+    check if the user of the request watched the film, read from the request activity loader
+    """
+    return FilmActivityLoader.for_request(request).watched(film_id)
+
+def rated(film_id, request):
+    """
+    check if the user of the request rated the film, read from the request activity loader
+    """
+    return FilmActivityLoader.for_request(request).rated(film_id)
 
 def ordered_page_number(page_number, ordering):
     page_number = str(page_number)
@@ -36,6 +34,12 @@ def ordered_page_number(page_number, ordering):
     
     return f"?page={page_number}"
 
+def ordered_cursor(cursor, ordering):
+    if ordering:
+        return f"?ordering={ordering}&cursor={cursor}"
+
+    return f"?cursor={cursor}"
+
 
     
 
@@ -66,4 +70,5 @@ register.filter('rated', rated)
 register.filter('loop_by_number', loop_by_number)
 register.filter('ordering_value', ordering_value)
 register.filter('ordered_page_number', ordered_page_number)
+register.filter('ordered_cursor', ordered_cursor)
 register.filter('filtered_page_number', filtered_page_number)
\ No newline at end of file
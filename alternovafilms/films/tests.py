@@ -1,10 +1,74 @@
+import io
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+from base64 import urlsafe_b64encode
+from pathlib import Path
+from unittest import mock
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, connection
+from django.db.migrations.executor import MigrationExecutor
+from django.http import HttpResponse
+from django.test import AsyncClient, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse, resolve
+from django.utils.http import http_date
+
 from rest_framework import status
-from rest_framework.test import APIClient, APITestCase
-from django.contrib.auth.models import User
 from rest_framework.authtoken.models import Token
-from django.test import TestCase
-import json
+from rest_framework.test import APIClient, APITestCase
+
+import alternovafilms.db as project_db
+import alternovafilms.routers as project_routers
+import films.activity as film_activity
+import films.cache as film_cache
+import films.counters as film_counters
+import films.leaderboards as film_leaderboards
+import films.metrics as film_metrics
+import films.models as film_models
+import films.search as film_search
+import films.synthetic as film_synthetic
+from films.instrumentation import QueryBudgetMixin
+from films.utils import CachedCountMixin, CachedCountPaginator
+
+
+class FilmsTestCase(APITestCase):
+    """
+    Base test case starting with empty caches and a logged in user
+
+    attributes:
+        login (bool): Create the test user and log it in
+    """
+
+    login = True
+
+    def setUp(self) -> None:
+        cache.clear()
+        film_activity.user_activity.clear()
+        if self.login:
+            self.user = User.objects.create_user(username='test', password='password')
+            self.client.force_login(self.user)
+
+    def create_films(self, count, film_type=None, genres=(), **fields):
+        """
+        create count films titled Film <number> with the film type, genres and fields
+        """
+        films = []
+        for number in range(count):
+            film = film_models.Film.objects.create(title=f'Film {number}', film_type=film_type, **fields)
+            film.genre.add(*genres)
+            films.append(film)
+        return films
+
+
 class FilmListTest(APITestCase):
 
     url = reverse('films')
@@ -38,4 +102,1396 @@ class FilmListTest(APITestCase):
         pass
 
     def error_no_authenticated(self):
-        pass
\ No newline at end of file
+        pass
+
+
+class HomeSnapshotTest(FilmsTestCase):
+
+    url = reverse('home')
+    login = False
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.user = User.objects.create_user(username='test', email='test@test.com', password='password')
+        self.film_type = film_models.FilmType.objects.create(name='movie')
+        self.genre = film_models.Genre.objects.create(name='drama')
+        self.films = []
+        for number in range(6):
+            film = film_models.Film.objects.create(title=f'Film {number}', film_type=self.film_type, rating=number)
+            film.genre.add(self.genre)
+            self.films.append(film)
+
+    def test_home_uses_snapshot(self):
+        """
+        Ensure a warm home request only queries the random film id.
+        """
+        self.client.get(self.url, HTTP_ACCEPT='application/json')
+        film_cache.get_films([film.pk for film in self.films])
+        # id bounds and the random film id, its body comes from the films cache
+        with self.assertNumQueries(3):
+            response = self.client.get(self.url, HTTP_ACCEPT='application/json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([film['title'] for film in response.data['top_films']], ['Film 5', 'Film 4', 'Film 3', 'Film 2', 'Film 1'])
+
+    def test_rating_refreshes_snapshot(self):
+        """
+        Ensure a new rating moves the film into the cached top films.
+        """
+        self.client.get(self.url, HTTP_ACCEPT='application/json')
+        film_models.UserFilmRating.objects.create(user=self.user, film=self.films[0], rating=10)
+
+        response = self.client.get(self.url, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.data['top_films'][0]['pk'], self.films[0].pk)
+        self.assertEqual(response.data['top_films'][0]['rating'], 10)
+
+
+class ListQueryCountTest(FilmsTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        film_type = film_models.FilmType.objects.create(name='movie')
+        genres = [film_models.Genre.objects.create(name=name) for name in ('drama', 'comedy')]
+        self.create_films(12, film_type, genres)
+
+    def count_queries(self, url, **params):
+        cache.clear()
+        film_activity.user_activity.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, params, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(context.captured_queries)
+
+    def test_constant_queries(self):
+        """
+        Ensure the list endpoints cost the same number of queries whatever the page size.
+        """
+        endpoints = [
+            (reverse('films'), {}),
+            (reverse('films'), {'ordering': '-rating'}),
+            (reverse('search_film'), {'title': 'film', 'genres': 'drama,comedy', 'film_type': 'movie'}),
+        ]
+        for url, params in endpoints:
+            self.assertEqual(self.count_queries(url, page_size=1, **params), self.count_queries(url, page_size=9, **params))
+
+
+class InstrumentationTest(QueryBudgetMixin, FilmsTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        film_type = film_models.FilmType.objects.create(name='movie')
+        genre = film_models.Genre.objects.create(name='drama')
+        self.films = self.create_films(12, film_type, [genre])
+
+    def test_query_budgets(self):
+        """
+        Ensure the read endpoints stay within their query budgets with cold caches, sessions and authentication included.
+        """
+        budgets = [
+            (11, reverse('home')),
+            (6, reverse('films')),
+            (5, reverse('films') + '?pagination=cursor&ordering=-rating'),
+            (5, reverse('film_detail', kwargs={'slug': self.films[0].slug})),
+            (6, reverse('random_film')),
+            (9, reverse('search_film') + '?title=film&genres=drama'),
+        ]
+        for budget, path in budgets:
+            with self.subTest(path=path):
+                cache.clear()
+                response = self.assertQueryBudget(budget, path, HTTP_ACCEPT='application/json')
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_server_timing(self):
+        """
+        Ensure measured requests get a Server-Timing header and a log line, and the rest get nothing.
+        """
+        url = reverse('films')
+        with override_settings(FILMS_INSTRUMENTATION_SAMPLE_RATE=1, FILMS_INSTRUMENTATION_LOG=True):
+            with self.assertLogs('films.instrumentation') as logs:
+                response = self.client.get(url, HTTP_ACCEPT='application/json')
+        self.assertRegex(response['Server-Timing'],
+                         r'^sql;dur=[0-9.]+;desc="\d+ queries", serialize;dur=[0-9.]+, render;dur=[0-9.]+, total;dur=[0-9.]+$')
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual((line['view'], line['status'], line['queries']), ('films', 200, response.instrumentation.queries))
+        self.assertGreater(line['serialize_ms'], 0)
+        self.assertGreater(line['render_ms'], 0)
+
+        with override_settings(FILMS_INSTRUMENTATION_SAMPLE_RATE=0):
+            response = self.client.get(url, HTTP_ACCEPT='application/json')
+        self.assertFalse(response.has_header('Server-Timing'))
+
+
+class MetricsTest(FilmsTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        film_metrics.registry.clear()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        settings = override_settings(FILMS_METRICS_DIR=self.directory.name, FILMS_METRICS_WRITE_INTERVAL=0)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.addCleanup(film_metrics.registry.clear)
+        self.films = self.create_films(3, film_models.FilmType.objects.create(name='movie'))
+
+    def test_endpoint(self):
+        """
+        Ensure the endpoint counts the requests per view and the stored ratings and visualizations.
+        """
+        self.client.get(reverse('films'), HTTP_ACCEPT='application/json')
+        self.client.get(reverse('films'), HTTP_ACCEPT='application/json')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('film_rate'), {'film': self.films[0].pk, 'user': self.user.pk, 'rating': 7}, format='json')
+        self.client.post(reverse('film_visualize_bulk'), [{'film': film.pk} for film in self.films], format='json')
+
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        text = response.content.decode()
+        self.assertIn('films_requests_total{view="films",method="GET",status="200"} 2', text)
+        self.assertIn('films_request_duration_seconds_count{view="films"} 2', text)
+        self.assertIn('films_request_duration_seconds_bucket{view="films",le="+Inf"} 2', text)
+        self.assertIn('films_activity_total{kind="rated"} 1', text)
+        self.assertIn('films_activity_total{kind="watched"} 3', text)
+        self.assertIn('# TYPE films_request_duration_seconds histogram', text)
+
+    async def test_async_requests_write_off_the_event_loop(self):
+        """
+        Ensure the snapshot of an async request is written in a thread instead of the event loop.
+        """
+        threads = []
+        write = film_metrics.registry.write
+
+        def record_thread():
+            threads.append(threading.get_ident())
+            write()
+
+        client = AsyncClient()
+        await sync_to_async(client.force_login)(self.user)
+        with mock.patch.object(film_metrics.registry, 'write', side_effect=record_thread):
+            response = await client.get(reverse('async_films'), ACCEPT='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(threads)
+        self.assertNotIn(threading.get_ident(), threads)
+        self.assertTrue(os.path.exists(os.path.join(self.directory.name, f'{os.getpid()}.json')))
+
+    def test_endpoint_access(self):
+        """
+        Ensure only staff users and scrapers with the metrics token read the metrics.
+        """
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, status.HTTP_403_FORBIDDEN)
+        self.client.logout()
+        with override_settings(FILMS_METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, status.HTTP_403_FORBIDDEN)
+            response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong')
+            self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+            response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_histogram_buckets(self):
+        """
+        Ensure the histogram buckets are cumulative and the values on a bound fall in its bucket.
+        """
+        registry = film_metrics.Registry()
+        histogram = registry.histogram('latency', 'Latency', ('view',), buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value, 'home')
+        with override_settings(FILMS_METRICS_DIR=None):
+            text = registry.render()
+        self.assertIn('latency_bucket{view="home",le="0.1"} 2', text)
+        self.assertIn('latency_bucket{view="home",le="1.0"} 3', text)
+        self.assertIn('latency_bucket{view="home",le="+Inf"} 4', text)
+        self.assertIn('latency_sum{view="home"} 3.65', text)
+
+    def test_aggregates_processes(self):
+        """
+        Ensure the snapshots of live processes are added and the ones of dead processes are archived.
+        """
+        film_metrics.activity.inc('rated', amount=2)
+        snapshot = film_metrics.registry.states()
+        for pid in (os.getppid(), 2 ** 22 + 1):
+            with open(os.path.join(self.directory.name, f'{pid}.json'), 'w') as stream:
+                json.dump(snapshot, stream)
+
+        with mock.patch.object(film_metrics, 'alive', side_effect=lambda pid: pid == os.getppid()):
+            self.assertIn('films_activity_total{kind="rated"} 6', film_metrics.registry.render())
+            self.assertFalse(os.path.exists(os.path.join(self.directory.name, f'{2 ** 22 + 1}.json')))
+            self.assertTrue(os.path.exists(os.path.join(self.directory.name, 'archive.json')))
+            # the archived values are counted once
+            self.assertIn('films_activity_total{kind="rated"} 6', film_metrics.registry.render())
+
+
+class FilmActivityBadgesTest(FilmsTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.films = self.create_films(12, film_models.FilmType.objects.create(name='movie'))
+        film_models.UserFilmVisualization.objects.create(user=self.user, film=self.films[0])
+        film_models.UserFilmRating.objects.create(user=self.user, film=self.films[0], rating=8)
+
+    def count_queries(self, url, **params):
+        cache.clear()
+        film_activity.user_activity.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, params, HTTP_ACCEPT='text/html')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertContains(response, 'Viewed')
+        self.assertContains(response, 'Rated')
+        return len(context.captured_queries)
+
+    def test_badges_constant_queries(self):
+        """
+        Ensure the watched and rated badges cost the same number of queries whatever the page size.
+        """
+        endpoints = [
+            (reverse('films'), {}),
+            (reverse('search_film'), {'title': 'film'}),
+        ]
+        for url, params in endpoints:
+            self.assertEqual(self.count_queries(url, page_size=1, **params), self.count_queries(url, page_size=9, **params))
+
+
+class ConditionalGetTest(FilmsTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.film = film_models.Film.objects.create(title='Heat')
+
+    def assertNotModified(self, url, etag):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, HTTP_ACCEPT='application/json', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertFalse([query for query in context.captured_queries if 'films_' in query['sql']])
+
+    def test_not_modified(self):
+        """
+        Ensure unchanged lists and details return 304 and changes give a new ETag.
+        """
+        for url in (reverse('films'), reverse('search_film') + '?title=heat', reverse('film_detail', args=[self.film.slug])):
+            response = self.client.get(url, HTTP_ACCEPT='application/json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            etag = response['ETag']
+            self.assertNotModified(url, etag)
+
+            film_models.UserFilmRating.objects.filter(user=self.user).delete()
+            film_models.UserFilmRating.objects.create(user=self.user, film=self.film, rating=7)
+            response = self.client.get(url, HTTP_ACCEPT='application/json', HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotEqual(response['ETag'], etag)
+
+    def test_if_modified_since_is_ignored(self):
+        """
+        Ensure a change in the same second as If-Modified-Since is not answered with 304.
+        """
+        url = reverse('film_detail', args=[self.film.slug])
+        response = self.client.get(url, HTTP_ACCEPT='application/json')
+        self.assertNotIn('Last-Modified', response)
+
+        since = http_date()
+        film_models.UserFilmRating.objects.create(user=self.user, film=self.film, rating=7)
+        response = self.client.get(url, HTTP_ACCEPT='application/json', HTTP_IF_MODIFIED_SINCE=since)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['film']['rating'], 7)
+
+
+class FilmBodyCacheTest(FilmsTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.films = self.create_films(4, genres=[film_models.Genre.objects.create(name='drama')])
+
+    def test_list_from_cache(self):
+        """
+        Ensure warm list pages only query the page ids and changed films are serialized again.
+        """
+        self.client.get(reverse('films'), HTTP_ACCEPT='application/json')
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('films'), {'ordering': '-rating'}, HTTP_ACCEPT='application/json')
+        self.assertFalse([query for query in context.captured_queries if 'films_genre' in query['sql']])
+        self.assertEqual(response.data['results'][0]['genre'], ['Drama'])
+
+        film_models.UserFilmRating.objects.create(user=self.user, film=self.films[2], rating=9)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('films'), {'ordering': '-rating'}, HTTP_ACCEPT='application/json')
+        genre_queries = [query['sql'] for query in context.captured_queries if 'films_genre' in query['sql']]
+        self.assertEqual(len(genre_queries), 1)
+        self.assertIn(f'IN ({self.films[2].pk})', genre_queries[0])
+        self.assertEqual((response.data['results'][0]['pk'], response.data['results'][0]['rating']), (self.films[2].pk, 9))
+
+
+class CountCacheTest(FilmsTestCase):
+
+    url = reverse('search_film')
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.film_type = film_models.FilmType.objects.create(name='movie')
+        self.create_films(12, self.film_type)
+
+    def search(self, **params):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.url, params, HTTP_ACCEPT='application/json')
+        counts = [query['sql'] for query in context.captured_queries if 'COUNT(' in query['sql']]
+        return response.data, len(counts)
+
+    def test_count_is_cached(self):
+        """
+        Ensure equivalent filters share the cached count until the catalog changes.
+        """
+        data, counts = self.search(film_type='movie')
+        self.assertEqual((data['total_results'], counts), (12, 1))
+        data, counts = self.search(film_type='MOVIE')
+        self.assertEqual((data['total_results'], counts), (12, 0))
+
+        film_models.Film.objects.create(title='Film 12', film_type=self.film_type)
+        data, counts = self.search(film_type='movie')
+        self.assertEqual((data['total_results'], counts), (13, 1))
+
+    def test_estimated_count(self):
+        """
+        Ensure the estimated mode stops counting at the threshold and counts exactly without an estimate.
+        """
+        with mock.patch.object(CachedCountPaginator, 'estimate_threshold', 5):
+            data, _ = self.search(film_type='movie', count='estimated')
+            self.assertFalse(data['estimated'])
+            self.assertEqual(data['total_results'], 12)
+
+        cache.clear()
+        with mock.patch.object(CachedCountPaginator, 'estimate_threshold', 5), \
+                mock.patch.object(CachedCountPaginator, 'estimate_total', return_value=10):
+            data, _ = self.search(film_type='movie', count='estimated')
+            self.assertTrue(data['estimated'])
+            self.assertEqual(data['total_results'], 10)
+            data, _ = self.search(film_type='movie', count='estimated', page=2)
+            self.assertEqual(len(data['results']['results']), 3)
+
+            data, _ = self.search(title='Film 1', count='estimated')
+            self.assertFalse(data['estimated'])
+            self.assertEqual(data['total_results'], 3)
+
+    def test_default_count_signature(self):
+        """
+        Ensure the default signature tells querysets apart by their query.
+        """
+        paginator = CachedCountMixin()
+        films = film_models.Film.objects.all()
+        signature = paginator.get_count_signature(None, films.filter(title='Film 1'))
+        self.assertEqual(signature, paginator.get_count_signature(None, films.filter(title='Film 1')))
+        self.assertNotEqual(signature, paginator.get_count_signature(None, films.filter(title='Film 2')))
+        self.assertEqual(paginator.get_count_signature(None, films.filter(pk__in=[])), 'empty')
+
+
+class TitleSearchTest(FilmsTestCase):
+
+    url = reverse('search_film')
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.amelie = film_models.Film.objects.create(title='Le Fabuleux Destin d\'Amélie Poulain', rating=8)
+        self.night = film_models.Film.objects.create(title='Night of the Living Dead', rating=9)
+        self.living = film_models.Film.objects.create(title='The Living Daylights', rating=6)
+
+    def search(self, title):
+        response = self.client.get(self.url, {'title': title}, HTTP_ACCEPT='application/json')
+        return [film['pk'] for film in response.data['results']['results']] if 'results' in response.data else []
+
+    def test_accent_insensitive(self):
+        """
+        Ensure titles match without accents and by word prefix.
+        """
+        self.assertEqual(self.search('amelie'), [self.amelie.pk])
+        self.assertEqual(self.search('AMÉL poul'), [self.amelie.pk])
+
+    def test_index_follows_changes(self):
+        """
+        Ensure the index follows title edits and deletes.
+        """
+        self.assertEqual(set(self.search('living')), {self.night.pk, self.living.pk})
+        self.living.title = 'Licence to Kill'
+        self.living.save()
+        self.night.delete()
+        self.assertEqual(self.search('living'), [])
+        self.assertEqual(self.search('licence'), [self.living.pk])
+
+    def test_match_runs_once(self):
+        """
+        Ensure a ranked search over a few thousand matches reads the index once instead of once per film.
+        """
+        films = film_models.Film.objects.bulk_create(
+            film_models.Film(title=f'Night {number}' if number % 2 else f'The Night of {number}', slug=f'night-{number}')
+            for number in range(3000)
+        )
+        backend = film_search.get_backend()
+        backend.index(films)
+        queryset = backend.filter(film_models.Film.objects.all(), 'night').order_by('search_rank', 'pk')
+
+        with self.assertNumQueries(2):
+            self.assertEqual(queryset.count(), 3001)
+            ranked = list(queryset[:9])
+        self.assertTrue(all(film.search_rank <= ranked[-1].search_rank for film in ranked))
+
+        sql, params = queryset[:9].query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = [row[-1] for row in cursor.fetchall()]
+        self.assertEqual(len([step for step in plan if 'films_film_fts' in step]), 1, plan)
+        self.assertFalse([step for step in plan if 'CORRELATED' in step], plan)
+
+
+class GenreMaskTest(FilmsTestCase):
+
+    url = reverse('search_film')
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.movie = film_models.FilmType.objects.create(name='movie')
+        self.drama, self.comedy, self.western = [film_models.Genre.objects.create(name=name) for name in ('Drama', 'Comedy', 'Western')]
+        self.both = film_models.Film.objects.create(title='Both', film_type=self.movie)
+        self.both.genre.add(self.drama, self.comedy)
+        self.drama_only = film_models.Film.objects.create(title='Drama only', film_type=self.movie)
+        self.drama_only.genre.add(self.drama)
+
+    def search(self, **params):
+        response = self.client.get(self.url, params, HTTP_ACCEPT='application/json')
+        return {film['pk'] for film in response.data['results']['results']} if 'results' in response.data else set()
+
+    def test_masks_follow_genres(self):
+        """
+        Ensure the genre mask follows additions and removals from both sides.
+        """
+        self.both.refresh_from_db()
+        self.assertEqual(self.both.genre_mask, (1 << self.drama.pk) | (1 << self.comedy.pk))
+
+        self.comedy.film_set.add(self.drama_only)
+        self.both.genre.remove(self.drama)
+        self.assertEqual(set(film_models.Film.objects.with_genres([self.drama.pk, self.comedy.pk])), {self.drama_only})
+
+        self.comedy.film_set.clear()
+        self.assertEqual(set(film_models.Film.objects.with_genres([self.comedy.pk])), set())
+
+    def test_search_all_genres(self):
+        """
+        Ensure the search returns the films with every genre, optionally of a film type.
+        """
+        self.assertEqual(self.search(genres='drama,COMEDY'), {self.both.pk})
+        self.assertEqual(self.search(genres='drama', film_type='Movie'), {self.both.pk, self.drama_only.pk})
+        self.assertEqual(self.search(genres='drama,western'), set())
+        self.assertEqual(self.search(genres='drama', film_type='series'), set())
+
+
+class RandomFilmTest(FilmsTestCase):
+
+    url = reverse('random_film')
+
+    def setUp(self) -> None:
+        super().setUp()
+        movie = film_models.FilmType.objects.create(name='movie')
+        series = film_models.FilmType.objects.create(name='series')
+        drama = film_models.Genre.objects.create(name='drama')
+        comedy = film_models.Genre.objects.create(name='comedy')
+        for number in range(10):
+            film = film_models.Film.objects.create(title=f'Film {number}', film_type=movie if number % 2 else series)
+            film.genre.add(drama if number < 5 else comedy)
+
+    def test_random_with_filters(self):
+        """
+        Ensure the random film honours the genre and film type filters.
+        """
+        for _ in range(20):
+            film = film_models.Film.objects.random(genre='Drama', film_type='movie')
+            self.assertEqual(film.film_type.name, 'movie')
+            self.assertIn('drama', [genre.name for genre in film.genre.all()])
+
+    def test_random_is_uniform_across_gaps(self):
+        """
+        Ensure a film after a gap of deleted ids is not drawn more often than the others.
+        """
+        first, last = film_models.Film.objects.order_by('pk')[0], film_models.Film.objects.order_by('-pk')[0]
+        film_models.Film.objects.exclude(pk__in=[first.pk, last.pk]).delete()
+        draws = [film_models.Film.objects.random().pk for _ in range(400)]
+        # the pivot walk picked the last film 9 times out of 10, a uniform draw is 200 +- 10
+        self.assertTrue(140 < draws.count(last.pk) < 260, draws.count(last.pk))
+
+    def test_random_falls_back_to_a_probe(self):
+        """
+        Ensure a filter every drawn id misses still returns one of the matching films without counting them.
+        """
+        with mock.patch.object(film_models.FilmQuerySet, 'RANDOM_PIVOTS', 0):
+            for _ in range(10):
+                with CaptureQueriesContext(connection) as context:
+                    film = film_models.Film.objects.random(genre='comedy', film_type='series')
+                self.assertEqual((film.film_type.name, film.genre.get().name), ('series', 'comedy'))
+                self.assertFalse([query for query in context.captured_queries if 'COUNT(' in query['sql'] or 'OFFSET' in query['sql']])
+
+            # a probe past the last matching film wraps around to the lowest id
+            last = film_models.Film.objects.order_by('-pk').first().pk
+            with mock.patch('random.randint', return_value=last):
+                film = film_models.Film.objects.random(genre='drama', film_type='series')
+            self.assertEqual(film, film_models.Film.objects.filter(genre__name='drama', film_type__name='series').order_by('pk').first())
+            film = async_to_sync(film_models.Film.objects.select_related('film_type').arandom)(film_type='series')
+            self.assertEqual(film.film_type.name, 'series')
+
+    def test_random_not_found(self):
+        """
+        Ensure a filter without films returns a 404.
+        """
+        response = self.client.get(self.url, {'genre': 'western'}, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class RatingAggregatesTest(FilmsTestCase):
+
+    url = reverse('film_rate')
+    login = False
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.users = [User.objects.create_user(username=f'test{number}', password='password') for number in range(3)]
+        self.film = film_models.Film.objects.create(title='Film')
+
+    def test_rating_aggregates(self):
+        """
+        Ensure the film rating is the average of its ratings and follows edits and deletes.
+        """
+        ratings = [film_models.UserFilmRating.objects.create(user=user, film=self.film, rating=value)
+                   for user, value in zip(self.users, [4, 7, 8])]
+        self.film.refresh_from_db()
+        self.assertEqual((self.film.rating_sum, self.film.rating_count, self.film.rating), (19, 3, 6.3))
+
+        ratings[0].rating = 10
+        ratings[0].save()
+        ratings[1].delete()
+        self.film.refresh_from_db()
+        self.assertEqual((self.film.rating_sum, self.film.rating_count, self.film.rating), (18, 2, 9))
+
+    def test_rate_view(self):
+        """
+        Ensure rating through the API updates the aggregates.
+        """
+        self.client.login(username='test0', password='password')
+        response = self.client.post(self.url, {'film': self.film.pk, 'user': self.users[0].pk, 'rating': 7})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.film.refresh_from_db()
+        self.assertEqual((self.film.rating_count, self.film.rating), (1, 7))
+
+
+@override_settings(FILMS_VISUALIZATION_FLUSH_SIZE=100, FILMS_VISUALIZATION_FLUSH_INTERVAL=0)
+class VisualizationBufferTest(FilmsTestCase):
+
+    url = reverse('film_visualize')
+    login = False
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.users = [User.objects.create_user(username=f'test{number}', password='password') for number in range(3)]
+        self.film = film_models.Film.objects.create(title='Film', visualizations=5)
+
+    def tearDown(self) -> None:
+        film_counters.visualizations.flush()
+
+    def test_visualizations_are_buffered(self):
+        """
+        Ensure visualizations are merged on responses and written on flush.
+        """
+        for user in self.users:
+            self.client.force_login(user)
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(self.url, {'film': self.film.pk, 'user': user.pk})
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        self.film.refresh_from_db()
+        self.assertEqual(self.film.visualizations, 5)
+        response = self.client.get(reverse('film_detail', args=[self.film.slug]), HTTP_ACCEPT='application/json')
+        self.assertEqual(response.data['film']['visualizations'], 8)
+
+        film_counters.visualizations.flush()
+        self.film.refresh_from_db()
+        self.assertEqual(self.film.visualizations, 8)
+
+    @override_settings(FILMS_VISUALIZATION_FLUSH_SIZE=2)
+    def test_flush_on_size(self):
+        """
+        Ensure the buffer is flushed once the flush size is reached.
+        """
+        with self.captureOnCommitCallbacks(execute=True):
+            for user in self.users[:2]:
+                film_models.UserFilmVisualization.objects.create(user=user, film=self.film)
+
+        self.film.refresh_from_db()
+        self.assertEqual(self.film.visualizations, 7)
+        self.assertEqual(film_counters.visualizations.pending(self.film.pk), 0)
+
+
+class BulkActivityTest(FilmsTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.films = self.create_films(3)
+        film_models.UserFilmRating.objects.create(user=self.user, film=self.films[0], rating=5)
+
+    def test_bulk_rate(self):
+        """
+        Ensure the bulk rating endpoint reports the status of every item.
+        """
+        items = [
+            {'film': self.films[0].pk, 'rating': 8},
+            {'film': self.films[1].pk, 'rating': 8},
+            {'film': self.films[1].pk, 'rating': 2},
+            {'film': self.films[2].pk, 'rating': 11},
+            {'film': 999, 'rating': 3},
+        ]
+        response = self.client.post(reverse('film_rate_bulk'), items, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual([item['status'] for item in response.data['results']],
+                         ['exists', 'created', 'duplicate', 'invalid', 'not_found'])
+        self.films[1].refresh_from_db()
+        self.assertEqual((self.films[1].rating_count, self.films[1].rating), (1, 8))
+
+    def test_bulk_conflict(self):
+        """
+        Ensure a batch that conflicts again after reading the stored pairs gets a 409.
+        """
+        items = [{'film': self.films[1].pk, 'rating': 8}]
+        with mock.patch.object(film_models.UserFilmRating.objects, 'bulk_create', side_effect=IntegrityError):
+            response = self.client.post(reverse('film_rate_bulk'), items, format='json')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertFalse(film_models.UserFilmRating.objects.filter(film=self.films[1]).exists())
+
+    def test_bulk_visualize(self):
+        """
+        Ensure the bulk visualization endpoint stores and counts every new film.
+        """
+        items = [{'film': film.pk} for film in self.films]
+        response = self.client.post(reverse('film_visualize_bulk'), items, format='json')
+
+        self.assertEqual(response.data['created'], 3)
+        self.assertEqual(film_models.UserFilmVisualization.objects.filter(user=self.user).count(), 3)
+        self.assertEqual(film_models.Film.objects.filter(visualizations=1).count(), 3)
+
+
+class UserActivityCacheTest(FilmsTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.films = self.create_films(3)
+
+    def test_duplicates_from_cache(self):
+        """
+        Ensure the duplicate checks read the cached activity and follow the writes.
+        """
+        data = {'film': self.films[0].pk, 'user': self.user.pk}
+        response = self.client.post(reverse('film_visualize'), data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(reverse('film_visualize'), data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse([query for query in context.captured_queries if 'userfilmvisualization' in query['sql']])
+
+        film_models.UserFilmVisualization.objects.filter(user=self.user).delete()
+        self.assertFalse(film_activity.user_activity.contains(self.user.pk, 'watched', self.films[0].pk))
+        self.assertEqual(film_activity.user_activity.stats()['misses'], 1)
+
+    def test_duplicates_from_constraint(self):
+        """
+        Ensure duplicates the cache doesn't know about are rejected by the unique constraint.
+        """
+        film_activity.user_activity.contains(self.user.pk, 'watched', self.films[0].pk)
+        film_models.UserFilmVisualization.objects.bulk_create([film_models.UserFilmVisualization(user=self.user, film=self.films[0])])
+
+        data = {'film': self.films[0].pk, 'user': self.user.pk}
+        response = self.client.post(reverse('film_visualize'), data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data, {'non_field_errors': ['You already visualized this film']})
+
+        items = [{'film': film.pk} for film in self.films]
+        response = self.client.post(reverse('film_visualize_bulk'), items, format='json')
+        self.assertEqual([item['status'] for item in response.data['results']], ['exists', 'created', 'created'])
+        self.assertEqual(film_models.UserFilmVisualization.objects.filter(user=self.user).count(), 3)
+
+    def test_rate_queries(self):
+        """
+        Ensure a rate reads the film once and doesn't look up the film and the user again.
+        """
+        film_activity.user_activity.contains(self.user.pk, 'rated', self.films[0].pk)
+        data = {'film': self.films[0].pk, 'user': self.user.pk, 'rating': 7}
+        # session, user, film, savepoint, INSERT, UPDATE of the aggregates, the film scopes and
+        # genres and the boards read by the leaderboard refresh and the savepoint release
+        with self.assertNumQueries(10):
+            response = self.client.post(reverse('film_rate'), data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(film_models.UserFilmRating.objects.get(user=self.user).film_id, self.films[0].pk)
+
+    def test_writes_of_other_processes(self):
+        """
+        Ensure a cached user is loaded again once another process moved the shared user version.
+        """
+        self.assertFalse(film_activity.user_activity.contains(self.user.pk, 'watched', self.films[0].pk))
+        # a write of another process, its signals update the activity cache of that process only
+        film_models.UserFilmVisualization.objects.bulk_create([film_models.UserFilmVisualization(user=self.user, film=self.films[0])])
+        self.assertFalse(film_activity.user_activity.contains(self.user.pk, 'watched', self.films[0].pk))
+
+        film_cache.bump_user_version(self.user.pk)
+        self.assertTrue(film_activity.user_activity.contains(self.user.pk, 'watched', self.films[0].pk))
+        self.assertEqual(film_activity.user_activity.stats()['misses'], 2)
+
+        film_models.UserFilmRating.objects.create(user=self.user, film=self.films[1], rating=5)
+        self.assertTrue(film_activity.user_activity.contains(self.user.pk, 'rated', self.films[1].pk))
+        self.assertEqual(film_activity.user_activity.stats()['misses'], 2)
+
+    @override_settings(FILMS_ACTIVITY_CACHE_SIZE=1)
+    def test_eviction(self):
+        """
+        Ensure the least recently used user is evicted when the cache is full.
+        """
+        other = User.objects.create_user(username='other', password='password')
+        film_activity.user_activity.contains(self.user.pk, 'rated', self.films[0].pk)
+        film_activity.user_activity.contains(other.pk, 'rated', self.films[0].pk)
+        film_activity.user_activity.contains(other.pk, 'watched', self.films[0].pk)
+
+        self.assertEqual(film_activity.user_activity.stats(), {'hits': 1, 'misses': 2, 'evictions': 1, 'size': 1})
+
+
+@override_settings(FILMS_LEADERBOARD_SIZE=3, FILMS_VISUALIZATION_FLUSH_SIZE=1)
+class LeaderboardTest(FilmsTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.movie = film_models.FilmType.objects.create(name='movie')
+        self.series = film_models.FilmType.objects.create(name='series')
+        self.drama = film_models.Genre.objects.create(name='drama')
+        self.comedy = film_models.Genre.objects.create(name='comedy')
+        self.films = []
+        for number in range(6):
+            film = film_models.Film.objects.create(title=f'Film {number}', film_type=self.movie if number % 2 else self.series)
+            film.genre.add(self.drama, *([self.comedy] if number < 3 else []))
+            self.films.append(film)
+        self.users = [User.objects.create_user(username=f'user{number}', password='password') for number in range(3)]
+
+    def boards(self):
+        entries = film_models.LeaderboardEntry.objects.order_by('scope', 'scope_id', 'metric', '-score', 'film_id')
+        return list(entries.values_list('scope', 'scope_id', 'metric', 'film_id', 'score'))
+
+    def assertMatchesRebuild(self):
+        boards = self.boards()
+        film_leaderboards.rebuild()
+        self.assertEqual(boards, self.boards())
+
+    def test_incremental_updates_match_rebuild(self):
+        """
+        Ensure the boards updated by the signals hold the same films as boards rebuilt from the films table.
+        """
+        self.assertMatchesRebuild()
+        ratings = []
+        for number, (film, rating) in enumerate([(3, 9), (4, 8), (5, 7), (0, 6), (3, 2)]):
+            ratings.append(film_models.UserFilmRating.objects.create(
+                user=self.users[number % 3], film=self.films[film], rating=rating,
+            ))
+            self.assertMatchesRebuild()
+
+        # the best drama film drops to the last row, another film takes its place
+        ratings[0].rating = 1
+        ratings[0].save()
+        self.assertMatchesRebuild()
+        ratings[1].delete()
+        self.assertMatchesRebuild()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            film_models.UserFilmVisualization.objects.create(user=self.user, film=self.films[4])
+        self.assertMatchesRebuild()
+        self.client.post(reverse('film_rate_bulk'), [{'film': film.pk, 'rating': 10} for film in self.films[:2]], format='json')
+        self.client.post(reverse('film_visualize_bulk'), [{'film': film.pk} for film in self.films[1:3]], format='json')
+        self.assertMatchesRebuild()
+
+        # genre, film type and catalog changes
+        self.films[0].genre.remove(self.comedy)
+        self.assertMatchesRebuild()
+        self.comedy.film_set.add(self.films[5])
+        self.assertMatchesRebuild()
+        self.films[1].refresh_from_db()
+        self.films[1].film_type = self.series
+        self.films[1].save()
+        self.assertMatchesRebuild()
+        self.films[2].delete()
+        self.assertMatchesRebuild()
+        self.comedy.delete()
+        self.assertMatchesRebuild()
+
+    def test_short_boards_missing_films(self):
+        """
+        Ensure a board that isn't full is rebuilt when a film isn't listed on it instead of assuming it lists every film.
+        """
+        western = film_models.Genre.objects.create(name='western')
+        Through = film_models.Film.genre.through
+        # genres written without the signals, like the rows of a fixture
+        Through.objects.bulk_create([Through(film=film, genre=western) for film in self.films[:2]])
+        film_leaderboards.refresh([self.films[0].pk])
+        self.assertMatchesRebuild()
+
+    def test_fixtures(self):
+        """
+        Ensure the rebuild places the films loaded from fixtures and the boards follow the ratings that come after them.
+        """
+        film_models.Film.objects.all().delete()
+        film_models.Genre.objects.all().delete()
+        film_models.FilmType.objects.all().delete()
+        for fixture in ('users.json', 'genres.json', 'film-types.json', 'films.json', 'ratings.json'):
+            call_command('loaddata', fixture, verbosity=0)
+        self.assertFalse(film_models.LeaderboardEntry.objects.exists())
+        call_command('rebuild_leaderboards', stdout=io.StringIO())
+        self.assertTrue(film_models.LeaderboardEntry.objects.exists())
+        self.assertMatchesRebuild()
+
+        film = film_models.Film.objects.order_by('pk').first()
+        with self.captureOnCommitCallbacks(execute=True):
+            film_models.UserFilmRating.objects.create(user=self.users[0], film=film, rating=0.5)
+        self.assertMatchesRebuild()
+
+    def test_endpoint(self):
+        """
+        Ensure the endpoint returns the boards in rank order and rejects unknown boards.
+        """
+        for number, film in enumerate(self.films):
+            film_models.UserFilmRating.objects.create(user=self.user, film=film, rating=number)
+        film_models.Film.objects.filter(pk=self.films[0].pk).update(visualizations=5)
+        call_command('rebuild_leaderboards', stdout=io.StringIO())
+
+        response = self.client.get(reverse('leaderboard') + '?genre=Drama', HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([film['pk'] for film in response.data['films']], [film.pk for film in self.films[:2:-1]])
+
+        response = self.client.get(reverse('leaderboard') + '?film_type=series&metric=visualizations')
+        self.assertEqual(response.data['films'][0]['pk'], self.films[0].pk)
+
+        with self.assertNumQueries(2):
+            # session and user, the board and the film bodies come from the cache
+            self.client.get(reverse('leaderboard') + '?genre=Drama', HTTP_ACCEPT='application/json')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            film_models.UserFilmRating.objects.create(user=self.users[0], film=self.films[0], rating=10)
+        response = self.client.get(reverse('leaderboard') + '?genre=Drama', HTTP_ACCEPT='application/json')
+        self.assertEqual(response.data['films'][0]['pk'], self.films[0].pk)
+
+        self.assertEqual(self.client.get(reverse('leaderboard')).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(reverse('leaderboard') + '?genre=drama&metric=title').status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(reverse('leaderboard') + '?genre=western').status_code, status.HTTP_404_NOT_FOUND)
+
+
+class CursorPaginationTest(FilmsTestCase):
+
+    url = reverse('films')
+
+    def setUp(self) -> None:
+        super().setUp()
+        film_types = [film_models.FilmType.objects.create(name=name) for name in ('movie', 'series')]
+        genres = [film_models.Genre.objects.create(name=name) for name in ('drama', 'comedy', 'western')]
+        for number in range(25):
+            film = film_models.Film.objects.create(
+                title=f'Film {number % 7}', film_type=film_types[number % 2] if number % 5 else None,
+                rating=number % 4, visualizations=number % 3,
+            )
+            film.genre.add(*genres[:number % 3 + 1])
+
+    def walk(self, ordering):
+        """
+        follow the next cursors and then the previous cursors and return the pk lists
+        """
+        params = {'pagination': 'cursor', 'ordering': ordering}
+        forward, backward, pages = [], [], []
+        while True:
+            data = self.client.get(self.url, params, HTTP_ACCEPT='application/json').data
+            pages.append(data)
+            forward += [film['pk'] for film in data['results']]
+            if not data['next']:
+                break
+            params = {'cursor': data['next'], 'ordering': ordering}
+        backward = [film['pk'] for film in data['results']]
+        while data['previous']:
+            data = self.client.get(self.url, {'cursor': data['previous'], 'ordering': ordering}, HTTP_ACCEPT='application/json').data
+            backward = [film['pk'] for film in data['results']] + backward
+        return forward, backward, pages
+
+    def test_cursor_orderings(self):
+        """
+        Ensure every ordering walks all the films once, in order, in both directions.
+        """
+        orderings = {
+            'title': lambda film: film.title,
+            'genre': None,
+            '-film_type': lambda film: -(film.film_type_id or -1),
+            '-rating': lambda film: -film.rating,
+            '-visualizations': lambda film: -film.visualizations,
+        }
+        films = {film.pk: film for film in film_models.Film.objects.all()}
+        for ordering, key in orderings.items():
+            forward, backward, pages = self.walk(ordering)
+            self.assertEqual(forward, backward, ordering)
+            self.assertTrue(all(len(page['results']) == 9 for page in pages[:-1]), ordering)
+            if key is None:
+                expected = film_models.Film.objects.values_list('pk', flat=True).order_by('genre__name', 'pk')
+                self.assertEqual(forward, list(expected))
+            else:
+                self.assertEqual(sorted(forward), sorted(films))
+                keys = [key(films[pk]) for pk in forward]
+                self.assertEqual(keys, sorted(keys), ordering)
+
+    def test_invalid_cursor(self):
+        """
+        Ensure an invalid cursor returns a 404.
+        """
+        response = self.client.get(self.url, {'cursor': 'nope'}, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        invalid = [
+            (None, ['Film 1', [1]]), (None, [{}, 1]), (None, ['Film 1', '1']),
+            ('-rating', ['7', 'Film 1', 1]), ('-rating', [True, 'Film 1', 1]),
+        ]
+        for ordering, values in invalid:
+            cursor = urlsafe_b64encode(json.dumps({'v': values, 'r': False}).encode()).decode()
+            params = {'cursor': cursor, 'ordering': ordering} if ordering else {'cursor': cursor}
+            response = self.client.get(self.url, params, HTTP_ACCEPT='application/json')
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND, values)
+
+
+class ImportCatalogTest(TestCase):
+
+    def setUp(self) -> None:
+        self.user = User.objects.create_user(username='test', password='password')
+        self.film_type = film_models.FilmType.objects.create(name='movie')
+        self.genre = film_models.Genre.objects.create(name='drama')
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write_file(self, name, content):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w') as stream:
+            stream.write(content)
+        return path
+
+    def test_import_csv_and_ndjson(self):
+        """
+        Ensure films and ratings are imported with slugs, genre masks and aggregates.
+        """
+        films = self.write_file('films.csv', f'id,title,film_type,genre,visualizations\n'
+                                             f'10,Café Society,{self.film_type.pk},{self.genre.pk},4\n'
+                                             f'11,Heat,{self.film_type.pk},,0\n')
+        ratings = self.write_file('ratings.ndjson', '\n'.join(json.dumps(rating) for rating in [
+            {'model': 'films.userfilmrating', 'pk': 1, 'fields': {'user': self.user.pk, 'film': 10, 'rating': 7}},
+            {'model': 'films.userfilmvisualization', 'pk': 1, 'fields': {'user': self.user.pk, 'film': 10}},
+        ]))
+        call_command('import_catalog', films, stdout=io.StringIO())
+        call_command('import_catalog', ratings, chunk_size=1, stdout=io.StringIO())
+
+        film = film_models.Film.objects.get(pk=10)
+        self.assertEqual((film.rating, film.rating_count, film.visualizations), (7, 1, 5))
+        self.assertRegex(film.slug, r'^cafe-society-[a-z0-9]{6}$')
+        self.assertEqual(film.genre_mask, film_models.genre_mask([self.genre.pk]))
+        self.assertEqual(list(film_models.Film.objects.with_genres([self.genre.pk]).values_list('pk', flat=True)), [10])
+
+    def test_resume(self):
+        """
+        Ensure a resumed import skips the records of the checkpoint.
+        """
+        films = self.write_file('films.ndjson', '\n'.join(json.dumps({'id': pk, 'title': f'Film {pk}'}) for pk in range(1, 5)))
+        self.write_file('films.ndjson.checkpoint', json.dumps({'records': 2, 'visualization_pk': 0}))
+        call_command('import_catalog', films, resume=True, stdout=io.StringIO())
+
+        self.assertEqual(list(film_models.Film.objects.order_by('pk').values_list('pk', flat=True)), [3, 4])
+        self.assertFalse(os.path.exists(films + '.checkpoint'))
+
+
+class SyntheticCatalogTest(FilmsTestCase):
+
+    login = False
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.catalog = film_synthetic.SyntheticCatalog(seed=3, chunk_size=40)
+
+    def test_deterministic_growth(self):
+        """
+        Ensure a catalog grown in steps has the same films as one generated at once.
+        """
+        genres, film_types = self.catalog.ensure_catalog_types()
+        films = list(self.catalog.iter_films(0, 30, genres, film_types))
+        self.assertEqual(list(self.catalog.iter_films(10, 30, genres, film_types)), films[10:])
+        self.assertNotEqual(list(film_synthetic.SyntheticCatalog(seed=4).iter_films(0, 30, genres, film_types)), films)
+
+        self.catalog.grow(10)
+        self.catalog.grow(30)
+        titles = list(film_models.Film.objects.order_by('pk').values_list('title', flat=True))
+        self.assertEqual(titles, [title for title, _, _ in films])
+
+    def test_activity_aggregates(self):
+        """
+        Ensure the generated activity is unique per user and film and the film aggregates match it.
+        """
+        self.catalog.grow(100)
+        self.assertEqual(self.catalog.add_activity(10, 5, 8), (50, 80))
+
+        film = film_models.Film.objects.order_by('-rating_count').first()
+        ratings = film_models.UserFilmRating.objects.filter(film=film)
+        self.assertEqual(film.rating_count, ratings.count())
+        self.assertEqual(film.visualizations, film_models.UserFilmVisualization.objects.filter(film=film).count())
+        self.assertEqual(film_models.UserFilmRating.objects.values('user', 'film').distinct().count(), 50)
+
+    def test_benchmark_baseline(self):
+        """
+        Ensure the benchmark covers every route and flags cases that run more queries than the baseline.
+        """
+        baseline = os.path.join(tempfile.mkdtemp(), 'baseline.json')
+        self.addCleanup(os.remove, baseline)
+        options = {'films': 120, 'users': 5, 'iterations': 2, 'baseline': baseline, 'stdout': io.StringIO()}
+        stderr = io.StringIO()
+        call_command('benchmark', save_baseline=True, stderr=stderr, **options)
+        self.assertEqual(stderr.getvalue(), '')
+        self.assertEqual(film_models.Film.objects.count(), 0)
+
+        with open(baseline) as stream:
+            run = json.load(stream)
+        run['results']['films']['queries'] -= 1
+        with open(baseline, 'w') as stream:
+            json.dump(run, stream)
+        with self.assertRaisesMessage(CommandError, 'films'):
+            call_command('benchmark', only=['films'], **options)
+
+
+class LoadTestCommandTest(TransactionTestCase):
+
+    def setUp(self) -> None:
+        cache.clear()
+        film_activity.user_activity.clear()
+
+    def test_counters_match_after_concurrent_writes(self):
+        """
+        Ensure concurrent ratings and visualizations of the same films leave correct counters.
+        """
+        stdout = io.StringIO()
+        call_command('loadtest', films=20, hot_films=3, users=10, requests=60, concurrency=3, write_ratio=1,
+                     stdout=stdout, stderr=io.StringIO())
+
+        self.assertIn('Counters of 3 hot films match their rows', stdout.getvalue())
+        self.assertTrue(film_models.UserFilmRating.objects.exists())
+        self.assertTrue(film_models.UserFilmVisualization.objects.exists())
+        self.assertFalse(Session.objects.exists())
+
+
+
+class ActivityMigrationTest(TransactionTestCase):
+    """
+    Run the 0006 migration over duplicated activity from 0005
+    """
+
+    migrate_from = [('films', '0005_film_genre_mask')]
+    migrate_to = [('films', '0006_activity_constraints_and_film_indexes')]
+
+    def setUp(self) -> None:
+        self.addCleanup(self.migrate)
+        apps = self.migrate(self.migrate_from)
+        Film = apps.get_model('films', 'Film')
+        User = apps.get_model('auth', 'User')
+        UserFilmRating = apps.get_model('films', 'UserFilmRating')
+        UserFilmVisualization = apps.get_model('films', 'UserFilmVisualization')
+
+        first, second = User.objects.create(username='first'), User.objects.create(username='second')
+        self.film = Film.objects.create(title='Film', visualizations=482, rating=7.1, rating_sum=50, rating_count=7)
+        self.unrated = Film.objects.create(title='Unrated', visualizations=3, rating=8, rating_sum=8, rating_count=1)
+        UserFilmVisualization.objects.bulk_create(
+            [UserFilmVisualization(user=first, film=self.film) for _ in range(3)]
+            + [UserFilmVisualization(user=second, film=self.film)]
+        )
+        UserFilmRating.objects.bulk_create([
+            UserFilmRating(user=first, film=self.film, rating=4),
+            UserFilmRating(user=first, film=self.film, rating=6),
+            UserFilmRating(user=second, film=self.film, rating=9),
+            UserFilmRating(user=first, film=self.unrated, rating=4),
+            UserFilmRating(user=first, film=self.unrated, rating=8),
+        ])
+        self.migrate(self.migrate_to)
+
+    def migrate(self, targets=None):
+        """
+        migrate to the targets, by default the latest migrations, and return their apps
+        """
+        executor = MigrationExecutor(connection)
+        targets = targets or executor.loader.graph.leaf_nodes()
+        executor.migrate(targets)
+        executor.loader.build_graph()
+        return executor.loader.project_state(targets).apps
+
+    def test_seeded_counters(self):
+        """
+        Ensure only the deleted duplicates are subtracted from counters without rows behind them.
+        """
+        film = film_models.Film.objects.get(pk=self.film.pk)
+        self.assertEqual(film.visualizations, 480)
+        self.assertEqual((film.rating_sum, film.rating_count, film.rating), (44, 6, 7.3))
+        self.assertEqual(film_models.UserFilmVisualization.objects.filter(film=film).count(), 2)
+        self.assertEqual(
+            sorted(film_models.UserFilmRating.objects.filter(film=film).values_list('rating', flat=True)), [4, 9]
+        )
+
+    def test_no_ratings_left(self):
+        """
+        Ensure a film whose counted ratings were all duplicates ends with no rating.
+        """
+        film = film_models.Film.objects.get(pk=self.unrated.pk)
+        self.assertEqual((film.rating_sum, film.rating_count, film.rating), (0, 0, 0))
+        self.assertEqual(film.visualizations, 3)
+
+
+class FilmSlugTest(TestCase):
+
+    def test_single_write(self):
+        """
+        Ensure a new film gets a unique slug with a single write.
+        """
+        with CaptureQueriesContext(connection) as context:
+            film = film_models.Film.objects.create(title='Amélie')
+        writes = [query for query in context.captured_queries if query['sql'].startswith(('INSERT INTO "films_film"', 'UPDATE "films_film"'))]
+        self.assertEqual(len(writes), 1)
+        self.assertRegex(film.slug, r'^amelie-[a-z0-9]{6}$')
+        self.assertNotEqual(film.slug, film_models.Film.objects.create(title='Amélie').slug)
+
+        film.title = 'Amélie Poulain'
+        film.save()
+        self.assertEqual(film_models.Film.objects.get(slug=film.slug).pk, film.pk)
+
+    def test_slug_collisions(self):
+        """
+        Ensure a taken slug is drawn again on create, import and repair.
+        """
+        drawn = ['taken-aaaaaa', 'taken-aaaaaa', 'taken-bbbbbb', 'taken-bbbbbb', 'taken-cccccc', 'taken-aaaaaa', 'taken-dddddd']
+        with mock.patch.object(film_models, 'film_slug', side_effect=drawn):
+            first = film_models.Film.objects.create(title='Taken')
+            second = film_models.Film.objects.create(title='Taken')
+            films = [film_models.Film(title='Taken'), film_models.Film(title='Taken')]
+            film_models.assign_slugs(films)
+        self.assertEqual((first.slug, second.slug), ('taken-aaaaaa', 'taken-bbbbbb'))
+        self.assertEqual([film.slug for film in films], ['taken-dddddd', 'taken-cccccc'])
+
+        with mock.patch.object(film_models, 'film_slug', return_value='taken-aaaaaa'):
+            with self.assertRaises(IntegrityError):
+                film_models.Film.objects.create(title='Taken')
+
+    def test_repair_slugs(self):
+        """
+        Ensure missing and invalid slugs are repaired and valid ones are kept.
+        """
+        films = [film_models.Film.objects.create(title=f'Film {number}') for number in range(3)]
+        film_models.Film.objects.filter(pk=films[0].pk).update(slug=None)
+        film_models.Film.objects.filter(pk=films[1].pk).update(slug='Not A Slug')
+        call_command('repair_slugs', stdout=io.StringIO())
+
+        slugs = dict(film_models.Film.objects.values_list('pk', 'slug'))
+        self.assertRegex(slugs[films[0].pk], r'^film-0-[a-z0-9]{6}$')
+        self.assertRegex(slugs[films[1].pk], r'^film-1-[a-z0-9]{6}$')
+        self.assertEqual(slugs[films[2].pk], films[2].slug)
+
+
+class AsyncViewsTest(FilmsTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.async_client = AsyncClient()
+        self.async_client.force_login(self.user)
+        film_type = film_models.FilmType.objects.create(name='movie')
+        genre = film_models.Genre.objects.create(name='drama')
+        self.film = film_models.Film.objects.create(title='Heat', film_type=film_type)
+        self.film.genre.add(genre)
+        film_models.Film.objects.create(title='Ronin', film_type=film_type)
+
+    async def test_same_responses(self):
+        """
+        Ensure the async endpoints return the same JSON bodies as the sync ones.
+        """
+        endpoints = [
+            ('films', 'async_films', [], {'ordering': '-rating'}),
+            ('films', 'async_films', [], {'pagination': 'cursor'}),
+            ('film_detail', 'async_film_detail', [self.film.slug], {}),
+            ('random_film', 'async_random_film', [], {'genre': 'drama'}),
+            ('search_film', 'async_search_film', [], {'title': 'heat'}),
+        ]
+        for name, async_name, args, params in endpoints:
+            response = await sync_to_async(self.client.get)(reverse(name, args=args), params, HTTP_ACCEPT='application/json')
+            async_response = await self.async_client.get(reverse(async_name, args=args), params, ACCEPT='application/json')
+            self.assertEqual(async_response.status_code, status.HTTP_200_OK)
+            self.assertEqual(json.loads(async_response.content), json.loads(response.content))
+
+        response = await self.async_client.get(reverse('async_films'), ACCEPT='text/html')
+        self.assertContains(response, 'Heat')
+        response = await self.async_client.get(reverse('async_home'), ACCEPT='application/json')
+        self.assertIn(json.loads(response.content)['random_movie']['title'], ['Heat', 'Ronin'])
+
+    async def test_errors(self):
+        """
+        Ensure missing films return 404 and anonymous users are sent to the login page.
+        """
+        response = await self.async_client.get(reverse('async_film_detail', args=['missing']), ACCEPT='application/json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = await AsyncClient().get(reverse('async_films'))
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+
+    async def test_token_authentication(self):
+        """
+        Ensure a token without a session is accepted and a wrong token is rejected.
+        """
+        token = await Token.objects.acreate(user=self.user)
+        client = AsyncClient()
+        response = await client.get(reverse('async_films'), ACCEPT='application/json', AUTHORIZATION=f'Token {token.key}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(json.loads(response.content)['results']), 2)
+
+        response = await client.get(reverse('async_films'), ACCEPT='application/json', AUTHORIZATION='Token wrong')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        response = await client.get(reverse('async_films'), ACCEPT='text/html', AUTHORIZATION='Token wrong')
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+
+
+class DatabaseProfileTest(SimpleTestCase):
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, 'films.sqlite3')
+
+    def connect(self, production):
+        connection = sqlite3.connect(self.path, timeout=project_db.SQLITE_BUSY_TIMEOUT if production else 0,
+                                     isolation_level=None, check_same_thread=False)
+        self.addCleanup(connection.close)
+        if production:
+            project_db.apply_pragmas(connection.cursor(), project_db.SQLITE_PRAGMAS)
+        return connection
+
+    def run_profile(self, production):
+        """
+        hold the write lock while a reader and a second writer run, the lock is released after 200ms
+        """
+        writer = self.connect(production)
+        writer.execute('CREATE TABLE IF NOT EXISTS ratings (rating REAL)')
+        writer.execute('INSERT INTO ratings VALUES (1)')
+        reader, other_writer = self.connect(production), self.connect(production)
+
+        writer.execute('BEGIN EXCLUSIVE')
+        writer.execute('INSERT INTO ratings VALUES (2)')
+        release = threading.Timer(0.2, lambda: writer.execute('COMMIT'))
+        release.start()
+        self.addCleanup(release.join)
+
+        results = {}
+        try:
+            results['read'] = reader.execute('SELECT COUNT(*) FROM ratings').fetchone()[0]
+        except sqlite3.OperationalError as error:
+            results['read'] = str(error)
+        try:
+            other_writer.execute('INSERT INTO ratings VALUES (3)')
+            results['write'] = 'ok'
+        except sqlite3.OperationalError as error:
+            results['write'] = str(error)
+        return results
+
+    def test_default_profile_locks(self):
+        """
+        Ensure the defaults fail readers and writers while a write is in progress.
+        """
+        self.assertEqual(self.run_profile(production=False), {'read': 'database is locked', 'write': 'database is locked'})
+
+    def test_production_profile_waits(self):
+        """
+        Ensure WAL reads the last committed data and the busy timeout makes the second writer wait.
+        """
+        self.assertEqual(self.run_profile(production=True), {'read': 1, 'write': 'ok'})
+
+    def test_database_settings(self):
+        """
+        Ensure the production profile keeps connections open on SQLite and Postgres.
+        """
+        databases = project_db.database_settings(Path(self.directory.name), profile='production')
+        self.assertEqual(databases['default']['CONN_MAX_AGE'], project_db.CONN_MAX_AGE)
+        with mock.patch.dict(os.environ, {'DATABASE_ENGINE': 'postgres'}):
+            databases = project_db.database_settings(None, profile='production')
+        self.assertEqual(databases['default']['ENGINE'], 'django.db.backends.postgresql')
+        self.assertTrue(databases['default']['CONN_HEALTH_CHECKS'])
+
+
+@override_settings(DATABASE_REPLICAS=['replica_1', 'replica_2'], DATABASE_REPLICA_SELECTION='round_robin')
+class ReplicaRouterTest(SimpleTestCase):
+
+    def setUp(self) -> None:
+        self.router = project_routers.ReplicaRouter()
+        self.factory = RequestFactory()
+
+    def run_request(self, request, write=False):
+        """
+        run a request through the middleware, return the read database before and after the optional write
+        """
+        reads = []
+
+        def view(request):
+            reads.append(self.router.db_for_read(film_models.Film))
+            if write:
+                self.router.db_for_write(film_models.Film)
+                reads.append(self.router.db_for_read(film_models.Film))
+            return HttpResponse()
+
+        response = project_routers.replica_middleware(view)(request)
+        return reads, response
+
+    def test_reads_of_get_requests_use_the_replicas(self):
+        """
+        Ensure GET reads rotate over the replicas and reads outside a request use the primary.
+        """
+        aliases = [self.run_request(self.factory.get('/films/'))[0][0] for _ in range(4)]
+        self.assertEqual(aliases, ['replica_1', 'replica_2', 'replica_1', 'replica_2'])
+        self.assertEqual(self.router.db_for_read(film_models.Film), 'default')
+
+    def test_writes_pin_the_primary(self):
+        """
+        Ensure POST requests read from the primary and set the read-your-writes cookie.
+        """
+        reads, response = self.run_request(self.factory.post('/films/rate/'), write=True)
+        self.assertEqual(reads, ['default', 'default'])
+        self.assertEqual(response.cookies[project_routers.STICKY_COOKIE]['max-age'], 10)
+
+        reads, response = self.run_request(self.factory.get('/films/'), write=True)
+        self.assertEqual(reads[1], 'default')
+        self.assertNotIn(project_routers.STICKY_COOKIE, response.cookies)
+
+        request = self.factory.get('/films/')
+        request.COOKIES[project_routers.STICKY_COOKIE] = '1'
+        self.assertEqual(self.run_request(request)[0], ['default'])
+
+    def test_writes_pin_the_user(self):
+        """
+        Ensure the reads of a user who just wrote use the primary without the cookie.
+        """
+        cache.clear()
+        request = self.factory.post('/films/rate/')
+        request.user = User(pk=7)
+        self.run_request(request, write=True)
+
+        reads = []
+        for user in (User(pk=7), User(pk=8), None):
+            request = self.factory.get('/films/')
+            if user is not None:
+                request.user = user
+            reads.append(self.run_request(request)[0][0])
+        self.assertEqual(reads[0], 'default')
+        self.assertNotEqual(reads[1], 'default')
+        self.assertNotEqual(reads[2], 'default')
+
+    @override_settings(DATABASE_REPLICA_SELECTION='lru')
+    def test_least_recently_used_selection(self):
+        """
+        Ensure the replica that finished a request last is chosen last.
+        """
+        selector = project_routers.get_selector()
+        busy = selector.choose()
+        idle = selector.choose()
+        selector.release(idle)
+        self.assertEqual(selector.choose(), busy)
+        selector.release(busy)
+        self.assertEqual([selector.choose(), selector.choose()], [idle, busy])
@@ -4,6 +4,7 @@ Films routing configuration file
 
 from django.urls import path
 import films.views as views
+import films.async_views as async_views
 
 urlpatterns = [
     path("", views.HomeView.as_view(), name="home"),
@@ -11,6 +12,19 @@ urlpatterns = [
     path("films/detail/<str:slug>/", views.FilmDetailView.as_view(), name="film_detail"),
     path("films/visualize/", views.VisualizeFilmView.as_view(), name="film_visualize"),
     path("films/rate/", views.RateFilmView.as_view(), name="film_rate"),
+    path("films/visualize/bulk/", views.BulkVisualizeFilmView.as_view(), name="film_visualize_bulk"),
+    path("films/rate/bulk/", views.BulkRateFilmView.as_view(), name="film_rate_bulk"),
     path("films/random/", views.RandomFilmView.as_view(), name="random_film"),
     path("films/search/", views.SearchFilmView.as_view(), name="search_film"),
+    path("films/leaderboard/", views.LeaderboardView.as_view(), name="leaderboard"),
+    path("metrics/", views.MetricsView.as_view(), name="metrics"),
+]
+
+# async read endpoints for ASGI deployments
+urlpatterns += [
+    path("async/", async_views.AsyncHomeView.as_view(), name="async_home"),
+    path("async/films/", async_views.AsyncFilmListView.as_view(), name="async_films"),
+    path("async/films/detail/<str:slug>/", async_views.AsyncFilmDetailView.as_view(), name="async_film_detail"),
+    path("async/films/random/", async_views.AsyncRandomFilmView.as_view(), name="async_random_film"),
+    path("async/films/search/", async_views.AsyncSearchFilmView.as_view(), name="async_search_film"),
 ]
@@ -1,7 +1,181 @@
 from rest_framework import pagination, response
+from rest_framework.exceptions import NotFound
 from collections import OrderedDict
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
+from django.db import connections
+from django.db.models import IntegerField, Q, Value
+from django.db.models.functions import Coalesce
+from django.utils.functional import cached_property
+import films.cache as film_cache
+import films.search as film_search
+import binascii
+import hashlib
+import json
 
-class StandardResultsSetPagination(pagination.PageNumberPagination):
+COUNT_CACHE_TIMEOUT = 60 * 10
+
+
+class CachedCountPaginator(Paginator):
+    """
+    Paginator that keeps the total count on the cache
+
+    The count is stored under the filter signature and the catalog version, so
+    it is computed once per filter until films, genres or film types change.
+    With estimate=True the count stops at estimate_threshold films and larger
+    result sets get an approximate count from estimate_total instead of an
+    exact COUNT, or the exact COUNT when the database has no estimate.
+
+    Args:
+        Paginator (Paginator): Paginator from django.core.paginator
+
+    attributes:
+        signature (str): Normalized filter signature of the queryset
+        estimate (bool): Return an approximate count for large result sets
+        estimated (bool): True when count is approximate
+    """
+
+    estimate_threshold = 10000
+
+    def __init__(self, object_list, per_page, signature, estimate=False, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.signature = signature
+        self.estimate = estimate
+        self.estimated = False
+
+    def cache_key(self, estimated=False):
+        digest = hashlib.sha1(self.signature.encode()).hexdigest()
+        suffix = ":estimated" if estimated else ""
+        return f"films:count:{film_cache.get_catalog_version()}:{digest}{suffix}"
+
+    @cached_property
+    def count(self):
+        """
+        Total number of films, from the cache when possible
+        """
+        count = cache.get(self.cache_key())
+        if count is not None:
+            return count
+
+        if self.estimate:
+            count = cache.get(self.cache_key(estimated=True))
+            if count is not None:
+                self.estimated = True
+                return count
+
+            bounded = self.object_list.order_by()[:self.estimate_threshold].count()
+            total = self.estimate_total() if bounded >= self.estimate_threshold else None
+            if total is not None:
+                self.estimated = True
+                count = max(bounded, total)
+                cache.set(self.cache_key(estimated=True), count, COUNT_CACHE_TIMEOUT)
+                return count
+            # without an estimate the count of a large result set is exact
+            count = bounded if bounded < self.estimate_threshold else super().count
+        else:
+            count = super().count
+
+        cache.set(self.cache_key(), count, COUNT_CACHE_TIMEOUT)
+        return count
+
+    def estimate_total(self):
+        """
+        Approximate number of rows, None when the database has no estimate for the queryset
+
+        PostgreSQL estimates any queryset from its query plan, other databases
+        only estimate unfiltered querysets from the id range.
+        """
+        connection = connections[self.object_list.db]
+        if connection.vendor == "postgresql":
+            sql, params = self.object_list.order_by().query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+                plan = cursor.fetchone()[0]
+            plan = json.loads(plan) if isinstance(plan, str) else plan
+            return int(plan[0]["Plan"]["Plan Rows"])
+
+        if self.object_list.query.where:
+            return None
+        model = self.object_list.model
+        ids = model._default_manager.using(self.object_list.db).order_by().values_list("pk", flat=True)
+        low = ids.order_by("pk").first()
+        high = ids.order_by("-pk").first()
+        return 0 if low is None else high - low + 1
+
+    def validate_number(self, number):
+        """
+        Approximate counts can be short, so pages after the estimated last page are allowed
+        """
+        self.count
+        if not self.estimated:
+            return super().validate_number(number)
+
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger("That page number is not an integer")
+        if number < 1:
+            raise EmptyPage("That page number is less than 1")
+        return number
+
+    def page(self, number):
+        """
+        Pages of approximate counts are sliced without clamping them to the count
+        """
+        number = self.validate_number(number)
+        if not self.estimated:
+            return super().page(number)
+
+        bottom = (number - 1) * self.per_page
+        return self._get_page(self.object_list[bottom:bottom + self.per_page], number, self)
+
+
+class CachedCountMixin:
+    """
+    Pagination mixin that uses CachedCountPaginator
+
+    Estimated counts are requested with ?count=estimated
+
+    attributes:
+        count_query_param (str): Query param to request estimated counts
+    """
+
+    count_query_param = 'count'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        return super().paginate_queryset(queryset, request, view)
+
+    def django_paginator_class(self, queryset, page_size):
+        """
+        build the paginator, called by paginate_queryset as self.django_paginator_class(queryset, page_size)
+        """
+        self.estimate = self.request.GET.get(self.count_query_param) == "estimated"
+        return CachedCountPaginator(queryset, page_size, self.get_count_signature(self.request, queryset), estimate=self.estimate)
+
+    def get_count_signature(self, request, queryset):
+        """
+        build the signature from the compiled query, subclasses normalize the request filters
+        so equivalent requests share the count
+        """
+        try:
+            sql, params = queryset.order_by().query.sql_with_params()
+        except EmptyResultSet:
+            return "empty"
+        return json.dumps([sql, [str(param) for param in params]])
+
+    def get_count_fields(self):
+        """
+        fields added to the response envelope in estimated mode
+        """
+        if not self.estimate:
+            return []
+        return [('estimated', self.page.paginator.estimated)]
+
+
+class StandardResultsSetPagination(CachedCountMixin, pagination.PageNumberPagination):
     """
     Pagination class for the Get List of Films endpoint
 
@@ -23,6 +197,12 @@ class StandardResultsSetPagination(pagination.PageNumberPagination):
     page_size_query_param = 'page_size'
     max_page_size = 9
 
+    def get_count_signature(self, request, queryset):
+        """
+        only the genre ordering changes the count, it lists a film once per genre
+        """
+        return "films:genre" if request.GET.get("ordering") == "genre" else "films"
+
     def get_paginated_response(self, data, template_name, status):
         """
         get paginated response method
@@ -45,10 +225,11 @@ class StandardResultsSetPagination(pagination.PageNumberPagination):
                 ('previous', self.page.previous_page_number() if self.page.has_previous() else None),
                 ('results', data),
                 ('ordering', self.request.GET.get("ordering") if self.request.GET.get("ordering") else None),
+                *self.get_count_fields(),
             ])
         return response.Response(result, status, template_name)
     
-class FilteredDataResultsSetPagination(pagination.PageNumberPagination):
+class FilteredDataResultsSetPagination(CachedCountMixin, pagination.PageNumberPagination):
     """
     Pagination class for the Get List of Films endpoint
 
@@ -69,6 +250,18 @@ class FilteredDataResultsSetPagination(pagination.PageNumberPagination):
     page_size_query_param = 'page_size'
     max_page_size = 9
 
+    def get_count_signature(self, request, queryset):
+        """
+        build the signature from the search filters, titles are matched by their normalized
+        words and genres and film types case insensitive, every genre is required so
+        case and genre order don't change the results
+        """
+        title = " ".join(film_search.query_tokens(request.GET.get("title")))
+        genres = request.GET.getlist("genres")
+        genres = sorted({genre.lower() for genre in genres[0].split(",")}) if genres else []
+        film_type = (request.GET.get("film_type") or "").lower()
+        return json.dumps(["search", title, genres, film_type])
+
     def get_paginated_response(self, data, template_name, status):
         
         filtering_data = data.pop("filtering_data", None)
@@ -83,5 +276,153 @@ class FilteredDataResultsSetPagination(pagination.PageNumberPagination):
                 ('results', data),
                 ('ordering', self.request.GET.get("ordering") if self.request.GET.get("ordering") else None),
                 ('filtering_data', filtering_data),
+                *self.get_count_fields(),
             ])
-        return response.Response(result, status, template_name)
\ No newline at end of file
+        return response.Response(result, status, template_name)
+
+
+class FilmCursorPagination(pagination.BasePagination):
+    """
+    Keyset pagination class for the Get List of Films endpoint
+
+    Pages are fetched with a WHERE on the ordering keys of the last film seen
+    instead of an OFFSET, so any page costs the same. Every ordering ends with
+    unique tiebreakers and next/previous are opaque cursor tokens.
+    Enabled with ?pagination=cursor, following pages are requested with ?cursor=<token>
+
+    Args:
+        pagination (BasePagination): BasePagination from rest_framework
+
+    Returns:
+        FilmCursorPagination: Keyset pagination class for the Get List of Films endpoint
+
+    attributes:
+        page_size (int): Number of items per page
+        cursor_query_param (str): Query param with the cursor token
+        orderings (dict): Ordering value -> list of (key, descending)
+        annotations (dict): Keys that are not film columns
+        key_types (dict): Key -> types a cursor value of the key may have
+    """
+
+    page_size = 9
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+    orderings = {
+        None: [("title", False), ("pk", False)],
+        "title": [("title", False), ("pk", False)],
+        "genre": [("genre_key", False), ("pk", False)],
+        "-film_type": [("film_type_key", True), ("title", False), ("pk", False)],
+        "-rating": [("rating", True), ("title", False), ("pk", False)],
+        "-visualizations": [("visualizations", True), ("title", False), ("pk", False)],
+    }
+    annotations = {
+        "genre_key": Coalesce("genre__name", Value("")),
+        "film_type_key": Coalesce("film_type", Value(-1), output_field=IntegerField()),
+    }
+    key_types = {
+        "pk": (int,),
+        "title": (str,),
+        "genre_key": (str,),
+        "film_type_key": (int,),
+        "rating": (int, float),
+        "visualizations": (int,),
+    }
+
+    @classmethod
+    def is_requested(cls, request):
+        """
+        check if the request asks for cursor pagination
+        """
+        return request.GET.get("pagination") == "cursor" or cls.cursor_query_param in request.GET
+
+    def paginate_queryset(self, queryset, request, view=None):
+        """
+        paginate queryset method
+
+        Args:
+            queryset (QuerySet): Films queryset
+            request (Request): Request with the ordering and cursor
+
+        Returns:
+            list: Films of the page
+        """
+        self.request = request
+        self.ordering = request.GET.get("ordering") or None
+        if self.ordering not in self.orderings:
+            raise NotFound("Ordering not found")
+
+        keys = self.orderings[self.ordering]
+        cursor = self.decode_cursor(request, keys)
+        reverse = cursor is not None and cursor["reverse"]
+
+        queryset = queryset.annotate(**{name: self.annotations[name] for name, _ in keys if name in self.annotations})
+        if cursor is not None:
+            queryset = queryset.filter(self.after(keys, cursor["values"], reverse))
+        order = [("-" if descending != reverse else "") + name for name, descending in keys]
+
+        films = list(queryset.order_by(*order)[:self.page_size + 1])
+        has_more = len(films) > self.page_size
+        films = films[:self.page_size]
+        if reverse:
+            films.reverse()
+
+        has_next = has_more if not reverse else cursor is not None
+        has_previous = cursor is not None if not reverse else has_more
+        self.next = self.encode_cursor(keys, films[-1], False) if films and has_next else None
+        self.previous = self.encode_cursor(keys, films[0], True) if films and has_previous else None
+        return films
+
+    def after(self, keys, values, reverse):
+        """
+        build the filter for the films after the cursor values in the page direction
+        """
+        query = Q()
+        for position, (name, descending) in enumerate(keys):
+            lookup = "lt" if descending != reverse else "gt"
+            equal = {key: value for (key, _), value in zip(keys[:position], values)}
+            query |= Q(**equal, **{f"{name}__{lookup}": values[position]})
+        return query
+
+    def encode_cursor(self, keys, film, reverse):
+        data = {"v": [film[name] for name, _ in keys], "r": reverse}
+        return urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+    def decode_cursor(self, request, keys):
+        token = request.GET.get(self.cursor_query_param)
+        if not token:
+            return None
+        try:
+            data = json.loads(urlsafe_b64decode(token.encode()))
+            values, reverse = data["v"], bool(data["r"])
+        except (binascii.Error, ValueError, TypeError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(values, list) or len(values) != len(keys):
+            raise NotFound(self.invalid_cursor_message)
+        for (name, _), value in zip(keys, values):
+            # bool is an int, any other value would reach the database lookups
+            if isinstance(value, bool) or not isinstance(value, self.key_types[name]):
+                raise NotFound(self.invalid_cursor_message)
+        return {"values": values, "reverse": reverse}
+
+    def get_paginated_response(self, data, template_name, status):
+        """
+        get paginated response method
+
+        Args:
+            data (dict): Results of the query
+            template_name (str): Template name
+            status (int): Status code
+
+        Returns:
+            Response: Response with the pagination data
+        """
+
+        result = OrderedDict([
+                ('items_on_page', self.page_size),
+                ('next', self.next),
+                ('previous', self.previous),
+                ('results', data),
+                ('ordering', self.ordering),
+                ('cursor', True),
+            ])
+        return response.Response(result, status, template_name)
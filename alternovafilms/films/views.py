@@ -1,16 +1,28 @@
 import films.models as film_models
 import films.serializers as film_serializers
+import films.cache as film_cache
+import films.counters as film_counters
+import films.search as film_search
+import films.activity as film_activity
+import films.instrumentation as film_instrumentation
+import films.metrics as film_metrics
+import films.leaderboards as film_leaderboards
+from films.conditional import conditional_get, catalog_versions, film_versions
 import rest_framework.views as views
 import rest_framework.generics as generics
 from rest_framework import renderers, permissions, response, authentication
 from django.contrib.auth.mixins import LoginRequiredMixin
-from films.utils import StandardResultsSetPagination, FilteredDataResultsSetPagination
-from django.http import Http404
+from films.utils import StandardResultsSetPagination, FilteredDataResultsSetPagination, FilmCursorPagination
+from django.http import Http404, HttpResponse, HttpResponseForbidden
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
 from django.urls import reverse
 from functools import reduce
 from django.db.models import Q
+from django.db import IntegrityError, transaction
+from django.views import View
+from django.conf import settings
+import secrets
 
 class HomeView(generics.ListAPIView):
     """
@@ -20,6 +32,9 @@ class HomeView(generics.ListAPIView):
     top_films: list of top 5 films ordered by rating
     most_seen: list of top 3 films ordered by visualizations
     random_movie: random film
+
+    top_films and most_seen are served from the cached home snapshot and
+    the random film from the films cache
     """
     renderer_classes = [renderers.TemplateHTMLRenderer ,renderers.JSONRenderer]
     template_name = "films/index.html"
@@ -32,13 +47,14 @@ class HomeView(generics.ListAPIView):
         Get method
         """
         
-        top_films = film_models.Film.objects.all().order_by("-rating")[:5]
-        most_seen = film_models.Film.objects.all().order_by("-visualizations")[:3]
-        random_movie = film_models.Film.objects.all().order_by("?").first()
+        snapshot = film_cache.get_home_snapshot()
+        random_movie = film_models.Film.objects.only("pk").random()
+        random_movie = film_cache.get_films([random_movie.pk] if random_movie is not None else [])
+        random_movie = random_movie[0] if random_movie else None
 
-        top_films = self.serializer_class(top_films, many=True).data
-        most_seen = self.serializer_class(most_seen, many=True).data
-        random_movie = self.serializer_class(random_movie).data
+        top_films = film_counters.visualizations.with_pending(snapshot["top_films"])
+        most_seen = film_counters.visualizations.with_pending(snapshot["most_seen"])
+        random_movie = film_counters.visualizations.with_pending(random_movie)
 
 
         return response.Response({"top_films":top_films, "most_seen":most_seen, "random_movie":random_movie}, template_name="films/index.html")
@@ -59,6 +75,10 @@ class FilmListView(LoginRequiredMixin, generics.ListAPIView):
     Page size value is not required, default value is 9
 
     Ordering and page size example: /films/?ordering=-rating&page=2
+
+    Cursor pagination is enabled with pagination=cursor, next and previous
+    are then cursor tokens sent back with the cursor parameter
+    Cursor example: /films/?ordering=-rating&pagination=cursor
     """
     queryset = film_models.Film.objects.all()
     template_name = "films/films.html"
@@ -72,33 +92,46 @@ class FilmListView(LoginRequiredMixin, generics.ListAPIView):
     ordering = openapi.Parameter('ordering', openapi.IN_QUERY, description= f"Ordering value, accepted values: title, genre, -film_type, -rating, -visualizations", type=openapi.TYPE_STRING)
     page = openapi.Parameter('page', openapi.IN_QUERY, description= f"Page number", type=openapi.TYPE_INTEGER)
     page_size = openapi.Parameter('page_size', openapi.IN_QUERY, description= f"Page size, not required always 9", type=openapi.TYPE_INTEGER,  required=False, enum=[9])
+    pagination = openapi.Parameter('pagination', openapi.IN_QUERY, description= "Pagination mode, use cursor for cursor pagination", type=openapi.TYPE_STRING, required=False, enum=["cursor"])
+    cursor = openapi.Parameter('cursor', openapi.IN_QUERY, description= "Cursor token from the next or previous values", type=openapi.TYPE_STRING, required=False)
+    
+    count = openapi.Parameter('count', openapi.IN_QUERY, description= "Count mode, use estimated for an approximate total on large results", type=openapi.TYPE_STRING, required=False, enum=["estimated"])
     
-    @swagger_auto_schema(manual_parameters=[ordering, page, page_size])
+    @swagger_auto_schema(manual_parameters=[ordering, page, page_size, pagination, cursor, count])
+    @conditional_get(catalog_versions)
     def get(self, request, *args, **kwargs):
         films = self.get_queryset()
-        paginator = StandardResultsSetPagination()
+        if FilmCursorPagination.is_requested(request):
+            paginator = FilmCursorPagination()
+        else:
+            paginator = StandardResultsSetPagination()
         page = paginator.paginate_queryset(films, request)
         if page is not None:
-            serializer = self.get_serializer(page, many=True)
-            return paginator.get_paginated_response(serializer.data, template_name="films/films.html", status=200)
+            data = film_counters.visualizations.with_pending(film_cache.get_films([film["pk"] for film in page]))
+            return paginator.get_paginated_response(data, template_name="films/films.html", status=200)
         
-        serializer = self.get_serializer(films, many=True)
-        return response.Response(serializer.data, template_name="films/films.html", status=200)
+        data = film_counters.visualizations.with_pending(film_cache.get_films([film["pk"] for film in films]))
+        return response.Response(data, template_name="films/films.html", status=200)
 
     def get_queryset(self, *args, **kwargs):
+        """
+        get queryset method for film listing view
+
+        Will return the film ids and sort columns in the requested ordering, the bodies come from the films cache
+        """
         ordering = self.request.GET.get("ordering")
         acepted_orders = ["title", "genre", "-film_type", "-rating", "-visualizations"]
         if ordering:
             if ordering in acepted_orders:
                 if ordering == "genre":
-                    queryset = film_models.Film.objects.all().order_by("genre__name")
+                    queryset = film_models.Film.objects.page_keys().order_by("genre__name", "pk")
                 else:
-                    queryset = film_models.Film.objects.all().order_by(ordering, "title")
+                    queryset = film_models.Film.objects.page_keys().order_by(ordering, "title")
 
                 return queryset
             else:
                 raise Http404("Ordering not found")
-        queryset = film_models.Film.objects.all()
+        queryset = film_models.Film.objects.page_keys()
         return queryset
     
 
@@ -114,15 +147,18 @@ class FilmDetailView(LoginRequiredMixin, views.APIView):
     authentication_classes = [authentication.SessionAuthentication, authentication.TokenAuthentication]
     renderer_classes = [renderers.TemplateHTMLRenderer, renderers.JSONRenderer]
 
+    @conditional_get(film_versions)
     def get(self, request, *args, **kwargs):
         film = self.get_object()
-        serializer = self.serializer_class(film)
-        return response.Response({'film':serializer.data}, template_name="films/film_detail.html", status=200)
+        with film_instrumentation.timer("serialize"):
+            data = self.serializer_class(film).data
+        data = film_counters.visualizations.with_pending(data)
+        return response.Response({'film':data}, template_name="films/film_detail.html", status=200)
 
     def get_object(self, *args, **kwargs):
         slug = self.kwargs.get("slug")
         try:
-            film = film_models.Film.objects.get(slug=slug)
+            film = film_models.Film.objects.with_related().get(slug=slug)
             return film
         except film_models.Film.DoesNotExist:
             raise Http404("Film not found")
@@ -133,6 +169,8 @@ class RandomFilmView(LoginRequiredMixin, views.APIView):
     Random Film View
 
     Will return a random film detail
+    The random film can be limited to a genre or film type
+    Example: /films/random/?genre=drama&film_type=movie
     """
     
     template_name = "films/film_detail.html"
@@ -141,17 +179,25 @@ class RandomFilmView(LoginRequiredMixin, views.APIView):
     authentication_classes = [authentication.SessionAuthentication, authentication.TokenAuthentication]
     renderer_classes = [renderers.TemplateHTMLRenderer, renderers.JSONRenderer]
 
+    # parameters:
+    genre = openapi.Parameter('genre', openapi.IN_QUERY, description= "Genre Filter, must use any genre name.", type=openapi.TYPE_STRING)
+    film_type = openapi.Parameter('film_type', openapi.IN_QUERY, description= "Film Type Filter, must use any film type name.", type=openapi.TYPE_STRING)
+
+    @swagger_auto_schema(manual_parameters=[genre, film_type])
     def get(self, request, *args, **kwargs):
         film = self.get_object()
-        serializer = self.serializer_class(film)
-        return response.Response({'film':serializer.data}, template_name="films/film_detail.html", status=200)
+        with film_instrumentation.timer("serialize"):
+            data = self.serializer_class(film).data
+        data = film_counters.visualizations.with_pending(data)
+        return response.Response({'film':data}, template_name="films/film_detail.html", status=200)
 
     def get_object(self, *args, **kwargs):
-        try:
-            film = film_models.Film.objects.all().order_by("?").first()
-            return film
-        except film_models.Film.DoesNotExist:
+        genre = self.request.GET.get("genre", None)
+        film_type = self.request.GET.get("film_type", None)
+        film = film_models.Film.objects.with_related().random(genre=genre, film_type=film_type)
+        if film is None:
             raise Http404("Film not found")
+        return film
         
 
 class VisualizeFilmView(LoginRequiredMixin, generics.CreateAPIView):
@@ -189,10 +235,12 @@ class VisualizeFilmView(LoginRequiredMixin, generics.CreateAPIView):
         will create a film visualization and return the film data with the new visualization
         """
         film = self.get_object(request.data)
-        serializer = self.get_serializer(data=request.data)
+        serializer = self.get_serializer(data=request.data, context={**self.get_serializer_context(), "film":film, "user":request.user})
         if serializer.is_valid():
             serializer.save(film=film, user=request.user)
-            film = {**serializer.data, "film_slug":film.slug ,"visualizations":film.visualizations}
+            film.refresh_from_db(fields=["visualizations"])
+            visualizations = film.visualizations + film_counters.visualizations.pending(film.pk)
+            film = {**serializer.data, "film_slug":film.slug ,"visualizations":visualizations}
             return response.Response({"film_data":film, "message":"You have successfully visualized the film"}, status=201)
         return response.Response(serializer.errors, status=400)
         
@@ -234,19 +282,176 @@ class RateFilmView(LoginRequiredMixin, generics.CreateAPIView):
         or the errors if the data is not valid
         """
         film = self.get_object(request.data)
-        serializer = self.get_serializer(data=request.data)
+        serializer = self.get_serializer(data=request.data, context={**self.get_serializer_context(), "film":film, "user":request.user})
         if serializer.is_valid():
             serializer.save(film=film, user=request.user)
-            film = {**serializer.data, "film_slug":film.slug ,"visualizations":film.visualizations}
+            visualizations = film.visualizations + film_counters.visualizations.pending(film.pk)
+            film = {**serializer.data, "film_slug":film.slug ,"visualizations":visualizations}
             return response.Response({"film_data":film, "message":"You have successfully rated the film"}, status=201)
         return response.Response(serializer.errors, status=400)
 
 
+class BulkFilmActivityView(LoginRequiredMixin, generics.GenericAPIView):
+    """
+    Base view for the bulk visualization and rating endpoints
+
+    Receives a list of items and returns the status of each one:
+    created: the item was stored
+    invalid: the item data is not valid, errors has the details
+    not_found: the film doesn't exist
+    duplicate: the film was sent more than once, only the first one is used
+    exists: the user already has a visualization or rating for the film
+
+    Existing (user, film) pairs are found on the user activity cache and the new items
+    are stored with bulk_create and a set-wise film update in one transaction. Pairs
+    the cache missed are caught by the unique constraint and read from the database,
+    when the second attempt conflicts too the request gets a 409 and nothing is stored.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    authentication_classes = [authentication.SessionAuthentication, authentication.TokenAuthentication]
+    renderer_classes = [renderers.JSONRenderer]
+    model = None
+    activity = None
+    metric = None
+    max_items = 500
+    message = None
+
+    def post(self, request, *args, **kwargs):
+        """
+        post method
+
+        will store the valid items and return the status of every item
+        """
+        items = request.data
+        if not isinstance(items, list):
+            return response.Response({"detail":"Expected a list of items"}, status=400)
+        if len(items) > self.max_items:
+            return response.Response({"detail":f"Send at most {self.max_items} items"}, status=400)
+
+        results = []
+        validated = {}
+        for item in items:
+            serializer = self.get_serializer(data=item)
+            if not serializer.is_valid():
+                film_id = item.get("film") if isinstance(item, dict) else None
+                results.append({"film":film_id, "status":"invalid", "errors":serializer.errors})
+                continue
+
+            film_id = serializer.validated_data["film"]
+            results.append({"film":film_id, "status":"duplicate" if film_id in validated else None})
+            validated.setdefault(film_id, serializer.validated_data)
+
+        films = set(film_models.Film.objects.filter(pk__in=validated.keys()).values_list("pk", flat=True))
+        existing = {
+            film_id for film_id in films
+            if film_activity.user_activity.contains(request.user.pk, self.activity, film_id)
+        }
+
+        pending = [result for result in results if result["status"] is None]
+        try:
+            rows = self.store(request, pending, films, existing, validated)
+        except IntegrityError:
+            # the cache missed a row written by another process, read the pairs from the database
+            existing = set(
+                self.model.objects.filter(user=request.user, film_id__in=films).values_list("film_id", flat=True)
+            )
+            try:
+                rows = self.store(request, pending, films, existing, validated)
+            except IntegrityError:
+                # another request of the user is storing the same films, nothing was stored
+                return response.Response({"detail":"The films are being stored by another request, try again"}, status=409)
+
+        if rows:
+            versions = film_cache.bump_user_version(request.user.pk)
+            film_activity.user_activity.add(request.user.pk, self.activity, [row.film_id for row in rows], versions)
+            film_cache.bump_film_stats([row.film_id for row in rows])
+            film_cache.refresh_home_snapshots([row.film_id for row in rows])
+            film_leaderboards.refresh([row.film_id for row in rows], (self.metric,))
+            film_metrics.activity.inc(self.activity, amount=len(rows))
+
+        return response.Response({"results":results, "created":len(rows), "message":self.message}, status=201 if rows else 200)
+
+    def store(self, request, results, films, existing, validated):
+        """
+        set the status of the results and store the new rows in one transaction
+
+        Returns:
+            list: The stored rows
+        """
+        rows = []
+        for result in results:
+            film_id = result["film"]
+            if film_id not in films:
+                result["status"] = "not_found"
+            elif film_id in existing:
+                result["status"] = "exists"
+            else:
+                result["status"] = "created"
+                fields = {key: value for key, value in validated[film_id].items() if key != "film"}
+                rows.append(self.model(user=request.user, film_id=film_id, **fields))
+
+        if rows:
+            with transaction.atomic():
+                self.model.objects.bulk_create(rows)
+                self.update_films(rows)
+        return rows
+
+    def update_films(self, rows):
+        """
+        update the films of the stored rows, bulk_create doesn't send the post_save signals
+        """
+        raise NotImplementedError
+
+
+class BulkVisualizeFilmView(BulkFilmActivityView):
+    """
+    Bulk Visualize Film View
+
+    Will create the visualizations of several films for the user
+
+    required parameters:
+    list of items with film: film id
+    Example: [{"film": 1}, {"film": 2}]
+    """
+    serializer_class = film_serializers.FilmVisualizationItemSerializer
+    model = film_models.UserFilmVisualization
+    activity = "watched"
+    metric = "visualizations"
+    message = "You have successfully visualized the films"
+
+    def update_films(self, rows):
+        film_models.Film.objects.add_visualizations({row.film_id: 1 for row in rows})
+
+
+class BulkRateFilmView(BulkFilmActivityView):
+    """
+    Bulk Rate Film View
+
+    Will rate several films for the user
+
+    required parameters:
+    list of items with film: film id and rating: rating value
+    Example: [{"film": 1, "rating": 7}, {"film": 2, "rating": 9.5}]
+    """
+    serializer_class = film_serializers.FilmRatingItemSerializer
+    model = film_models.UserFilmRating
+    activity = "rated"
+    metric = "rating"
+    message = "You have successfully rated the films"
+
+    def update_films(self, rows):
+        film_models.Film.objects.add_ratings({row.film_id: (row.rating, 1) for row in rows})
+
+
 class SearchFilmView(LoginRequiredMixin, generics.ListAPIView):
     """
     Search Film View
 
     Will return a list of films filtered by title, genre or film type
+
+    Titles are matched on the full-text index, accents and case are ignored and
+    every word must start a word of the title. Results are ranked by relevance
+    and then by rating
     """
     
     template_name = "films/search.html"
@@ -263,9 +468,11 @@ class SearchFilmView(LoginRequiredMixin, generics.ListAPIView):
     genres = openapi.Parameter('genres', openapi.IN_QUERY, description= f"Genre Filter, must use any genre name.", type=openapi.TYPE_ARRAY, items=openapi.Items(type=openapi.TYPE_STRING))
     page = openapi.Parameter('page', openapi.IN_QUERY, description= f"Page number", type=openapi.TYPE_INTEGER)
     page_size = openapi.Parameter('page_size', openapi.IN_QUERY, description= f"Page size, not required always 9", type=openapi.TYPE_INTEGER,  required=False, enum=[9])
+    count = openapi.Parameter('count', openapi.IN_QUERY, description= "Count mode, use estimated for an approximate total on large results", type=openapi.TYPE_STRING, required=False, enum=["estimated"])
 
 
-    @swagger_auto_schema(manual_parameters=[title, film_type, genres, page, page_size])
+    @swagger_auto_schema(manual_parameters=[title, film_type, genres, page, page_size, count])
+    @conditional_get(catalog_versions)
     def get(self, request, *args, **kwargs):
         """
         get method for search film view
@@ -287,15 +494,12 @@ class SearchFilmView(LoginRequiredMixin, generics.ListAPIView):
         
         films = self.get_queryset()
         
-        if films:
-            paginator = FilteredDataResultsSetPagination()
-            page = paginator.paginate_queryset(films, request)
-            if page is not None:
-                serializer = self.get_serializer(page, many=True)
-                return paginator.get_paginated_response({"results":serializer.data, "filtering_data":filtering_data}, template_name="films/search.html", status=200)
-            
-            serializer = self.get_serializer(films, many=True)
-            return response.Response({"results":serializer.data, "filtering_data":filtering_data}, template_name="films/search.html", status=200)
+        # the cached count tells if there are results, an empty first page means no films
+        paginator = FilteredDataResultsSetPagination()
+        page = paginator.paginate_queryset(films, request)
+        if page:
+            data = film_counters.visualizations.with_pending(film_cache.get_films([film["pk"] for film in page]))
+            return paginator.get_paginated_response({"results":data, "filtering_data":filtering_data}, template_name="films/search.html", status=200)
         
         return response.Response({"message":"No films found", "filtering_data":filtering_data}, template_name="films/search.html", status=200)
     
@@ -315,27 +519,32 @@ class SearchFilmView(LoginRequiredMixin, generics.ListAPIView):
         query = []
 
         if title:
-            films_by_title = film_models.Film.objects.filter(title__icontains=title)
+            films_by_title = film_search.get_backend().filter(film_models.Film.objects.all(), title)
             query.append(films_by_title)
 
         if genres:
             
             genres = genres[0].split(",")
+            genre_ids = film_cache.get_name_ids(film_models.Genre)
             films_by_genre = film_models.Film.objects.all()
-            for genre in genres:
-                films_by_genre = films_by_genre.filter(genre__name__iexact=genre)
-            
-            
+            if all(len(genre_ids.get(genre.lower(), [])) == 1 for genre in genres):
+                # every name is a single genre, the genre mask answers it without joins
+                films_by_genre = films_by_genre.with_genres([genre_ids[genre.lower()][0] for genre in genres])
+            else:
+                for genre in genres:
+                    films_by_genre = films_by_genre.filter(genre__name__iexact=genre)
             
             query.append(films_by_genre)
 
         if film_type:
-            films_by_type = film_models.Film.objects.filter(film_type__name__iexact=film_type)
+            film_type_ids = film_cache.get_name_ids(film_models.FilmType).get(film_type.lower(), [])
+            films_by_type = film_models.Film.objects.filter(film_type__in=film_type_ids)
             query.append(films_by_type)
 
         if len(query) > 0:
             query = reduce(lambda x, y: x & y, query)
-            return query.distinct().order_by("-rating")
+            ordering = ["search_rank", "-rating"] if title else ["-rating"]
+            return query.distinct().order_by(*ordering).page_keys()
         
         return None
 
@@ -351,4 +560,65 @@ class SearchFilmView(LoginRequiredMixin, generics.ListAPIView):
        
 
 
+class LeaderboardView(LoginRequiredMixin, views.APIView):
+    """
+    Leaderboard View
+
+    Will return the best films of a genre or film type by rating or by visualizations
+    The board is read from the materialized leaderboards and the films from the films cache
+    Example: /films/leaderboard/?genre=drama&metric=visualizations
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+    authentication_classes = [authentication.SessionAuthentication, authentication.TokenAuthentication]
+    renderer_classes = [renderers.JSONRenderer]
+
+    # parameters:
+    genre = openapi.Parameter('genre', openapi.IN_QUERY, description= "Genre of the board, must use any genre name.", type=openapi.TYPE_STRING)
+    film_type = openapi.Parameter('film_type', openapi.IN_QUERY, description= "Film type of the board, must use any film type name.", type=openapi.TYPE_STRING)
+    metric = openapi.Parameter('metric', openapi.IN_QUERY, description= "Ranking of the board, rating by default", type=openapi.TYPE_STRING, required=False, enum=list(film_leaderboards.METRICS))
+
+    @swagger_auto_schema(manual_parameters=[genre, film_type, metric])
+    @conditional_get(catalog_versions)
+    def get(self, request, *args, **kwargs):
+        genre = request.GET.get("genre")
+        film_type = request.GET.get("film_type")
+        metric = request.GET.get("metric", "rating")
+        if bool(genre) == bool(film_type):
+            return response.Response({"message":"Please provide a genre or a film type"}, status=400)
+        if metric not in film_leaderboards.METRICS:
+            return response.Response({"message":f"Metric must be one of {', '.join(film_leaderboards.METRICS)}"}, status=400)
+
+        if genre:
+            scope, name, model = film_models.LeaderboardEntry.GENRE, genre, film_models.Genre
+        else:
+            scope, name, model = film_models.LeaderboardEntry.FILM_TYPE, film_type, film_models.FilmType
+        scope_ids = film_cache.get_name_ids(model).get(name.lower())
+        if not scope_ids:
+            raise Http404(f"{model._meta.verbose_name.capitalize()} not found")
+
+        films = film_cache.get_films(film_leaderboards.get_board(scope, scope_ids, metric))
+        films = film_counters.visualizations.with_pending(films)
+        return response.Response({scope:name, "metric":metric, "films":films}, status=200)
+
+
+class MetricsView(View):
+    """
+    Metrics View
 
+    Will return the request counters, the latency histograms per view and the
+    activity counters of every worker process in the Prometheus text format
+
+    Only staff users and scrapers sending the FILMS_METRICS_TOKEN bearer token can read them
+    """
+
+    def get(self, request, *args, **kwargs):
+        if not self.is_allowed(request):
+            return HttpResponseForbidden()
+        return HttpResponse(film_metrics.registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+    def is_allowed(self, request):
+        if request.user.is_authenticated and request.user.is_staff:
+            return True
+        token = getattr(settings, "FILMS_METRICS_TOKEN", None)
+        return bool(token) and secrets.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}")